@@ -0,0 +1,241 @@
+﻿"""
+Builds the reports of several schools (or school years) in one run.
+
+The schools are listed in a JSON manifest, every school is a folder with its own input files and template,
+named like in config.py (timetable.xlsx, grades.xlsx, days.xlsx, newkaz, template.xlsx, ...):
+
+    {
+        "schools": [
+            {"name": "school 12, 2023", "directory": "school12/2023", "parallels": ["5", "6"]},
+            {"name": "school 12, DOD", "directory": "school12/2023", "dod": true},
+            {"directory": "../school7"}
+        ]
+    }
+
+    python batch.py schools.json --jobs 4
+
+Relative directories are relative to the manifest. Without "parallels" every parallel of the school's timetable
+is built. Every school x parallel is a job for a bounded pool of worker processes, a job runs inside the folder
+of its school, so the reports end up in the school's own config.output_dir. All workers share one on-disk cache
+(config.cache_dir next to the manifest): it is keyed by the content of the files, so schools with the same
+template or calendar parse it once. The timings and errors of all jobs are summarized at the end
+and written to batch_summary.json next to the manifest.
+"""
+from typing import Dict, List, Optional
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+import argparse
+import json
+import os
+import time
+import cache
+import config
+import instrument
+import log
+import main
+
+
+class School:
+    def __init__(self, name: str, directory: str, parallels: List[str], is_dod=False):
+        self.name = name
+        self.directory = directory
+        self.parallels = parallels
+        self.is_dod = is_dod
+
+    def __repr__(self):
+        return f"school '{self.name}' in '{self.directory}'"
+
+    @contextmanager
+    def inside(self):
+        """Runs the block in the folder of the school, where the relative paths of config.py point to its files."""
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            yield self
+        finally:
+            os.chdir(cwd)
+
+
+def load_schools(manifest_path: str) -> List[School]:
+    with open(manifest_path, encoding="utf-8") as f:
+        entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries.get("schools", [])
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    schools = []
+    for entry in entries:
+        if "directory" not in entry:
+            raise ValueError(f"Every school in '{manifest_path}' needs a directory: {entry}")
+        directory = os.path.normpath(os.path.join(base_dir, entry["directory"]))
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"The folder '{directory}' of a school in '{manifest_path}' was not found.")
+        is_dod = bool(entry.get("dod", False))
+        name = entry.get("name") or entry["directory"] + (" (DOD)" if is_dod else "")
+        schools.append(School(name, directory, [str(parallel) for parallel in entry.get("parallels", [])], is_dod))
+
+    names = [school.name for school in schools]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"The school names in '{manifest_path}' must be unique, these are not: {duplicates}")
+    return schools
+
+
+def init_batch_worker(cache_dir: str, *worker_settings):
+    main.init_worker(*worker_settings)
+    config.cache_dir = cache_dir  # absolute, shared by the jobs of every school
+
+
+def school_parallels(school: School) -> List[str]:
+    """The parallels of the school's timetable, the 1st grade only has DOD journals."""
+    with school.inside():
+        parallels = main.timetable_parallels(school.is_dod)
+        cache.save()
+    return parallels
+
+
+def build_parallel(school: School, parallel: str, skip_topics_hw=False, writer_backend="openpyxl",
+                   incremental=True) -> dict:
+    """Builds the report of one parallel of the school, returns its job record for the batch summary."""
+    start = time.perf_counter()
+    with school.inside():
+        saved_reports, failed_parallels = main.build_reports(
+            [parallel], is_dod=school.is_dod, skip_topics_hw=skip_topics_hw,
+            writer_backend=writer_backend, incremental=incremental)
+        report = saved_reports.get(parallel)
+        report = os.path.abspath(report) if report else None
+    error = failed_parallels.get(parallel)
+    if report is None and error is None:
+        error = "the school has no classes in this parallel"
+    return {"school": school.name, "parallel": parallel, "report": report, "error": error,
+            "seconds": round(time.perf_counter() - start, 3)}
+
+
+def run_batch(
+        schools: List[School],
+        jobs: int = 1,
+        cache_dir: Optional[str] = None,
+        skip_topics_hw=False,
+        writer_backend: str = "openpyxl",
+        incremental=True
+) -> List[dict]:
+    """
+    Runs every school x parallel job in a pool of jobs worker processes, the parallels of a school without
+    a list of parallels are looked up in its timetable first. Returns a record of every job, failed ones included.
+    """
+    cache_dir = os.path.abspath(cache_dir or config.cache_dir)
+    records = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker,
+                             initargs=(cache_dir, *main.worker_settings())) as pool:
+        pending = {}
+
+        def submit(school: School, parallel: str):
+            future = pool.submit(main.run_in_worker, build_parallel, school, parallel,
+                                 skip_topics_hw, writer_backend, incremental)
+            pending[future] = (school, parallel)
+
+        for school in schools:
+            if school.parallels:
+                for parallel in school.parallels:
+                    submit(school, parallel)
+            else:
+                pending[pool.submit(main.run_in_worker, school_parallels, school)] = (school, None)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                school, parallel = pending.pop(future)
+                try:
+                    result, output, failed, recorded, events = future.result()
+                except Exception as e:
+                    result, output, failed, recorded, events = None, "", True, [], []
+                    log.error("\n{}: the worker process failed: {}", school, e)
+                log.write_output(output)
+                instrument.merge(recorded)
+                log.merge(events)
+
+                if parallel is None:
+                    if failed:
+                        records.append(failed_record(school, None, "could not read the timetable, see the messages above"))
+                        continue
+                    log.info("\n--> {}: parallels {}", school, result)
+                    for found_parallel in result:
+                        submit(school, found_parallel)
+                    continue
+
+                record = result if not failed else failed_record(school, parallel, "see the traceback above")
+                records.append(record)
+                log.info("\n--> {} parallel {} finished ({} jobs done)", school.name, parallel, len(records))
+
+    log_batch_summary(schools, records, time.perf_counter() - start, jobs)
+    return records
+
+
+def failed_record(school: School, parallel: Optional[str], error: str) -> dict:
+    return {"school": school.name, "parallel": parallel, "report": None, "error": error, "seconds": None}
+
+
+def log_batch_summary(schools: List[School], records: List[dict], seconds: float, jobs: int):
+    log.summary(f"\n{'='*20} BATCH SUMMARY {'='*20}")
+    by_school: Dict[str, List[dict]] = {school.name: [] for school in schools}
+    for record in records:
+        by_school[record["school"]].append(record)
+    for school_name, school_records in by_school.items():
+        log.summary("  {}:", school_name)
+        for record in sorted(school_records, key=lambda record: int(record["parallel"] or 0)):
+            if record["error"] is None:
+                log.summary("    parallel {}: saved '{}' in {:.1f} s", record["parallel"], record["report"],
+                            record["seconds"], school=school_name, parallel=record["parallel"])
+            else:
+                log.summary("    parallel {}: FAILED ({})", record["parallel"] or "?", record["error"],
+                            school=school_name, parallel=record["parallel"])
+    failed = sum(1 for record in records if record["error"] is not None)
+    busy = sum(record["seconds"] or 0 for record in records)
+    log.summary("  {} jobs, {} failed, {:.1f} s with {} workers ({:.1f} s of work)",
+                len(records), failed, seconds, jobs, busy)
+    log.flush()
+
+
+def write_batch_summary(records: List[dict], filepath: str):
+    with open(filepath, "w", encoding="utf-8") as f:
+        json.dump({"jobs": records}, f, ensure_ascii=False, indent=2)
+    log.info("\nSaved the batch summary to '{}'.", filepath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the reports of every school in a batch manifest.")
+    parser.add_argument("manifest", help="JSON file with the schools, see batch.py")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes, each builds one parallel of one school at a time")
+    parser.add_argument("--writer", choices=main.WRITER_BACKENDS, default="openpyxl",
+                        help="'stream' writes each sheet straight to a new report instead of keeping the workbook in memory")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="regenerate every sheet, even those whose inputs did not change since the last run")
+    parser.add_argument("--trace", action="store_true",
+                        help="time every stage and write run_summary.json and run_trace.json next to the manifest")
+    parser.add_argument("--quiet", "-q", action="store_true", help="only show warnings, errors and the summary")
+    parser.add_argument("--verbose", "-v", action="store_true", help="show every detail")
+    parser.add_argument("--skip-topics", action="store_true", help="do not write dates, topics and homework")
+    parser.add_argument("--seed", type=int, default=config.random_seed,
+                        help="the run seed, the same seed gives the same grades in every sheet")
+    args = parser.parse_args()
+    if args.quiet and args.verbose:
+        parser.error("use either --quiet or --verbose, not both")
+
+    batch_dir = os.path.dirname(os.path.abspath(args.manifest))
+    batch_schools = load_schools(args.manifest)
+    instrument.enable(args.trace)
+    config.random_seed = args.seed
+    if args.verbose:
+        log.set_mode("verbose")
+    elif args.quiet:
+        log.set_mode("quiet")
+
+    batch_records = run_batch(batch_schools, jobs=max(1, args.jobs), cache_dir=os.path.join(batch_dir, config.cache_dir),
+                              skip_topics_hw=args.skip_topics, writer_backend=args.writer, incremental=not args.rebuild)
+    write_batch_summary(batch_records, os.path.join(batch_dir, "batch_summary.json"))
+    if args.trace:
+        instrument.print_stages()
+        instrument.write_summary(os.path.join(batch_dir, "run_summary.json"))
+        instrument.write_trace(os.path.join(batch_dir, "run_trace.json"))
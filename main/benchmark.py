@@ -0,0 +1,232 @@
+﻿"""
+Times every stage of the report generation on a synthetic school (see synthetic_school.py).
+
+    python benchmark.py --classes 4 --subjects 10 --students 30
+    python benchmark.py --save-baseline          # remember these timings for this size
+    python benchmark.py                          # ... and compare a later version against them
+
+Each stage gets its inputs prepared outside the timing, is timed on its own (best of --repeat runs)
+and then run once more under tracemalloc for its peak memory. The baseline of every school size is stored
+in config.benchmark_dir, a stage that got slower than the baseline by more than --tolerance is flagged.
+"""
+from typing import Callable, Dict, List, Optional
+from contextlib import redirect_stdout
+import argparse
+import gc
+import json
+import os
+import time
+import tracemalloc
+import numpy as np
+import openpyxl
+import config
+import class_extractor
+import grade_generator as gg
+import helper
+import log
+import main
+import sheet_fragment
+import stream_writer
+import timetable_extractor
+import topic_extractor
+import writer
+from synthetic_school import SyntheticSchool, school_folder
+
+MAX_EXTEND_SHEETS = 24  # every sheet copy of the template holds ~26k cells, the stage samples this many
+
+
+class Stage:
+    def __init__(self, name: str, run: Callable, items: int, unit: str, prepare: Optional[Callable] = None):
+        self.name = name
+        self.run = run  # run(prepared input), the part that is timed
+        self.items = items
+        self.unit = unit
+        self.prepare = prepare or (lambda: None)
+
+
+def extract_school(school: SyntheticSchool):
+    classes = timetable_extractor.parse_timetable(school.timetable_path)
+    topic_extractor.extract_all_topics_and_hw(classes)
+    class_extractor.extract_grades_and_classes(classes, filepath=school.grades_path)
+    return [current_class for current_class in classes.values() if current_class is not None]
+
+
+def build_stages(school: SyntheticSchool) -> List[Stage]:
+    all_days = config.all_days_in_each_quarter
+    with redirect_stdout(open(os.devnull, "w")):
+        classes = extract_school(school)
+        units = list(main.parallel_units(classes, all_days))
+    state = {}
+
+    grade_batches = []
+    for current_class, quarter_num, subject, grades, *_ in units:
+        quarter_grades = grades[:, quarter_num - 1]
+        marks = quarter_grades[np.isin(quarter_grades, list(config.grade_bands))].astype(np.int64)
+        if len(marks):
+            grade_batches.append((marks, subject, quarter_num, helper.get_parallel(current_class.name) < 5))
+
+    def generate_grades(_):
+        for marks, subject, quarter_num, is_beginner_class in grade_batches:
+            gg.generate_plausible_grades_batch(marks, subject, quarter_num, is_beginner_class)
+
+    extend_units = units[:MAX_EXTEND_SHEETS]
+
+    def template_copies():
+        workbook = openpyxl.load_workbook(config.template_path)
+        template_sheet = workbook[config.template_sheet_name]
+        return [workbook.copy_worksheet(template_sheet) for _ in extend_units]
+
+    def extend_columns(sheets):
+        for sheet, (_, quarter_num, subject, *_) in zip(sheets, extend_units):
+            lessons = len(helper.get_days_this_quarter(subject, quarter_num, all_days))
+            writer.extend_day_columns(sheet, lessons, quarter_num == 4, subject.has_exam)
+
+    def write_sheets(workbook):
+        for unit in units:
+            main.quarter(workbook, *unit[:4], all_days, skip_topics_hw=False)
+        for name in (config.template_sheet_name, config.dod_template_sheet_name):
+            workbook.remove(workbook[name])
+        state["workbook"] = workbook
+
+    def stream_save(fragments):
+        stream = stream_writer.StreamReportWriter(config.template_path)
+        for fragment in fragments:
+            stream.add(fragment)
+        stream.save(os.path.join(school.folder, "stream report.xlsx"))
+
+    num_students = school.num_classes * school.num_students
+    num_topic_files = len(os.listdir(school.topic_paths[0])) + len(os.listdir(school.topic_paths[1]))
+    return [
+        Stage("timetable extraction", lambda _: timetable_extractor.parse_timetable(school.timetable_path),
+              school.num_classes, "classes"),
+        Stage("topic extraction", topic_extractor.extract_all_topics_and_hw, num_topic_files, "files",
+              prepare=lambda: timetable_extractor.parse_timetable(school.timetable_path)),
+        Stage("grade extraction",
+              lambda classes: class_extractor.extract_grades_and_classes(classes, filepath=school.grades_path),
+              num_students, "students", prepare=lambda: timetable_extractor.parse_timetable(school.timetable_path)),
+        Stage("generate_plausible_grades", generate_grades,
+              sum(len(batch[0]) for batch in grade_batches), "students"),
+        Stage("extend_day_columns", extend_columns, len(extend_units), "sheets", prepare=template_copies),
+        Stage("sheet writing", write_sheets, len(units), "sheets",
+              prepare=lambda: openpyxl.load_workbook(config.template_path)),
+        Stage("save (openpyxl)", lambda workbook: workbook.save(os.path.join(school.folder, "report.xlsx")),
+              len(units), "sheets", prepare=lambda: state["workbook"]),
+        Stage("save (stream)", stream_save, len(units), "sheets",
+              prepare=lambda: [sheet_fragment.extract_fragment(sheet) for sheet in state["workbook"].worksheets]),
+    ]
+
+
+def measure(stage: Stage, repeat: int = 1, trace_memory=True) -> dict:
+    seconds = []
+    with redirect_stdout(open(os.devnull, "w")):
+        for _ in range(repeat):
+            prepared = stage.prepare()
+            gc.collect()
+            start = time.perf_counter()
+            stage.run(prepared)
+            seconds.append(time.perf_counter() - start)
+            log.flush()
+            del prepared
+
+        peak_mb = None
+        if trace_memory:
+            prepared = stage.prepare()
+            gc.collect()
+            tracemalloc.start()
+            try:
+                stage.run(prepared)
+                peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+                log.flush()
+            finally:
+                tracemalloc.stop()
+            del prepared
+
+    best = min(seconds)
+    return {
+        "seconds": best,
+        "items": stage.items,
+        "unit": stage.unit,
+        "per_second": stage.items / best if best > 0 else None,
+        "peak_mb": peak_mb,
+    }
+
+
+def baseline_path(school: SyntheticSchool) -> str:
+    return os.path.join(config.benchmark_dir,
+                        f"baseline_{school.num_classes}x{school.num_subjects}x{school.num_students}.json")
+
+
+def load_baseline(school: SyntheticSchool) -> Dict[str, dict]:
+    try:
+        with open(baseline_path(school), encoding="utf-8") as f:
+            return json.load(f)["stages"]
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(school: SyntheticSchool, results: Dict[str, dict]):
+    os.makedirs(config.benchmark_dir, exist_ok=True)
+    with open(baseline_path(school), "w", encoding="utf-8") as f:
+        json.dump({"school": repr(school), "saved": time.strftime("%Y-%m-%d %H:%M:%S"), "stages": results},
+                  f, ensure_ascii=False, indent=1)
+    print(f"\nSaved the baseline to '{baseline_path(school)}'")
+
+
+def print_results(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float):
+    print(f"\n{'stage':<28}{'seconds':>10}{'throughput':>22}{'peak MB':>10}{'vs baseline':>14}")
+    slower = []
+    for name, result in results.items():
+        throughput = f"{result['per_second']:.1f} {result['unit']}/s" if result["per_second"] else "-"
+        peak = f"{result['peak_mb']:.1f}" if result["peak_mb"] is not None else "-"
+        comparison = ""
+        if name in baseline and baseline[name]["seconds"] > 0:
+            ratio = result["seconds"] / baseline[name]["seconds"]
+            comparison = f"{ratio:.2f}x"
+            if ratio > 1 + tolerance:
+                comparison += " SLOWER"
+                slower.append(name)
+        print(f"{name:<28}{result['seconds']:>10.3f}{throughput:>22}{peak:>10}{comparison:>14}")
+    if slower:
+        print(f"\n# WARNING: slower than the baseline by more than {tolerance:.0%}: {', '.join(slower)}")
+    return slower
+
+
+def run_benchmark(school: SyntheticSchool, stage_names: List[str] = (), repeat=1, trace_memory=True):
+    results = {}
+    with school.use():
+        for stage in build_stages(school):
+            if stage_names and stage.name not in stage_names:
+                continue
+            print(f"  -> timing {stage.name}...")
+            results[stage.name] = measure(stage, repeat, trace_memory)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times every stage of the report generation on a synthetic school.")
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--subjects", type=int, default=8)
+    parser.add_argument("--students", type=int, default=25)
+    parser.add_argument("--parallels", nargs="+", default=["7"])
+    parser.add_argument("--regenerate", action="store_true", help="write the synthetic input files again")
+    parser.add_argument("--stages", nargs="*", default=[], help="only time these stages")
+    parser.add_argument("--repeat", type=int, default=1, help="keep the best time of this many runs")
+    parser.add_argument("--no-memory", action="store_true", help="skip the extra run that measures peak memory")
+    parser.add_argument("--save-baseline", action="store_true", help="store the timings as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown against the baseline")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    folder = school_folder(args.classes, args.subjects, args.students)
+    synthetic = SyntheticSchool(folder, args.classes, args.subjects, args.students, args.parallels)
+    if args.regenerate or not os.path.exists(synthetic.grades_path):
+        synthetic.generate()
+    print(f"Benchmarking on the {synthetic}")
+
+    stage_results = run_benchmark(synthetic, args.stages, args.repeat, not args.no_memory)
+    print_results(stage_results, load_baseline(synthetic), args.tolerance)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as out:
+            json.dump(stage_results, out, ensure_ascii=False, indent=1)
+    if args.save_baseline:
+        save_baseline(synthetic, stage_results)
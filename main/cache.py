@@ -0,0 +1,131 @@
+﻿"""
+On-disk cache of parsed input workbooks.
+
+Every source file (timetable, grades, days, topic workbooks) is fingerprinted by its
+path, size, mtime and content hash. Whatever an extractor parsed out of that file is
+stored as a pickled blob under the file's content hash, so a run only re-parses the
+files that actually changed and everything else is loaded back in milliseconds.
+"""
+import hashlib
+import os
+import pickle
+import threading
+import config
+import log
+
+CACHE_VERSION = 5  # bump whenever the shape of the parsed data changes
+
+_lock = threading.Lock()
+_state = None  # {"version": int, "files": {path: (size, mtime_ns, digest)}, "entries": {key: bytes}}
+_dirty = False
+
+
+def cache_path() -> str:
+    return os.path.join(config.cache_dir, config.cache_filename)
+
+
+def _empty_state():
+    return {"version": CACHE_VERSION, "files": {}, "entries": {}}
+
+
+def _load_state():
+    global _state
+    if _state is not None:
+        return _state
+
+    _state = _empty_state()
+    if not config.use_cache:
+        return _state
+    try:
+        with open(cache_path(), "rb") as f:
+            loaded = pickle.load(f)
+        if isinstance(loaded, dict) and loaded.get("version") == CACHE_VERSION:
+            _state = loaded
+        else:
+            log.info("# Cache '{}' is from another version and will be rebuilt.", cache_path())
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("# WARNING: Could not read cache '{}', it will be rebuilt. Reason: {}", cache_path(), e)
+    return _state
+
+
+def file_digest(filepath) -> str:
+    """
+    Returns the content hash of a source file.
+    The hash is only recomputed when the size or mtime of the file has changed since the last run.
+    """
+    global _dirty
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)  # raises FileNotFoundError just like opening the file would
+    with _lock:
+        state = _load_state()
+        known = state["files"].get(filepath)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    with _lock:
+        _load_state()["files"][filepath] = (stat.st_size, stat.st_mtime_ns, digest)
+        _dirty = True
+    return digest
+
+
+def get_or_parse(kind: str, filepath, parse, *variant):
+    """
+    Returns the cached result of parse(filepath, *variant) for the current content of the file.
+
+    Args:
+        kind (str): What is being parsed ("timetable", "topics", ...), part of the cache key.
+        filepath: The source file, its content hash is part of the cache key.
+        parse: A function called as parse(filepath, *variant) on a cache miss.
+        variant: Extra arguments that change what parse returns (sheet name, is_dod, ...).
+
+    Every call returns a fresh copy, so callers are free to mutate the result.
+    """
+    global _dirty
+    if not config.use_cache:
+        return parse(filepath, *variant)
+
+    key = (kind, file_digest(filepath)) + tuple(variant)
+    with _lock:
+        blob = _load_state()["entries"].get(key)
+    if blob is not None:
+        try:
+            return pickle.loads(blob)
+        except Exception as e:
+            log.warning("# WARNING: Broken cache entry for '{}', parsing again. Reason: {}", filepath, e)
+
+    result = parse(filepath, *variant)
+    blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+    with _lock:
+        _load_state()["entries"][key] = blob
+        _dirty = True
+    return result
+
+
+def save():
+    """Writes the cache back to disk, dropping entries of files that have changed since."""
+    global _dirty
+    if not config.use_cache:
+        return
+    with _lock:
+        if not _dirty or _state is None:
+            return
+        live_digests = {digest for (_, _, digest) in _state["files"].values()}
+        _state["entries"] = {key: blob for key, blob in _state["entries"].items() if key[1] in live_digests}
+
+        os.makedirs(config.cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path()}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path())
+            _dirty = False
+        except OSError as e:
+            log.warning("# WARNING: Could not write cache '{}'. Reason: {}", cache_path(), e)
@@ -0,0 +1,152 @@
+﻿from typing import Dict, List, Tuple, Union
+import numpy as np
+import config
+
+WEEKDAYS = 5  # a school week is Monday to Friday, one slot per day
+
+# the month headers of the sheets, by month number - 1
+MONTH_NAMES = np.array(["Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+                        "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"], dtype=object)
+# "dd" and "dd.mm" labels of every day of the year, by [day of month - 1] and [month - 1, day of month - 1]
+DAY_LABELS = np.array([f"{day:02d}" for day in range(1, 32)], dtype=object)
+SHORT_DATE_LABELS = np.array([[f"{day:02d}.{month:02d}" for day in range(1, 32)] for month in range(1, 13)], dtype=object)
+
+
+class CompiledCalendar:
+    """
+    The school year as read from the days file, a row of WEEKDAYS slots for every school week.
+    For every quarter:
+        dates[q]     datetime64[D] of every slot, NaT where there is no school
+        weekdays[q]  the weekday of every slot, 0 is Monday
+        holidays[q]  True for the slots without school
+    """
+    def __init__(self, dates: Dict[int, np.ndarray]):
+        self.dates: Dict[int, np.ndarray] = {q: np.asarray(d, dtype="datetime64[D]") for q, d in dates.items()}
+        self.weekdays: Dict[int, np.ndarray] = {
+            q: (np.arange(len(d)) % WEEKDAYS).astype(np.int8) for q, d in self.dates.items()}
+        self.holidays: Dict[int, np.ndarray] = {q: np.isnat(d) for q, d in self.dates.items()}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __repr__(self):
+        return f"CompiledCalendar({', '.join(f'{q}: {self.school_days(q).size} days' for q in self.dates)})"
+
+    def school_days(self, quarter_num: int) -> np.ndarray:
+        if quarter_num not in self.dates:
+            return np.array([], dtype="datetime64[D]")
+        return self.dates[quarter_num][~self.holidays[quarter_num]]
+
+    def misplaced_days(self) -> List[np.datetime64]:
+        """The dates that are not in the column of their weekday (1970-01-01 was a Thursday)."""
+        misplaced = []
+        for q, dates in self.dates.items():
+            real_weekdays = (dates.view(np.int64) + 3) % 7
+            misplaced.extend(dates[~self.holidays[q] & (real_weekdays != self.weekdays[q])])
+        return misplaced
+
+    @classmethod
+    def from_day_strings(cls, all_days_in_quarters: Dict[int, List[str]]) -> "CompiledCalendar":
+        """The calendar of days in the format of config.all_days_in_each_quarter."""
+        return cls({q: np.array([np.datetime64("NaT") if day == "nan" else f"{day[6:]}-{day[3:5]}-{day[:2]}"
+                                 for day in days], dtype="datetime64[D]")
+                    for q, days in all_days_in_quarters.items()})
+
+    def day_strings(self) -> Dict[int, List[str]]:
+        """The calendar in the format of config.all_days_in_each_quarter, "dd.mm.yyyy" and "nan" for no school."""
+        day_strings = {}
+        for q, dates in self.dates.items():
+            iso_dates = np.datetime_as_string(dates, unit="D")
+            day_strings[q] = ["nan" if day == "NaT" else f"{day[8:10]}.{day[5:7]}.{day[:4]}" for day in iso_dates]
+        return day_strings
+
+
+class LessonDates:
+    """
+    The lesson dates of one weekly-hours pattern, e.g. [2, 0, 1, 0, 1], as datetime64[D] arrays.
+    A date is repeated once for every lesson hour on that day.
+    """
+    def __init__(self, hours_in_days: Tuple[int, ...], calendar: CompiledCalendar):
+        self.hours_in_days = hours_in_days
+        hours_in_weekdays = np.array(hours_in_days, dtype=np.int64)
+        self.quarters: Dict[int, np.ndarray] = {}
+        year_dates, year_hours = [], []
+        for q in range(1, 5):
+            dates = calendar.dates.get(q, np.array([], dtype="datetime64[D]"))
+            hours = hours_in_weekdays[calendar.weekdays[q]] if q in calendar.dates else np.array([], dtype=np.int64)
+            hours = np.where(np.isnat(dates), 0, hours)
+            self.quarters[q] = np.repeat(dates, hours)
+            year_dates.append(dates)
+            year_hours.append(hours)
+        self.counts: Dict[int, int] = {q: len(days) for q, days in self.quarters.items()}
+
+        # every day with lessons, in the whole year; skip_week keeps every other one of them, starting from the second
+        year_dates, year_hours = np.concatenate(year_dates), np.concatenate(year_hours)
+        lesson_days = year_hours > 0
+        dates, hours = year_dates[lesson_days], year_hours[lesson_days]
+        self.dod: Dict[bool, np.ndarray] = {
+            False: np.repeat(dates, hours),
+            True: np.repeat(dates[1::2], hours[1::2]),
+        }
+
+
+class CalendarIndex:
+    """
+    Computes the lesson dates once per distinct weekly-hours pattern.
+    Subjects of different classes with the same hours in days share the same LessonDates.
+    """
+    def __init__(self, calendar: CompiledCalendar):
+        self.calendar = calendar
+        self.patterns: Dict[Tuple[int, ...], LessonDates] = {}
+
+    def lessons(self, hours_in_days: List[int]) -> LessonDates:
+        pattern = tuple(hours_in_days)
+        lesson_dates = self.patterns.get(pattern)
+        if lesson_dates is None:
+            lesson_dates = LessonDates(pattern, self.calendar)
+            self.patterns[pattern] = lesson_dates
+        return lesson_dates
+
+
+SchoolDays = Union[CompiledCalendar, Dict[int, List[str]]]
+_indexes: Dict[int, Tuple[SchoolDays, CalendarIndex]] = {}
+
+
+def get_calendar_index(all_days_in_quarters: SchoolDays = config.all_days_in_each_quarter) -> CalendarIndex:
+    """
+    Returns the index shared by every subject and class that uses these days for the run.
+    The days are a compiled calendar or lists of "dd.mm.yyyy" strings like config.all_days_in_each_quarter.
+    """
+    known = _indexes.get(id(all_days_in_quarters))
+    if known is None or known[0] is not all_days_in_quarters:
+        calendar = all_days_in_quarters
+        if not isinstance(calendar, CompiledCalendar):
+            calendar = CompiledCalendar.from_day_strings(calendar)
+        known = (all_days_in_quarters, CalendarIndex(calendar))
+        _indexes[id(all_days_in_quarters)] = known
+    return known[1]
+
+
+def month_parts(dates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The month (0 is January) and the day of the month (0 is the first) of every date."""
+    months = dates.astype("datetime64[M]")
+    return months.astype(np.int64) % 12, (dates - months).astype(np.int64)
+
+
+def day_labels(dates: np.ndarray) -> List[str]:
+    """The "dd" label of every date."""
+    _, days = month_parts(dates)
+    return DAY_LABELS[days].tolist()
+
+
+def short_date_labels(dates: np.ndarray) -> List[str]:
+    """The "dd.mm" label of every date."""
+    months, days = month_parts(dates)
+    return SHORT_DATE_LABELS[months, days].tolist()
+
+
+def month_headers(dates: np.ndarray) -> List[Tuple[int, str]]:
+    """(index, month name) of every date that starts a new month, the first date included."""
+    months, _ = month_parts(dates)
+    starts = np.flatnonzero(np.diff(months, prepend=-1) != 0)
+    return list(zip(starts.tolist(), MONTH_NAMES[months[starts]].tolist()))
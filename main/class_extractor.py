@@ -1,110 +1,206 @@
-import pandas as pd
-from classes import Class
+﻿import numpy as np
+from classes import Class, GRADE_SLOTS, EXAM_SLOT, FINAL_SLOT, PASS_FAIL
 import config
-from typing import Dict
+import excel_reader
+from typing import Collection, Dict
 import helper
 import re
+import cache
+import instrument
+import log
 
 
 def process_class_sheet(
-        xls,
+        parsed_sheet,
         sheet_name,
         all_classes_dict: Dict[str, Class],
-        target_class: str = "",
 ):
-    if sheet_name != target_class and target_class != "":
-        return
-
-    print(f"\n# --- Configuration for Class: {sheet_name} ---")
-
-    df = pd.read_excel(xls, sheet_name=sheet_name, header=0)
-    if len(df.columns) < 4:
-        print(f"# Skipping sheet '{sheet_name}' - it does not have the expected format.")
-        return
-
-    genders_col_name = df.columns[0]
-    student_col_name = df.columns[1]
-    subject_col_names = df.columns[3:]
-    df[student_col_name] = df[student_col_name].ffill()
-    df[student_col_name] = df[student_col_name].astype(str).str.strip()
-    data_df = df.dropna(subset=[student_col_name]).copy()
+    log.info("\n# --- Configuration for Class: {} ---", sheet_name)
 
-    unique_student_df = data_df.drop_duplicates(subset=[student_col_name])
-    student_list = unique_student_df[student_col_name].tolist()
-    if not student_list:
+    if parsed_sheet is None:
         return
+    student_list, gender_list, subjects_grades_dict = parsed_sheet
 
-    gender_list = unique_student_df[genders_col_name].notna().tolist()
-    print("\n# List of student names")
-    print(f"student_names_{sheet_name.replace(' ', '_')} = {student_list}")
-    print(f"genders_{sheet_name.replace(' ', '_')} = {gender_list}")
-    subjects_grades_dict = {}
-    for subject in subject_col_names:
-        if 'Unnamed' in str(subject):
-            continue
-
-        normalized_subject = str(subject).strip().lower()
-        grade_series = data_df[subject]
-        grade_string = "".join(grade_series.fillna('').apply(helper.clean_grade))
-        subjects_grades_dict[normalized_subject] = grade_string
+    variable_name = sheet_name.replace(' ', '_')
+    log.debug("\n# List of student names")
+    log.debug("student_names_{} = {}", variable_name, student_list)
+    log.debug("genders_{} = {}", variable_name, gender_list)
 
     if sheet_name not in all_classes_dict:
-        print(f"# WARNING: Class '{sheet_name}' from grades file not found in timetable data. Skipping.")
+        log.warning("# WARNING: Class '{}' from grades file not found in timetable data. Skipping.", sheet_name,
+                    class_name=sheet_name)
         return
 
     clean_class = all_classes_dict[sheet_name]
     clean_class.students = student_list
     clean_class.genders = gender_list
 
-    print("\n# Dictionary of subjects and their grade strings")
-    print(f"subjects_{sheet_name.replace(' ', '_')} = {{")
+    log.debug("\n# Dictionary of subjects and their grade codes")
+    log.debug("subjects_{} = {{", variable_name)
     class_number_str = re.match(r'^\d+', clean_class.name).group(0)
     class_number = int(class_number_str)
+    # from the 5th grade on every student has exam and final rows as well
+    rows_per_student = len(GRADE_SLOTS) if class_number >= 5 else EXAM_SLOT
     for subject, grades in subjects_grades_dict.items():
         if subject in clean_class.subjects:
-            clean_class.subjects[subject].has_exam = check_exam_grade(grades, sheet_name) and class_number >= 5
-            if not clean_class.subjects[subject].has_exam and class_number >= 5:
-                grades = remove_6th_and_7th_chars(grades)
-            clean_class.subjects[subject].grades = grades
-            print(f"    '{subject}':\n        \"{grades}\",")
+            grade_matrix = to_grade_matrix(grades, rows_per_student)
+            has_exam = check_exam_grade(grade_matrix, sheet_name) and class_number >= 5
+            if not has_exam:
+                grade_matrix[:, EXAM_SLOT:] = 0
+            clean_class.subjects[subject].has_exam = has_exam
+            clean_class.subjects[subject].grades = grade_matrix
+            log.debug("    '{}':\n        \"{}\",", subject, grades)
         else:
-            print(f"# WARNING: Grades found for subject '{subject}', but subject is missing from class.")
-    print("}")
+            log.warning("# WARNING: Grades found for subject '{}', but subject is missing from class.", subject,
+                        class_name=sheet_name, subject=subject)
+    log.debug("}")
     return clean_class
 
 
-def check_exam_grade(grades: str, class_name):
+def column_names(header: tuple) -> list:
+    """The column names pandas would give the header row: 'Unnamed: i' for empty cells, 'name.1' for repeats."""
+    names = []
+    seen = {}
+    for idx, value in enumerate(header):
+        name = f"Unnamed: {idx}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def parse_class_sheet(reader: excel_reader.ExcelReader, sheet_name):
+    """
+    Reads the students, their genders and the grade codes of every subject (one per row) from one class sheet.
+    Returns None when the sheet does not have the expected format.
+    """
+    rows = reader.rows(sheet_name)
+    if not rows or len(rows[0]) < 4:
+        log.info("# Skipping sheet '{}' - it does not have the expected format.", sheet_name)
+        return None
+    header, data_rows = column_names(rows[0]), rows[1:]
+
+    # a student's name is only in the first of their rows, the rows below belong to the same student
+    student_list = []
+    gender_list = []
+    known_students = set()
+    student_name = None
+    for row in data_rows:
+        if row[1] is not None:
+            student_name = row[1]
+        name = str(student_name).strip() if student_name is not None else "nan"
+        if name not in known_students:
+            known_students.add(name)
+            student_list.append(name)
+            gender_list.append(row[0] is not None)
+    if not student_list:
+        return None
+
+    # the grades of every subject are cleaned at once, as one block of the sheet
+    grade_codes = helper.clean_grades(np.array(data_rows, dtype=object).reshape(len(data_rows), -1)[:, 3:])
+    subjects_grades_dict = {}
+    for col_idx in range(3, len(header)):
+        subject = header[col_idx]
+        if 'Unnamed' in str(subject):
+            continue
+
+        normalized_subject = str(subject).strip().lower()
+        subjects_grades_dict[normalized_subject] = np.ascontiguousarray(grade_codes[:, col_idx - 3])
+
+    return student_list, gender_list, subjects_grades_dict
+
+
+def to_grade_matrix(grades: np.ndarray, rows_per_student: int) -> np.ndarray:
+    """
+    Turns the grade codes of a subject (rows_per_student codes per student, one per row of the grades file)
+    into a students x GRADE_SLOTS int8 matrix. The slots a student has no row for stay 0.
+    """
+    num_students = -(-len(grades) // rows_per_student)
+    digits = np.zeros(num_students * rows_per_student, dtype=np.int8)
+    digits[:len(grades)] = grades
+    matrix = np.zeros((num_students, len(GRADE_SLOTS)), dtype=np.int8)
+    matrix[:, :rows_per_student] = digits.reshape(num_students, rows_per_student)
+    return matrix
+
+
+def check_exam_grade(grades: np.ndarray, class_name):
+    """A subject has an exam when none of its grades is pass/fail and the first student has a final grade."""
     class_number_str = re.match(r'^\d+', class_name).group(0)
     class_number = int(class_number_str)
-    for grade in grades:
-        if grade == '1':
-            return False
-    if grades[6] != '0' and class_number >= 5:
-        print("has exam")
+    if (grades == PASS_FAIL).any():
+        return False
+    if len(grades) and grades[0, FINAL_SLOT] != 0 and class_number >= 5:
+        log.debug("has exam")
         return True
     else:
         return False
 
 
-def remove_6th_and_7th_chars(input_string: str):
-    """
-    A more concise version using a list comprehension.
-    """
-    # Create a list of 5-character slices for every 7-character step
-    parts = [input_string[i:i+5] for i in range(0, len(input_string), 7)]
-    return "".join(parts)
-
-
+@instrument.timed("grade extraction")
 def extract_grades_and_classes(
         all_classes_dict: Dict[str, Class],
         filepath=config.grades_path,
-        class_name: str = ""
+        targets: Collection[str] = ()
 ):
+    """
+    Fills in the students and grades of the classes from their sheets of the grades file.
+    Only the sheets of target classes the timetable has are read, the other classes become None.
+    """
+    reader = None
+
+    def open_reader():
+        # the workbook is only opened when something is missing from the cache
+        nonlocal reader
+        if reader is None:
+            reader = excel_reader.open_workbook(filepath)
+        return reader
+
     try:
-        xls = pd.ExcelFile(filepath)
+        sheet_names = cache.get_or_parse("grades_sheets", filepath, lambda _: open_reader().sheet_names)
     except FileNotFoundError:
-        print(f"Error: The file '{filepath}' was not found.")
+        log.error("Error: The file '{}' was not found.", filepath)
         return
-    for sheet_name in xls.sheet_names:
-        all_classes_dict[sheet_name] = process_class_sheet(xls, sheet_name, all_classes_dict, target_class=class_name)
+    for sheet_name in sheet_names:
+        if not helper.is_target(sheet_name, targets):
+            all_classes_dict[sheet_name] = None
+            continue
+        if sheet_name not in all_classes_dict:
+            log.warning("# WARNING: Class '{}' from grades file not found in timetable data. Skipping.", sheet_name,
+                        class_name=sheet_name)
+            all_classes_dict[sheet_name] = None
+            continue
+        parsed_sheet = cache.get_or_parse("grades", filepath, lambda _, name: parse_class_sheet(open_reader(), name), sheet_name)
+        all_classes_dict[sheet_name] = process_class_sheet(parsed_sheet, sheet_name, all_classes_dict)
+    if reader is not None:
+        reader.close()
     return
+
+
+def test():
+    """Checks that helper.clean_grades gives the codes of helper.clean_grade, on odd cells and on every sheet of the grades file."""
+    odd_cells = [None, float("nan"), "", "  ", " 5 ", "4.0", 4.0, 3, "Зачёт", "зачет", "сынақ", "есептелінді", "abc", True, 10, -1]
+    sheets = [("odd cells", [odd_cells])]
+    with excel_reader.open_workbook(config.grades_path) as reader:
+        sheets += [(sheet_name, reader.rows(sheet_name)) for sheet_name in reader.sheet_names]
+
+    mismatches = 0
+    for sheet_name, rows in sheets:
+        if not rows:
+            continue
+        block = np.array(rows, dtype=object)
+        codes = helper.clean_grades(block)
+        for (row_idx, col_idx), value in np.ndenumerate(block):
+            expected = int(helper.clean_grade(value))
+            expected = expected if 0 <= expected <= 9 else 0
+            if codes[row_idx, col_idx] != expected:
+                mismatches += 1
+                print(f"{sheet_name} [{row_idx}, {col_idx}] {value!r}: {codes[row_idx, col_idx]} != {expected}")
+    print(f"clean_grades vs clean_grade on {len(sheets)} sheets: {mismatches} mismatches")
+    assert mismatches == 0
+
+
+if __name__ == "__main__":
+    test()
@@ -1,16 +1,119 @@
-﻿from typing import List, Dict
+﻿from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from itertools import repeat
+import sys
+import numpy as np
+import log
+
+# the grade slots of a student, in the order of the rows of the grades file
+GRADE_SLOTS = ("I", "II", "III", "IV", "год", "экз", "итог")
+YEAR_SLOT = 4
+EXAM_SLOT = 5
+FINAL_SLOT = 6
+PASS_FAIL = 1  # the grade code of a pass/fail mark, 0 is no grade
+
+_shared_tuples: Dict[tuple, tuple] = {}
+
+
+def shared_tuple(items: Iterable[str]) -> Tuple[str, ...]:
+    """
+    The one tuple of the process with these interned strings. The topics and homework of a plan are shared
+    like this by every subject that uses them, also by those unpickled in a worker process or from the cache.
+    """
+    items = tuple(map(sys.intern, items))
+    return _shared_tuples.setdefault(items, items)
+
+
+class TopicPlan:
+    """
+    The topics and homework of a subject, run-length encoded: every row of the plan file is one run of
+    a topic and its homework over the lesson hours the row takes. Lessons are numbered over the whole plan,
+    view() gives the per-lesson sequence of any range of them without expanding the plan.
+    """
+    __slots__ = ("topics", "homework", "hours", "lessons")
+
+    def __init__(self, topics: Iterable[str] = (), homework: Iterable[str] = (), hours: Iterable[int] = ()):
+        self.topics = shared_tuple(topics)
+        self.homework = shared_tuple(homework)
+        self.hours: Tuple[int, ...] = tuple(hours)
+        self.lessons = sum(self.hours)
+
+    def __reduce__(self):
+        return TopicPlan, (self.topics, self.homework, self.hours)
+
+    def __len__(self):
+        return self.lessons
+
+    def __repr__(self):
+        return f"TopicPlan({len(self.topics)} topics in {len(self)} lessons)"
+
+    def runs(self, start=0, stop: Optional[int] = None) -> Iterator[Tuple[str, str, int]]:
+        """The (topic, homework, hours) runs of the lessons start..stop, the first and last run cut to the range."""
+        stop = self.lessons if stop is None else min(stop, self.lessons)
+        if stop <= start:
+            return
+        lesson = 0
+        for topic, homework, hours in zip(self.topics, self.homework, self.hours):
+            end = lesson + hours
+            if end > start:
+                yield topic, homework, min(end, stop) - max(lesson, start)
+            if end >= stop:
+                return
+            lesson = end
+
+    def view(self, start=0, stop: Optional[int] = None, pad_to=0, filler="") -> "LessonView":
+        return LessonView(self, start, len(self) if stop is None else stop, pad_to, filler)
+
+
+class LessonView:
+    """
+    The lessons start..stop of a plan, like the slice plan[start:stop] of the expanded plan would be.
+    The topics are padded with the filler (helper.get_repeat_str) up to pad_to lessons, the homework is not.
+    """
+    __slots__ = ("plan", "start", "stop", "pad_to", "filler")
+
+    def __init__(self, plan: TopicPlan, start: int, stop: int, pad_to=0, filler=""):
+        self.plan = plan
+        self.start = start
+        self.stop = stop
+        self.pad_to = pad_to
+        self.filler = filler
+
+    def lessons(self) -> int:
+        """The lessons of the range that the plan has."""
+        return max(0, min(self.stop, len(self.plan)) - self.start)
+
+    def __len__(self):
+        return max(self.lessons(), self.pad_to)
+
+    def topics(self) -> Iterator[str]:
+        for topic, _, hours in self.plan.runs(self.start, self.stop):
+            yield from repeat(topic, hours)
+        yield from repeat(self.filler, self.pad_to - self.lessons())
+
+    def homework(self) -> Iterator[str]:
+        for _, homework, hours in self.plan.runs(self.start, self.stop):
+            yield from repeat(homework, hours)
+
+
+NO_PLAN = TopicPlan()
 
 
 class Subject:
+    __slots__ = ("name", "teacher", "grades", "has_exam", "plan", "hours_in_days")
+
     def __init__(self, name: str, teacher: str):
-        self.name = name
-        self.teacher = teacher
-        self.grades = ""
+        self.name = sys.intern(name)
+        self.teacher = sys.intern(teacher)
+        # students x GRADE_SLOTS, the grade codes of helper.clean_grade; without an exam its slots stay 0
+        self.grades: np.ndarray = np.zeros((0, len(GRADE_SLOTS)), dtype=np.int8)
         self.has_exam = False
-        self.homework = []
-        self.topics = []
+        self.plan: TopicPlan = NO_PLAN  # the topics and homework, shared by the subjects of one plan file
         self.hours_in_days = [0, 0, 0, 0, 0]  # 5 days in a week
 
+    def __reduce__(self):
+        # a flat tuple pickles smaller and faster than the state of the slots
+        return _restore_subject, (self.name, self.teacher, self.grades, self.has_exam, self.plan, self.hours_in_days)
+
     def __repr__(self):
         return f"{self.name}"
 
@@ -20,17 +123,48 @@ class Subject:
     def hours(self):
         return sum(self.hours_in_days)
 
+    @property
+    def pass_fail(self) -> np.ndarray:
+        """students x GRADE_SLOTS, True where the grade is a pass/fail mark."""
+        return self.grades == PASS_FAIL
+
 
 class Class:
+    __slots__ = ("name", "subjects", "students", "genders", "is_kz")
+
     def __init__(self, name: str, subjects: Dict[str, Subject]):
-        self.name = name
+        self.name = sys.intern(name)
         self.subjects: Dict[str, Subject] = subjects
         self.students: List[str] = []
         self.genders: List[bool] = []
 
         self.is_kz = False  # by default
 
-        print(f"class {self.name} has been created!")
+        log.debug("class {} has been created!", self.name)
+
+    def __reduce__(self):
+        return _restore_class, (self.name, self.subjects, self.students, self.genders, self.is_kz)
 
     def __repr__(self):
         return f"class(name='{self.name}') has {len(self.students)} students"
+
+
+def _restore_subject(name, teacher, grades, has_exam, plan, hours_in_days) -> Subject:
+    subject = Subject.__new__(Subject)
+    subject.name = sys.intern(name)
+    subject.teacher = sys.intern(teacher)
+    subject.grades = grades
+    subject.has_exam = has_exam
+    subject.plan = plan
+    subject.hours_in_days = hours_in_days
+    return subject
+
+
+def _restore_class(name, subjects, students, genders, is_kz) -> Class:
+    current_class = Class.__new__(Class)  # without the message of __init__
+    current_class.name = sys.intern(name)
+    current_class.subjects = subjects
+    current_class.students = students
+    current_class.genders = genders
+    current_class.is_kz = is_kz
+    return current_class
@@ -21,6 +21,13 @@ timetable_path = "timetable.xlsx"
 dod_timetable_path = "dodschedule.xlsx"  # dodtimetable
 
 topic_paths = ["newkaz", "newrus", "ДОДказ", "ДОДрус"]
+
+use_cache = True  # keep parsed input workbooks in an on-disk cache between runs
+cache_dir = ".cache"
+cache_filename = "parsed_inputs.pickle"
+benchmark_dir = "benchmarks"  # synthetic schools and the stored benchmark baselines
+memory_limit_mb = None  # memory ceiling of a --low-memory run in MB (--memory-limit), None for no ceiling
+excel_reader = "calamine"  # "calamine" (pip install python-calamine), "openpyxl" or "pandas", see excel_reader.py
 kaz_exception_subject_name = {"казахский язык и литература", "казахский язык"}
 kaz_repeat_str = "Қайталау"
 rus_exception_subject_name = {"орыс тілі мен әдебиеті", "орыс тілі"}
@@ -41,6 +48,7 @@ DAILY_GRADE_BANDS = {
     5: (4.0, 7.0)
 }
 daily_grade_density = 0.66
+random_seed = 20230901  # the run seed, every sheet draws from its own stream of it (see random_streams.py)
 weights = {
     'sop': 50,
     'so4': 50
@@ -86,6 +94,7 @@ dod_date_col = "E"
 dod_topic_col = "F"
 dod_hw_col = "G"
 
+# the school days are read from days_path, these are only used when it can't be read (see main.school_days)
 all_days_in_each_quarter = {
     1: ["nan", "nan", "nan", "nan", "01.09.2023",
         "04.09.2023", "05.09.2023", "06.09.2023", "07.09.2023", "08.09.2023",
@@ -130,8 +139,19 @@ all_days_in_each_quarter = {
 }
 
 
-def get_daily_grade_distribution(bonus, quarter_grade):
-    """Determines the primary daily grade and a secondary grade based on the bonus."""
+# Daily grade splits for every primary grade.
+# The primary grade is highly likely, with a small chance of an adjacent grade
+DAILY_GRADE_SPLITS = {
+    5: {10: 0.75, 9: 0.1, 8: 0.06, 7: 0.04, 6: 0.04, 5: 0.007, 4: 0.003},  # Mostly 5s, some 4s
+    4: {10: 0.05, 9: 0.1, 8: 0.65, 7: 0.1, 6: 0.05, 5: 0.044, 4: 0.005, 3: 0.001},
+    3: {10: 0.01, 9: 0.015, 8: 0.025, 7: 0.05, 6: 0.1, 5: 0.65, 4: 0.1, 3: 0.045, 2: 0.005},
+    2: {10: 0.002, 9: 0.003, 8: 0.005, 7: 0.015, 6: 0.25, 5: 0.05, 4: 0.1, 3: 0.65, 2: 0.1},
+}
+DEFAULT_DAILY_GRADE_SPLIT = DAILY_GRADE_SPLITS[5]  # Default case same as 5
+
+
+def get_primary_daily_grade(bonus, quarter_grade):
+    """Determines the primary daily grade based on the bonus, capped by the quarter grade."""
     primary_grade = 4  # Default grade
     for grade, (min_bonus, max_bonus) in DAILY_GRADE_BANDS.items():
         if min_bonus <= bonus < max_bonus:
@@ -139,16 +159,10 @@ def get_daily_grade_distribution(bonus, quarter_grade):
             # print(f"primary grade is {primary_grade}, bonus {bonus}, quarter grade is {quarter_grade}")
             primary_grade = min(primary_grade, quarter_grade)
             break
+    return primary_grade
+
 
-    # Create a weighted distribution for more realistic grades
-    # The primary grade is highly likely, with a small chance of an adjacent grade
-    split = {10: 0.75, 9: 0.1, 8: 0.06, 7: 0.04, 6: 0.04, 5: 0.007, 4: 0.003} # Default case same as 5
-    if primary_grade == 5:
-        split = {10: 0.75, 9: 0.1, 8: 0.06, 7: 0.04, 6: 0.04, 5: 0.007, 4: 0.003}  # Mostly 5s, some 4s
-    if primary_grade == 4:
-        split = {10: 0.05, 9: 0.1, 8: 0.65, 7: 0.1, 6: 0.05, 5: 0.044, 4: 0.005, 3: 0.001}
-    if primary_grade == 3:
-        split = {10: 0.01, 9: 0.015, 8: 0.025, 7: 0.05, 6: 0.1, 5: 0.65, 4: 0.1, 3: 0.045, 2: 0.005}
-    if primary_grade == 2:
-        split = {10: 0.002, 9: 0.003, 8: 0.005, 7: 0.015, 6: 0.25, 5: 0.05, 4: 0.1, 3: 0.65, 2: 0.1}
-    return split
+def get_daily_grade_distribution(bonus, quarter_grade):
+    """Determines the primary daily grade and a secondary grade based on the bonus."""
+    primary_grade = get_primary_daily_grade(bonus, quarter_grade)
+    return DAILY_GRADE_SPLITS.get(primary_grade, DEFAULT_DAILY_GRADE_SPLIT)
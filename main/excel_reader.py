@@ -0,0 +1,173 @@
+﻿"""
+Readers of the input workbooks.
+
+The extractors only walk the cell values of a sheet row by row, so instead of a DataFrame per sheet
+a reader returns the rows as plain tuples. Every backend returns the same rows, the way pd.read_excel(header=None)
+sees the sheet: empty cells are None, whole numbers are ints, trailing empty rows are dropped
+and every row is padded to the width of the widest one.
+
+    "calamine"  the python-calamine package (Rust parser), by far the fastest, optional
+    "openpyxl"  openpyxl in read_only mode, values only
+    "pandas"    pd.read_excel, the reference the other two are checked against
+
+config.excel_reader picks the backend, calamine falls back to openpyxl when it is not installed.
+"""
+from typing import List, Optional
+import os
+import warnings
+import config
+import log
+
+BACKENDS = ("calamine", "openpyxl", "pandas")
+
+# strings pd.read_excel reads as NaN by default
+NA_STRINGS = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+
+
+def clean_value(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return None if value in NA_STRINGS else value
+    if type(value) is float:
+        if value != value:  # NaN
+            return None
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def clean_rows(raw_rows) -> List[tuple]:
+    """Cleans the values and drops the trailing empty rows, then pads every row to the same width."""
+    rows = []
+    last_row_with_data = -1
+    for raw_row in raw_rows:
+        row = [clean_value(value) for value in raw_row]
+        while row and row[-1] is None:
+            row.pop()
+        if row:
+            last_row_with_data = len(rows)
+        rows.append(row)
+    del rows[last_row_with_data + 1:]
+    width = max((len(row) for row in rows), default=0)
+    return [tuple(row) + (None,) * (width - len(row)) for row in rows]
+
+
+class ExcelReader:
+    """An opened workbook, rows(sheet_name) gives the cell values of a sheet."""
+    backend = ""
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def sheet_names(self) -> List[str]:
+        raise NotImplementedError
+
+    def rows(self, sheet_name: str) -> List[tuple]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class PandasReader(ExcelReader):
+    backend = "pandas"
+
+    def __init__(self, path):
+        import pandas as pd
+        super().__init__(path)
+        self._pd = pd
+        self.xls = pd.ExcelFile(path)
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return self.xls.sheet_names
+
+    def rows(self, sheet_name: str) -> List[tuple]:
+        df = self._pd.read_excel(self.xls, sheet_name=sheet_name, header=None)
+        return clean_rows(df.itertuples(index=False, name=None))
+
+    def close(self):
+        self.xls.close()
+
+
+class OpenpyxlReader(ExcelReader):
+    backend = "openpyxl"
+
+    def __init__(self, path):
+        import openpyxl
+        super().__init__(path)
+        with warnings.catch_warnings():
+            # some exported topic files have no default style, only the values are read anyway
+            warnings.simplefilter("ignore", UserWarning)
+            self.workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return self.workbook.sheetnames
+
+    def rows(self, sheet_name: str) -> List[tuple]:
+        sheet = self.workbook[sheet_name]
+        sheet.reset_dimensions()  # the stored dimensions can't be trusted, read up to the last cell
+        return clean_rows(sheet.iter_rows(values_only=True))
+
+    def close(self):
+        self.workbook.close()
+
+
+class CalamineReader(ExcelReader):
+    backend = "calamine"
+
+    def __init__(self, path):
+        from python_calamine import CalamineWorkbook
+        super().__init__(path)
+        self.workbook = CalamineWorkbook.from_path(str(path))
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return self.workbook.sheet_names
+
+    def rows(self, sheet_name: str) -> List[tuple]:
+        return clean_rows(self.workbook.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False))
+
+    def close(self):
+        self.workbook.close()
+
+
+READERS = {reader.backend: reader for reader in (CalamineReader, OpenpyxlReader, PandasReader)}
+_available = {}
+
+
+def available(backend: str) -> bool:
+    if backend not in _available:
+        try:
+            if backend == "calamine":
+                import python_calamine  # noqa: F401
+            _available[backend] = True
+        except ImportError:
+            _available[backend] = False
+            log.info("# The '{}' Excel reader is not installed, using openpyxl instead.", backend)
+    return _available[backend]
+
+
+def open_workbook(path, backend: Optional[str] = None) -> ExcelReader:
+    """Opens the workbook with the backend (config.excel_reader by default), raises FileNotFoundError like pandas."""
+    backend = backend or config.excel_reader
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No such file: '{path}'")
+    if backend not in READERS:
+        raise ValueError(f"Unknown Excel reader '{backend}', use one of {BACKENDS}")
+    if not available(backend):
+        backend = "openpyxl"
+    return READERS[backend](path)
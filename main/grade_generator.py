@@ -1,11 +1,31 @@
 ﻿import numpy as np
-import random
 import config
+import instrument
 from classes import Subject
 
 
-def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: int, is_beginner_class: bool):
-    # --- Create local copies of settings to modify them based on rules ---
+def build_daily_grade_tables():
+    """
+    Precomputes the cumulative distribution of daily grades for every primary grade 0-5,
+    so a whole class can be drawn with one lookup instead of rebuilding the split per student.
+    """
+    values = sorted({grade for split in config.DAILY_GRADE_SPLITS.values() for grade in split}
+                    | set(config.DEFAULT_DAILY_GRADE_SPLIT))
+    max_primary = max(config.grade_bands)
+    cdfs = np.zeros((max_primary + 1, len(values)))
+    for primary_grade in range(max_primary + 1):
+        split = config.DAILY_GRADE_SPLITS.get(primary_grade, config.DEFAULT_DAILY_GRADE_SPLIT)
+        weights = np.array([split.get(value, 0.0) for value in values])
+        cdfs[primary_grade] = np.cumsum(weights) / weights.sum()
+    cdfs[:, -1] = 1.0
+    return np.array(values), cdfs
+
+
+DAILY_GRADE_VALUES, DAILY_GRADE_CDFS = build_daily_grade_tables()
+
+
+def get_local_settings(subject: Subject, is_beginner_class: bool):
+    """Returns the number of midterms, the weights and the max scores used for this subject."""
     local_num_midterms = config.num_midterms
     local_weights = config.weights.copy()
     local_max_scores = config.max_scores_low.copy() if is_beginner_class else config.max_scores.copy()
@@ -18,6 +38,15 @@ def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: i
         local_weights['sop'] = 100
     elif subject.hours() == 2:
         local_num_midterms = 2  # 2 midterms
+    return local_num_midterms, local_weights, local_max_scores
+
+
+@instrument.timed("generate_plausible_grades")
+def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: int, is_beginner_class: bool,
+                              rng: np.random.Generator = None):
+    rng = np.random.default_rng() if rng is None else rng
+    # --- Create local copies of settings to modify them based on rules ---
+    local_num_midterms, local_weights, local_max_scores = get_local_settings(subject, is_beginner_class)
 
     midterm_max_scores = local_max_scores[:local_num_midterms]
     so4_max_score = local_max_scores[-1]
@@ -30,11 +59,11 @@ def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: i
     mean_pct += config.total_percent_mean_offset
     std_dev_pct = config.total_percent_sd
 
-    total_percent = np.random.normal(loc=mean_pct, scale=std_dev_pct)
+    total_percent = rng.normal(loc=mean_pct, scale=std_dev_pct)
     total_percent = np.clip(total_percent, min_pct, max_pct)
 
     # Initialize penalty/bonus
-    penalty_bonus = np.random.uniform(config.penalty_bonus_range[0], config.penalty_bonus_range[1])
+    penalty_bonus = rng.uniform(config.penalty_bonus_range[0], config.penalty_bonus_range[1])
 
     if local_weights.get('so4', 0) == 0:
         # --- CASE: No  so4 exam---
@@ -52,7 +81,7 @@ def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: i
         mean_split += config.split_mean_offset
         std_dev_split = config.split_sd
 
-        so4_percent_contribution = np.random.normal(loc=mean_split, scale=std_dev_split)
+        so4_percent_contribution = rng.normal(loc=mean_split, scale=std_dev_split)
         so4_percent_contribution = np.clip(so4_percent_contribution, min_so4_contrib, max_so4_contrib)
         sop_percent_contribution = total_percent - so4_percent_contribution
 
@@ -77,14 +106,7 @@ def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: i
     if local_weights['sop'] > 0 and total_max_midterm_score > 0:
         target_sum = int(round((raw_sop_contribution / local_weights['sop']) * total_max_midterm_score))
 
-    midterm_scores = [0] * local_num_midterms
-    if target_sum > 0:
-        for _ in range(target_sum):
-            available_indices = [i for i, score in enumerate(midterm_scores) if score < midterm_max_scores[i]]
-            if not available_indices:
-                break
-            chosen_index = random.choice(available_indices)
-            midterm_scores[chosen_index] += 1
+    midterm_scores = sample_midterm_scores(np.array([target_sum]), midterm_max_scores, rng)[0].tolist()
 
     # --- Format numbers for the return dictionary ---
     final_sop_percent = round(adjusted_sop_contribution, 1)
@@ -105,3 +127,166 @@ def generate_plausible_grades(final_grade_mark, subject: Subject, quarter_num: i
         "Actual СОч %": final_so4_percent,
         "Penalty/Bonus Applied": penalty_bonus,
     }
+
+
+@instrument.timed("generate_plausible_grades")
+def generate_plausible_grades_batch(final_grade_marks, subject: Subject, quarter_num: int, is_beginner_class: bool,
+                                    rng: np.random.Generator = None):
+    """
+    Vectorized version of generate_plausible_grades for a whole class (or parallel) at once.
+
+    Args:
+        final_grade_marks: The quarter marks (2-5) of every student.
+        rng: The generator to draw from, the sheet's own stream (random_streams.sheet_generator) in a run.
+
+    Returns:
+        A dictionary with the same keys as generate_plausible_grades, where every value is a NumPy array
+        with one entry per student ("СОр Scores (Midterms)" is a students x midterms matrix).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    marks = np.asarray(final_grade_marks, dtype=np.int64).reshape(-1)
+    num_students = len(marks)
+
+    local_num_midterms, local_weights, local_max_scores = get_local_settings(subject, is_beginner_class)
+    midterm_max_scores = local_max_scores[:local_num_midterms]
+    so4_max_score = local_max_scores[-1]
+    total_max_midterm_score = sum(midterm_max_scores)
+
+    # --- 1. Generate Total Percentage ---
+    bands = np.array([config.grade_bands[mark] for mark in marks.tolist()], dtype=float).reshape(num_students, 2)
+    min_pct, max_pct = bands[:, 0], bands[:, 1]
+    mean_pct = (min_pct + max_pct) / 2 + config.total_percent_mean_offset
+
+    total_percent = rng.normal(loc=mean_pct, scale=config.total_percent_sd)
+    total_percent = np.clip(total_percent, min_pct, max_pct)
+
+    penalty_bonus = rng.uniform(config.penalty_bonus_range[0], config.penalty_bonus_range[1], size=num_students)
+
+    if local_weights.get('so4', 0) == 0:
+        # --- CASE: No  so4 exam---
+        adjusted_sop_contribution = np.clip(total_percent, 0, local_weights['sop'])
+        so4_score_rounded = np.full(num_students, '-', dtype=object)
+        final_so4_percent = np.full(num_students, '-', dtype=object)
+    else:
+        min_so4_contrib = np.maximum(0, total_percent - local_weights['sop'])
+        max_so4_contrib = np.minimum(local_weights['so4'], total_percent)
+        mean_split = (min_so4_contrib + max_so4_contrib) / 2 + config.split_mean_offset
+
+        so4_percent_contribution = rng.normal(loc=mean_split, scale=config.split_sd)
+        so4_percent_contribution = np.clip(so4_percent_contribution, min_so4_contrib, max_so4_contrib)
+        sop_percent_contribution = total_percent - so4_percent_contribution
+
+        so4_score_float = (so4_percent_contribution / local_weights['so4']) * so4_max_score
+        so4_score_rounded = np.clip(np.rint(so4_score_float), 0, so4_max_score).astype(np.int64)
+        actual_so4_contribution = (so4_score_rounded / so4_max_score) * local_weights['so4']
+
+        rounding_diff = so4_percent_contribution - actual_so4_contribution
+        adjusted_sop_contribution = np.clip(sop_percent_contribution + rounding_diff, 0, local_weights['sop'])
+        final_so4_percent = np.round(actual_so4_contribution, 1)
+
+    raw_sop_contribution = np.clip(adjusted_sop_contribution - penalty_bonus, 0, local_weights['sop'])
+
+    # --- Generate Midterm (СОр) Scores ---
+    target_sums = np.zeros(num_students, dtype=np.int64)
+    if local_weights['sop'] > 0 and total_max_midterm_score > 0:
+        target_sums = np.rint((raw_sop_contribution / local_weights['sop']) * total_max_midterm_score).astype(np.int64)
+    midterm_scores = sample_midterm_scores(target_sums, midterm_max_scores, rng)
+
+    input_grades = marks.astype(object)
+    if subject.hours() == 1 and quarter_num in [1, 3]:
+        input_grades = np.full(num_students, '', dtype=object)
+
+    return {
+        "Input Grade": input_grades,
+        "Generated Total %": np.round(total_percent, 1),
+        "СОч Score (Final)": so4_score_rounded,
+        "СОр Scores (Midterms)": midterm_scores,
+        "Adjusted СОр %": np.round(adjusted_sop_contribution, 1),
+        "Actual СОч %": final_so4_percent,
+        "Penalty/Bonus Applied": penalty_bonus,
+    }
+
+
+def sample_midterm_scores(target_sums, midterm_max_scores, rng: np.random.Generator = None,
+                          draws_per_round: int = 64) -> np.ndarray:
+    """
+    Spreads every target sum over the midterms point by point, each point going to a uniformly chosen
+    midterm that is not full yet.
+
+    Choosing among the midterms that are not full is the same as drawing a midterm uniformly
+    and throwing the draw away when it is full, so the points are drawn for all students at once
+    in rounds of draws_per_round and the capped running counts are cut where they reach the target.
+
+    Returns:
+        An integer matrix of shape (students, midterms).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    max_scores = np.asarray(midterm_max_scores, dtype=np.int64)
+    targets = np.minimum(np.asarray(target_sums, dtype=np.int64).reshape(-1), max_scores.sum())
+    scores = np.zeros((len(targets), len(max_scores)), dtype=np.int64)
+    if len(max_scores) == 0:
+        return scores
+
+    pending = np.flatnonzero(targets > 0)
+    while len(pending) > 0:
+        draws = rng.integers(0, len(max_scores), size=(len(pending), draws_per_round))
+        one_hot = draws[:, :, None] == np.arange(len(max_scores))
+        running = np.minimum(scores[pending, None, :] + np.cumsum(one_hot, axis=1), max_scores)
+        reached = running.sum(axis=2) >= targets[pending, None]
+
+        done = reached[:, -1]
+        stop_at = np.where(done, reached.argmax(axis=1), draws_per_round - 1)
+        scores[pending] = running[np.arange(len(pending)), stop_at]
+        pending = pending[~done]
+
+    return scores
+
+
+def get_primary_daily_grades(bonuses, quarter_grades) -> np.ndarray:
+    """Vectorized config.get_primary_daily_grade."""
+    bonuses = np.asarray(bonuses, dtype=float)
+    quarter_grades = np.asarray(quarter_grades, dtype=np.int64)
+    primary_grades = np.full(len(bonuses), 4, dtype=np.int64)  # Default grade
+    matched = np.zeros(len(bonuses), dtype=bool)
+    for grade, (min_bonus, max_bonus) in config.DAILY_GRADE_BANDS.items():
+        in_band = ~matched & (min_bonus <= bonuses) & (bonuses < max_bonus)
+        primary_grades[in_band] = np.minimum(grade, quarter_grades[in_band])
+        matched |= in_band
+    return primary_grades
+
+
+@instrument.timed("generate_daily_grades")
+def generate_daily_grades(bonuses, quarter_grades, num_columns: int, grades_per_student: int,
+                          rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Generates the daily grades of a whole class in one pass.
+
+    Args:
+        bonuses: The penalty/bonus of every student, it picks the primary daily grade.
+        quarter_grades: The quarter grade of every student, the primary daily grade never exceeds it.
+        num_columns: The number of lesson columns that can hold a daily grade.
+        grades_per_student: How many of those columns get a grade in every row.
+        rng: The generator to draw from, the sheet's own stream (random_streams.sheet_generator) in a run.
+
+    Returns:
+        An integer matrix of shape (students, num_columns), 0 where no grade is placed.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    num_students = len(bonuses)
+    grades_per_student = min(grades_per_student, num_columns)
+    daily_grades = np.zeros((num_students, num_columns), dtype=np.int64)
+    if num_students == 0 or grades_per_student <= 0:
+        return daily_grades
+
+    # --- Pick the columns: every row gets grades_per_student distinct random columns ---
+    column_order = np.argsort(rng.random((num_students, num_columns)), axis=1)
+    filled = np.zeros((num_students, num_columns), dtype=bool)
+    np.put_along_axis(filled, column_order[:, :grades_per_student], True, axis=1)
+
+    # --- Draw a grade for every cell from the CDF of the student's primary grade ---
+    primary_grades = np.clip(get_primary_daily_grades(bonuses, quarter_grades), 0, len(DAILY_GRADE_CDFS) - 1)
+    cdfs = DAILY_GRADE_CDFS[primary_grades]
+    draws = rng.random((num_students, num_columns))
+    value_indices = (draws[:, :, None] >= cdfs[:, None, :]).sum(axis=2)
+    daily_grades[filled] = DAILY_GRADE_VALUES[np.minimum(value_indices, len(DAILY_GRADE_VALUES) - 1)][filled]
+    return daily_grades
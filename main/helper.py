@@ -1,17 +1,16 @@
 ﻿import pandas as pd
+import numpy as np
 from classes import Subject, Class
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Collection
 import config
 import openpyxl
 import main
+import calendar_index
+import log
 from os import path
+import re
 
-
-def split_string_by_pattern(data_string: str, grades_per_student=7) -> list[list[int]]:
-    result_lists = [[] for _ in range(grades_per_student)]
-    for index, char in enumerate(data_string):
-        result_lists[index % grades_per_student].append(int(char))
-    return result_lists
+NO_DATES = np.array([], dtype="datetime64[D]")
 
 
 def clean_grade(grade):
@@ -34,72 +33,48 @@ def clean_grade(grade):
         return '0'
 
 
+def clean_grades(values) -> np.ndarray:
+    """
+    clean_grade for a whole block of cells at once, as int8 grade codes of the same shape.
+    A sheet only holds a handful of distinct values, each of them goes through clean_grade once
+    and the codes are spread over the block by index. Anything but a single digit becomes 0.
+    """
+    values = np.asarray(values, dtype=object)
+    value_codes, distinct_values = pd.factorize(values.ravel(), use_na_sentinel=False)
+    codes = np.array([int(clean_grade(value)) for value in distinct_values], dtype=np.int64)
+    codes[(codes < 0) | (codes > 9)] = 0
+    return codes[value_codes].astype(np.int8).reshape(values.shape)
+
+
 def get_dod_days(
         subject: Subject,
-        all_days_in_quarters: Dict[int, List[str]] = config.all_days_in_each_quarter,
+        all_days_in_quarters: calendar_index.SchoolDays = config.all_days_in_each_quarter,
         skip_week=False
-) -> List[str]:
+) -> np.ndarray:
+    """The datetime64[D] lesson dates of the subject in the whole year, once per lesson hour."""
     if len(all_days_in_quarters) == 0:
-        print("all_days_in_quarters empty")
-        return []
-
-    skip = skip_week
-    days: List[str] = []
-    # print(f"getting days for {subject.name}")
-    for q in range(1, 5):
-        for idx, date in enumerate(all_days_in_quarters[q]):
-            if date == "nan":
-                continue
-
-            day = idx % 5
-            hours_that_day = subject.hours_in_days[day]
-
-            if hours_that_day == 0:
-                continue
-
-            if skip_week and skip:
-                skip = not skip
-                continue
+        log.warning("all_days_in_quarters empty")
+        return NO_DATES
 
-            for i in range(hours_that_day):
-                days.append(date)
-
-            if skip_week:
-                skip = not skip
-
-    print(f"     -> subject {subject} has {len(days)} days total, skip_week = {skip_week}")
+    days = calendar_index.get_calendar_index(all_days_in_quarters).lessons(subject.hours_in_days).dod[skip_week]
+    log.debug("     -> subject {} has {} days total, skip_week = {}", subject, len(days), skip_week)
     return days
 
 
 def get_days_this_quarter(
         subject: Subject,
         quarter_num: int,
-        all_days_in_quarters: Dict[int, List[str]] = config.all_days_in_each_quarter
-) -> List[str]:
+        all_days_in_quarters: calendar_index.SchoolDays = config.all_days_in_each_quarter
+) -> np.ndarray:
+    """The datetime64[D] lesson dates of the subject in the quarter, once per lesson hour."""
     if len(all_days_in_quarters) == 0:
-        print("all_days_in_quarters empty")
-        return []
+        log.warning("all_days_in_quarters empty")
+        return NO_DATES
 
     valid_q = [1, 2, 3, 4]
     if quarter_num not in valid_q:
-        return []
-    days_this_quarter: List[str] = []
-    # print(f"getting days for {subject.name} for quarter {quarter_num}")
-    for idx, date in enumerate(all_days_in_quarters[quarter_num]):
-        if date == "nan":
-            continue
-
-        day = idx % 5
-        hours_that_day = subject.hours_in_days[day]
-
-        if hours_that_day == 0:
-            continue
-
-        for i in range(hours_that_day):
-            # print(f"for day {get_day_name_by_index(day_idx=day)} added date {date}")
-            days_this_quarter.append(date)
-
-    return days_this_quarter
+        return NO_DATES
+    return calendar_index.get_calendar_index(all_days_in_quarters).lessons(subject.hours_in_days).quarters[quarter_num]
 
 
 def split_by_proportion(list_to_split: List[Any],
@@ -109,7 +84,7 @@ def split_by_proportion(list_to_split: List[Any],
     total_new_size = len(list_to_split)
 
     if total_original_size == 0:
-        print("Error: Original part sizes cannot sum to zero.")
+        log.error("Error: Original part sizes cannot sum to zero.")
         return []
 
     # 2. Calculate the proportions of the original parts
@@ -162,20 +137,15 @@ def split_by_proportion(list_to_split: List[Any],
 def get_quarter_start_index(
         subject: Subject,
         quarter_num: int,
-        all_days_in_quarters: Dict[int, List[str]] = config.all_days_in_each_quarter
+        all_days_in_quarters: calendar_index.SchoolDays = config.all_days_in_each_quarter
 ) -> int:
     if quarter_num == 5:
-        return len(subject.topics)
+        return len(subject.plan)
 
-    total = 0
-    for q in range(1, 5):
-        total += len(get_days_this_quarter(subject, q, all_days_in_quarters))
-    sizes: List[int] = []
-    for q in range(1, 5):
-        days_num = len(get_days_this_quarter(subject, q, all_days_in_quarters))
-        sizes.append(days_num)
+    counts = calendar_index.get_calendar_index(all_days_in_quarters).lessons(subject.hours_in_days).counts
+    sizes: List[int] = [counts[q] for q in range(1, 5)]
 
-    topics_split = split_by_proportion(subject.topics, sizes)
+    topics_split = split_by_proportion(range(len(subject.plan)), sizes)  # the lesson numbers, nothing expanded
     # print(f"len(topics_split) = {len(topics_split)}")
     index = 0
     for q in range(quarter_num-1):
@@ -185,6 +155,16 @@ def get_quarter_start_index(
     return index
 
 
+def get_parallel(class_name: str) -> int:
+    match = re.match(r'^\d+', class_name)
+    return int(match.group(0)) if match else 0
+
+
+def is_target(class_name: str, targets: Collection[str] = ()) -> bool:
+    """Whether the class is one of the targets, given as class names ("3D") or parallels ("3"). No targets is every class."""
+    return not targets or class_name in targets or str(get_parallel(class_name)) in targets
+
+
 def get_day_name_by_index(day_idx: int):
     if day_idx == 0:
         return "Monday"
@@ -202,33 +182,6 @@ def get_day_name_by_index(day_idx: int):
         return "Sunday"
 
 
-def get_month_from_date(date: str):
-    month = date[3:5]
-    if month == "9":
-        return "Сентябрь"
-    if month == "09":
-        return "Сентябрь"
-    if month == "10":
-        return "Октябрь"
-    if month == "11":
-        return "Ноябрь"
-    if month == "12":
-        return "Декабрь"
-    if month == "01":
-        return "Январь"
-    if month == "02":
-        return "Февраль"
-    if month == "03":
-        return "Март"
-    if month == "04":
-        return "Апрель"
-    if month == "05":
-        return "Май"
-    if month == "06":
-        return "Июнь"
-    return month
-
-
 def get_repeat_str(subject_name: str, is_kaz: bool) -> str:
     repeat_str = config.kaz_repeat_str if is_kaz else config.rus_repeat_str
     if subject_name in config.eng_exception_subject_name:
@@ -250,10 +203,8 @@ def test_subject(current_class: Class,
                  ):
     current_subject = current_class.subjects[subject_name]
 
-    split = 7 if (class_number >= 5 and current_subject.has_exam) else 5
-    split_grades: list[list[int]] = split_string_by_pattern(current_subject.grades, split)
     for q in quarters_to_test:
-        main.quarter(workbook, current_class, q, current_subject, split_grades, is_dod=is_dod, skip_topics_hw=skip_topics)
+        main.quarter(workbook, current_class, q, current_subject, current_subject.grades, is_dod=is_dod, skip_topics_hw=skip_topics)
         if is_dod:
             break
 
@@ -277,7 +228,7 @@ def full_test():
         return
 
     for class_str in classes_to_test:
-        all_classes: Dict[str, Class] = main.extract_all_data(class_str, is_dod=is_dod)
+        all_classes: Dict[str, Class] = main.extract_all_data([class_str], is_dod=is_dod)
         current_class: Class = all_classes[class_str]
         class_number = int(class_str[0])
 
@@ -0,0 +1,218 @@
+﻿"""
+Optional per-stage instrumentation of a run.
+
+Spans record the wall time and calls of a stage (extractors, quarter, the grade generator, extend_day_columns,
+saving), counters record amounts (sheets created, cells written, bytes saved). Both carry the context they ran in:
+parallel, class, subject and quarter. At the end of a run summary() aggregates them per stage and per
+parallel, class and subject, write_trace() exports a Chrome trace that opens in ui.perfetto.dev or chrome://tracing.
+
+Everything is off unless enable() is called, a disabled span or counter costs a single flag check.
+"""
+from typing import Callable, Dict, List, Optional
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+enabled = False
+
+_spans: List[tuple] = []  # (name, start ns, duration ns, pid, context)
+_counters: List[tuple] = []  # (name, value, time ns, pid, context)
+_local = threading.local()  # the context stack of every thread, the stages of a pipelined run overlap in threads
+
+CONTEXT_KEYS = ("parallel", "class", "subject", "quarter")
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+def reset(flag: Optional[bool] = None):
+    """Forgets everything recorded so far, a forked worker starts with a copy of its parent's records."""
+    _spans.clear()
+    _counters.clear()
+    del _context_stack()[1:]
+    if flag is not None:
+        enable(flag)
+
+
+def _context_stack() -> List[dict]:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = [{}]
+    return stack
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name: str, context: dict):
+        self.name = name
+        self.context = context
+        self.start = 0
+
+    def __enter__(self):
+        stack = _context_stack()
+        stack.append({**stack[-1], **self.context})
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter_ns() - self.start
+        context = _context_stack().pop()
+        if threading.current_thread() is not threading.main_thread():
+            context["thread"] = threading.get_native_id()  # its own track in the trace
+        _spans.append((self.name, self.start, duration, os.getpid(), context))
+        return False
+
+
+def span(name: str, **context):
+    """Times the with-block as a stage, the context is inherited by everything recorded inside it."""
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, context)
+
+
+def current_context() -> dict:
+    """The context of the running span, to carry it over to work that is handed to another thread."""
+    return dict(_context_stack()[-1])
+
+
+@contextmanager
+def within(context: dict):
+    """Runs the with-block in the given context without timing it as a stage."""
+    stack = _context_stack()
+    stack.append({**stack[-1], **context})
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def timed(name: str, context: Callable[..., dict] = None):
+    """Decorator version of span(), context(*args, **kwargs) picks the context out of the call's arguments."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Span(name, context(*args, **kwargs) if context else {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name: str, value=1, **context):
+    if not enabled:
+        return
+    _counters.append((name, value, time.perf_counter_ns(), os.getpid(), {**_context_stack()[-1], **context}))
+
+
+def drain() -> dict:
+    """Hands the records over (from a worker process to the parent, see merge) and forgets them here."""
+    recorded = {"spans": list(_spans), "counters": list(_counters)}
+    reset()
+    return recorded
+
+
+def merge(recorded: Optional[dict]):
+    if recorded:
+        _spans.extend(recorded["spans"])
+        _counters.extend(recorded["counters"])
+
+
+def _group_key(context: dict, level: str) -> Optional[str]:
+    if level == "parallel":
+        return context.get("parallel")
+    if level == "class":
+        return context.get("class")
+    if "class" in context and "subject" in context:
+        return f"{context['class']} / {context['subject']}"
+    return None
+
+
+def summary() -> dict:
+    """Inclusive wall time and calls per stage and the counter totals, for the run and per parallel, class and subject."""
+    def empty_group():
+        return {"stages": defaultdict(lambda: {"calls": 0, "seconds": 0.0}), "counters": defaultdict(int)}
+
+    total = empty_group()
+    groups = {level: defaultdict(empty_group) for level in ("parallel", "class", "subject")}
+    for name, start, duration, pid, context in _spans:
+        targets = [total] + [groups[level][key] for level in groups
+                             if (key := _group_key(context, level)) is not None]
+        for target in targets:
+            stage = target["stages"][name]
+            stage["calls"] += 1
+            stage["seconds"] += duration / 1e9
+    for name, value, at, pid, context in _counters:
+        targets = [total] + [groups[level][key] for level in groups
+                             if (key := _group_key(context, level)) is not None]
+        for target in targets:
+            target["counters"][name] += value
+
+    times = [start for _, start, _, _, _ in _spans] + [start + duration for _, start, duration, _, _ in _spans]
+    wall_seconds = (max(times) - min(times)) / 1e9 if times else 0.0
+
+    def plain(group):
+        return {"stages": dict(group["stages"]), "counters": dict(group["counters"])}
+
+    return {
+        "wall_seconds": wall_seconds,
+        "processes": len({pid for _, _, _, pid, _ in _spans}),
+        **plain(total),
+        **{f"by_{level}": {key: plain(group) for key, group in sorted(by_key.items())}
+           for level, by_key in groups.items()},
+    }
+
+
+def trace_events() -> List[dict]:
+    """The spans as complete events and the counters as running totals, in the Chrome trace event format."""
+    starts = [start for _, start, _, _, _ in _spans] + [at for _, _, at, _, _ in _counters]
+    origin = min(starts, default=0)
+    parent_pid = os.getpid()
+    events = []
+    for pid in sorted({pid for _, _, _, pid, _ in _spans} | {pid for _, _, _, pid, _ in _counters}):
+        process_name = "main" if pid == parent_pid else f"worker {pid}"
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": pid, "args": {"name": process_name}})
+    for name, start, duration, pid, context in _spans:
+        events.append({"name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": context.get("thread", pid),
+                       "ts": (start - origin) / 1e3, "dur": duration / 1e3, "args": context})
+    running: Dict[tuple, float] = defaultdict(int)
+    for name, value, at, pid, context in sorted(_counters, key=lambda counter: counter[2]):
+        running[(pid, name)] += value
+        events.append({"name": name, "ph": "C", "pid": pid, "tid": pid,
+                       "ts": (at - origin) / 1e3, "args": {name: running[(pid, name)]}})
+    return events
+
+
+def write_summary(path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary(), f, ensure_ascii=False, indent=1)
+    print(f"Saved the run summary to '{path}'")
+
+
+def write_trace(path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": trace_events(), "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    print(f"Saved the timeline to '{path}', open it in ui.perfetto.dev or chrome://tracing")
+
+
+def print_stages():
+    stages = summary()["stages"]
+    print(f"\n{'stage':<32}{'calls':>8}{'seconds':>12}")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{name:<32}{stage['calls']:>8}{stage['seconds']:>12.2f}")
@@ -0,0 +1,174 @@
+﻿"""
+Leveled, buffered logging of a run.
+
+The pipeline reports through debug(), info(), warning() and error() instead of print(). A message is a
+str.format() template whose arguments are only formatted when the message is actually shown or recorded,
+so the detailed dumps (students, grade lists) cost nothing when they are filtered out. Shown messages are
+collected in a buffer that goes to stdout in large writes (flush() empties it, warnings flush right away).
+
+    set_mode("quiet")      only warnings, errors and the final summary
+    set_mode("normal")     progress messages as well
+    set_mode("verbose")    everything, and every message is also recorded as a JSON line in the event log
+
+Worker processes record into their own buffers and hand the events back like instrument.py does (drain/merge).
+"""
+from typing import List, Optional
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+SUMMARY = 50  # the final summary of a run, shown in every mode
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR", SUMMARY: "SUMMARY"}
+MODES = {"quiet": WARNING, "normal": INFO, "verbose": DEBUG}
+BUFFER_SIZE = 64 * 1024  # characters kept before they are written to stdout
+
+level = INFO
+record_events = False  # keep an event for every message, whatever the level
+
+_buffer: List[str] = []
+_buffered = 0
+_events: List[dict] = []
+_event_file = None
+_flush_lock = threading.Lock()
+
+
+def set_mode(mode: str, event_log_path: Optional[str] = None):
+    """Sets the level shown on the terminal, an event_log_path turns the event log on."""
+    global level
+    if mode not in MODES:
+        raise ValueError(f"Unknown log mode '{mode}', use one of {tuple(MODES)}")
+    level = MODES[mode]
+    if event_log_path:
+        open_event_log(event_log_path)
+
+
+def open_event_log(path: str):
+    global record_events, _event_file
+    close_event_log()
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    _event_file = open(path, "w", encoding="utf-8")
+    record_events = True
+
+
+def close_event_log():
+    global record_events, _event_file
+    flush()
+    if _event_file is not None:
+        _event_file.close()
+        print(f"Saved the event log to '{_event_file.name}'")
+    _event_file = None
+    record_events = False
+
+
+def configure_worker(worker_level: int, worker_record_events: bool):
+    """Takes over the parent's settings in a worker process, the events stay in memory until drain()."""
+    global level, record_events, _event_file, _buffered
+    level = worker_level
+    record_events = worker_record_events
+    _event_file = None
+    _buffer.clear()
+    _buffered = 0
+    _events.clear()
+
+
+def settings() -> tuple:
+    """The arguments of configure_worker() for the workers of this process."""
+    return level, record_events
+
+
+def wanted(message_level: int) -> bool:
+    """Whether a message of this level would be shown or recorded, to skip work that only feeds a message."""
+    return message_level >= level or record_events
+
+
+def log(message_level: int, message: str, *args, **fields):
+    global _buffered
+    shown = message_level >= level
+    if not shown and not record_events:
+        return
+    text = message.format(*args) if args else message
+    if record_events:
+        _events.append({"time": time.time(), "pid": os.getpid(), "level": LEVEL_NAMES[message_level],
+                        "message": text.strip(), **fields})
+    if shown:
+        _buffer.append(text)
+        _buffered += len(text) + 1
+        if _buffered >= BUFFER_SIZE or message_level >= WARNING:
+            flush()
+
+
+def debug(message: str, *args, **fields):
+    log(DEBUG, message, *args, **fields)
+
+
+def info(message: str, *args, **fields):
+    log(INFO, message, *args, **fields)
+
+
+def warning(message: str, *args, **fields):
+    log(WARNING, message, *args, **fields)
+
+
+def error(message: str, *args, **fields):
+    log(ERROR, message, *args, **fields)
+
+
+def summary(message: str, *args, **fields):
+    log(SUMMARY, message, *args, **fields)
+
+
+def write_output(output: str):
+    """Passes on the output of a worker process, its messages were already filtered by the worker's level."""
+    global _buffered
+    if output:
+        _buffer.append(output.rstrip("\n"))
+        _buffered += len(output)
+        if _buffered >= BUFFER_SIZE:
+            flush()
+
+
+def flush():
+    """
+    Writes the buffered messages to the current stdout and the recorded events to the event log.
+    The threads of a pipelined run log concurrently, a message added while flushing waits for the next flush.
+    """
+    global _buffered
+    with _flush_lock:
+        if _buffer:
+            lines = _buffer[:]
+            del _buffer[:len(lines)]
+            _buffered = 0
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+        if _event_file is not None and _events:
+            events = _events[:]
+            del _events[:len(events)]
+            _event_file.writelines(json.dumps(event, ensure_ascii=False, default=str) + "\n" for event in events)
+
+
+def drain() -> List[dict]:
+    """Hands the recorded events over (from a worker process to the parent, see merge) and forgets them here."""
+    flush()
+    events = list(_events)
+    _events.clear()
+    return events
+
+
+def merge(events: List[dict]):
+    if events and record_events:
+        _events.extend(events)
+        if _event_file is not None:
+            flush()
+
+
+atexit.register(flush)
@@ -4,12 +4,14 @@ by reverse-engineering the grading process.
 ### How to Use the Script
 0.  **Install libraries:** If you don't have them, open your terminal or command prompt and run:
     `pip install pandas numpy odfpy openpyxl`
+    (optionally `pip install python-calamine` for reading the input workbooks several times faster)
 1.  **Run the script:** Execute the file from your terminal while inside the folder with these scripts:
      `python main.py`
 2. You can change the input by modifying the `config.py` file.
 """
 
 import pandas as pd
+import numpy as np
 import os
 import config
 import grade_generator as gg
@@ -20,25 +22,110 @@ import class_extractor
 import topic_extractor
 import timetable_extractor
 import re
-from collections import defaultdict
-import random
+from collections import defaultdict, deque
 import helper
+import calendar_index
+import random_streams
 import writer
-from typing import List, Dict
-from classes import Class, Subject
+import cache
+import sheet_fragment
+import stream_writer
+import manifest
+import instrument
+import log
+import memory
+from typing import List, Dict, Collection
+from classes import Class, Subject, YEAR_SLOT, EXAM_SLOT, FINAL_SLOT
+from calendar_index import CompiledCalendar, SchoolDays
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import islice
+from contextlib import redirect_stdout
+import argparse
+import io
+import traceback
+from copy import copy
 
+redo_1hpw = False  # only redo the subjects with 1 hour a week
+WRITER_BACKENDS = ("openpyxl", "stream")
+PIPELINE_DEPTH = 2  # parallels whose inputs are parsed ahead of the one being generated
 
-def extract_all_data(class_str: str = "", is_dod=False):
-    all_classes_dict = timetable_extractor.extract_class_subjects(class_name=class_str, is_dod=is_dod)
-    topic_extractor.extract_all_topics_and_hw(all_classes_dict, class_name=class_str, is_dod=is_dod)
-    class_extractor.extract_grades_and_classes(all_classes_dict, class_name=class_str)
+
+def extract_all_data(targets: Collection[str] = (), is_dod=False):
+    """
+    Extracts the classes with their subjects, topics and grades. Only the target classes are read
+    when targets (class names like "3D" or parallels like "3", see helper.is_target) are given.
+    """
+    all_classes_dict = timetable_extractor.extract_class_subjects(targets=targets, is_dod=is_dod)
+    topic_extractor.extract_all_topics_and_hw(all_classes_dict, targets=targets, is_dod=is_dod)
+    class_extractor.extract_grades_and_classes(all_classes_dict, targets=targets)
+    cache.save()
     return all_classes_dict
 
 
-def main(target_parallels: List[str], is_dod=False, skip_topics_hw=False):
-    all_days_in_year = config.all_days_in_each_quarter
-    # all_days_in_year = timetable_extractor.extract_days()
-    all_classes_dict = extract_all_data(is_dod=is_dod)
+def school_days() -> CompiledCalendar:
+    """
+    The school days of the year from the days file, so a new school year only needs a new days.xlsx.
+    Falls back to config.all_days_in_each_quarter when there is no usable days file.
+    """
+    calendar = timetable_extractor.extract_days()
+    if calendar is None:
+        log.warning("# WARNING: Using the school days of config.all_days_in_each_quarter.")
+        return CompiledCalendar.from_day_strings(config.all_days_in_each_quarter)
+    return calendar
+
+
+def main(
+        target_parallels: List[str],
+        is_dod=False,
+        skip_topics_hw=False,
+        jobs: int = 1,
+        sheet_jobs: int = 1,
+        writer_backend: str = "openpyxl",
+        incremental=True,
+        pipeline=False,
+        low_memory=False
+):
+    """Builds the report of every target parallel (see build_reports) and prints which were saved and which failed."""
+    saved_reports, failed_parallels = build_reports(target_parallels, is_dod, skip_topics_hw, jobs, sheet_jobs,
+                                                    writer_backend, incremental, pipeline, low_memory)
+    log.summary(f"\n{'='*20} SUMMARY {'='*20}")
+    for parallel, filepath in sorted(saved_reports.items(), key=lambda item: int(item[0])):
+        log.summary("  parallel {}: saved '{}'", parallel, filepath, parallel=parallel)
+    for parallel, reason in sorted(failed_parallels.items(), key=lambda item: int(item[0])):
+        log.summary("  parallel {}: FAILED ({})", parallel, reason, parallel=parallel)
+    log.flush()
+    return saved_reports, failed_parallels
+
+
+def build_reports(
+        target_parallels: List[str],
+        is_dod=False,
+        skip_topics_hw=False,
+        jobs: int = 1,
+        sheet_jobs: int = 1,
+        writer_backend: str = "openpyxl",
+        incremental=True,
+        pipeline=False,
+        low_memory=False
+):
+    """
+    Builds the report of every target parallel, returns ({parallel: saved report}, {parallel: why it failed}).
+    writer_backend "openpyxl" fills one workbook per parallel and saves it at the end (existing reports are updated),
+    "stream" writes every finished sheet straight into a new report file, which keeps memory flat.
+    With incremental, an existing report only gets the sheets regenerated whose inputs changed since its manifest.
+    With pipeline (and a single process) the parallels go through pipeline_reports(),
+    with low_memory through low_memory_reports().
+    """
+    if writer_backend not in WRITER_BACKENDS:
+        raise ValueError(f"Unknown writer backend '{writer_backend}', use one of {WRITER_BACKENDS}")
+    all_days_in_year = school_days()
+    if low_memory and jobs <= 1:
+        return low_memory_reports(target_parallels, all_days_in_year, is_dod, skip_topics_hw, sheet_jobs,
+                                  writer_backend, incremental)
+    if pipeline and jobs <= 1:
+        return pipeline_reports(target_parallels, all_days_in_year, is_dod, skip_topics_hw, sheet_jobs,
+                                writer_backend, incremental)
+    all_classes_dict = extract_all_data(target_parallels, is_dod=is_dod)
 
     # --- Group classes by parallel (grade level) ---
     grouped_classes = defaultdict(list)
@@ -52,93 +139,640 @@ def main(target_parallels: List[str], is_dod=False, skip_topics_hw=False):
 
     os.makedirs(config.output_dir, exist_ok=True)
 
-    # --- Loop through each parallel group and create a separate file ---
+    parallels_to_process = []
     for parallel, classes_in_parallel in grouped_classes.items():
         if parallel == "1" and not is_dod:
             continue
         if target_parallels != [] and parallel not in target_parallels:
             continue
-        prefix = "dod "if is_dod else ""
-        output_filename = f"{prefix}journal {parallel}.xlsx"
-        filepath = os.path.join(config.output_dir, output_filename)
-        print(f"\n{'='*20} PROCESSING PARALLEL {parallel} {'='*20}")
+        parallels_to_process.append((parallel, classes_in_parallel))
 
-        workbook = None
-        template_path = config.template_path
+    # --- Create a separate file for each parallel group, in worker processes if asked to ---
+    saved_reports = {}
+    failed_parallels = {}
+    if jobs > 1 and len(parallels_to_process) > 1:
+        log.info("\nProcessing {} parallels with {} worker processes...", len(parallels_to_process), jobs)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=worker_settings()) as pool:
+            futures = {
+                pool.submit(run_in_worker, process_parallel, parallel, classes_in_parallel,
+                            all_days_in_year, is_dod, skip_topics_hw, None, writer_backend, incremental): parallel
+                for parallel, classes_in_parallel in parallels_to_process
+            }
+            for future in as_completed(futures):
+                parallel = futures[future]
+                try:
+                    filepath, output, _, recorded, events = future.result()
+                except Exception as e:
+                    failed_parallels[parallel] = f"{type(e).__name__}: {e}"
+                    log.error("\nParallel {} failed in its worker process: {}", parallel, e, parallel=parallel)
+                    continue
+                log.write_output(output)
+                instrument.merge(recorded)
+                log.merge(events)
+                if filepath is None:
+                    failed_parallels[parallel] = "see the messages above"
+                else:
+                    saved_reports[parallel] = filepath
+                log.info("\n--> Parallel {} finished ({}/{} done)",
+                         parallel, len(saved_reports) + len(failed_parallels), len(futures))
+    else:
+        # the parallels go one after another, but their sheets can still be rendered by a pool of workers
+        sheet_pool = sheet_worker_pool(sheet_jobs)
         try:
-            if os.path.exists(filepath):
-                workbook = openpyxl.load_workbook(filepath)
-                print(f"Successfully loaded existing report from '{filepath}'.")
+            for parallel, classes_in_parallel in parallels_to_process:
+                try:
+                    filepath = process_parallel(parallel, classes_in_parallel, all_days_in_year, is_dod,
+                                                skip_topics_hw, sheet_pool, writer_backend, incremental)
+                except Exception as e:
+                    failed_parallels[parallel] = f"{type(e).__name__}: {e}"
+                    log.error("\nAn error occurred while processing parallel {}: {}", parallel, e, parallel=parallel)
+                    continue
+                if filepath is None:
+                    failed_parallels[parallel] = "see the messages above"
+                else:
+                    saved_reports[parallel] = filepath
+        finally:
+            if sheet_pool is not None:
+                sheet_pool.shutdown()
+    return saved_reports, failed_parallels
+
+
+def low_memory_reports(
+        target_parallels: List[str],
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False,
+        sheet_jobs: int = 1,
+        writer_backend: str = "openpyxl",
+        incremental=True
+):
+    """
+    Builds the reports one parallel at a time: only the classes of a parallel are extracted, its report is
+    generated and saved, and everything of it is released before the next parallel is extracted.
+    Returns ({parallel: saved report}, {parallel: why it failed}) like build_reports.
+
+    Under config.memory_limit_mb the run keeps to the ceiling as far as it can, see enforce_memory_limit().
+    """
+    parallels = report_parallels(target_parallels, is_dod)
+    os.makedirs(config.output_dir, exist_ok=True)
+    log.info("\nProcessing {} parallels one at a time, memory limit {}...", len(parallels),
+             f"{config.memory_limit_mb} MB" if config.memory_limit_mb else "none")
+
+    saved_reports = {}
+    failed_parallels = {}
+    sheet_pool = sheet_worker_pool(sheet_jobs)
+    try:
+        for parallel in parallels:
+            try:
+                classes_in_parallel = extract_parallel(parallel, is_dod)
+                if not classes_in_parallel:
+                    log.info("\nParallel {} has no classes, skipped.", parallel)
+                    continue
+                filepath = process_parallel(parallel, classes_in_parallel, all_days_in_year, is_dod,
+                                            skip_topics_hw, sheet_pool, writer_backend, incremental)
+                if filepath is None:
+                    failed_parallels[parallel] = "see the messages above"
+                else:
+                    saved_reports[parallel] = filepath
+            except Exception as e:
+                failed_parallels[parallel] = f"{type(e).__name__}: {e}"
+                log.error("\nAn error occurred while processing parallel {}: {}", parallel, e, parallel=parallel)
+            finally:
+                classes_in_parallel = None
+                writer_backend = enforce_memory_limit(parallel, writer_backend)
+    finally:
+        if sheet_pool is not None:
+            sheet_pool.shutdown()
+    return saved_reports, failed_parallels
+
+
+def enforce_memory_limit(parallel: str, writer_backend: str) -> str:
+    """
+    Releases what the finished parallel left behind and returns the writer backend for the next parallels.
+    When the process is still above config.memory_limit_mb the scratch templates are dropped as well,
+    when the parallel peaked above it the next reports are written with the "stream" backend,
+    which never holds a whole workbook.
+    """
+    in_use = memory.release()
+    peak = memory.peak_mb()
+    log.info("Parallel {} done: {} MB in use, {} MB at the peak.", parallel,
+             "?" if in_use is None else round(in_use), "?" if peak is None else round(peak))
+    limit = config.memory_limit_mb
+    if not limit:
+        return writer_backend
+
+    if in_use is not None and in_use > limit:
+        _scratch_workbooks.clear()
+        in_use = memory.release()
+        if in_use is not None and in_use > limit:
+            log.warning("# WARNING: {:.0f} MB are still in use after parallel {}, above the memory limit of {} MB.",
+                        in_use, parallel, limit, parallel=parallel)
+    if peak is not None and peak > limit and writer_backend != "stream":
+        log.warning("# WARNING: Parallel {} peaked at {:.0f} MB, above the memory limit of {} MB, "
+                    "the next reports are written with the stream writer.", parallel, peak, limit, parallel=parallel)
+        return "stream"
+    return writer_backend
+
+
+def sheet_worker_pool(sheet_jobs: int):
+    """The pool of worker processes that renders the sheets, None to render them in this process."""
+    if sheet_jobs <= 1:
+        return None
+    log.info("\nRendering sheets with {} worker processes...", sheet_jobs)
+    return ProcessPoolExecutor(max_workers=sheet_jobs, initializer=init_worker, initargs=worker_settings())
+
+
+def timetable_parallels(is_dod=False) -> List[str]:
+    """The parallels of the timetable in order, the 1st grade only has DOD journals."""
+    classes = timetable_extractor.extract_class_subjects(is_dod=is_dod)
+    parallels = {str(helper.get_parallel(class_name)) for class_name in classes}
+    parallels.discard("0")
+    if not is_dod:
+        parallels.discard("1")
+    return sorted(parallels, key=int)
+
+
+def report_parallels(target_parallels: List[str], is_dod=False) -> List[str]:
+    """The target parallels, every parallel of the timetable when there are none."""
+    return [parallel for parallel in (target_parallels or timetable_parallels(is_dod)) if is_dod or parallel != "1"]
+
+
+def extract_parallel(parallel: str, is_dod=False) -> List[Class]:
+    """The classes of one parallel with their subjects, topics and grades."""
+    all_classes_dict = extract_all_data([parallel], is_dod=is_dod)
+    return [class_obj for class_name, class_obj in all_classes_dict.items()
+            if class_obj is not None and str(helper.get_parallel(class_name)) == parallel]
+
+
+def pipeline_reports(
+        target_parallels: List[str],
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False,
+        sheet_jobs: int = 1,
+        writer_backend: str = "openpyxl",
+        incremental=True
+):
+    """
+    Builds the reports with the stages of consecutive parallels overlapping. While a parallel is generated,
+    a thread pool parses the inputs of the next PIPELINE_DEPTH parallels and a background thread saves
+    the report of the previous one. Returns ({parallel: saved report}, {parallel: why it failed}) like build_reports.
+
+    Backpressure keeps the memory bounded: a parallel is only extracted when it is at most PIPELINE_DEPTH ahead,
+    and the next parallel is only generated after the save before the current one has finished,
+    so there are never more than two reports in memory.
+    """
+    parallels = report_parallels(target_parallels, is_dod)
+    os.makedirs(config.output_dir, exist_ok=True)
+    log.info("\nPipelining {} parallels, {} extracted ahead...", len(parallels), PIPELINE_DEPTH)
+
+    saved_reports = {}
+    failed_parallels = {}
+
+    def record(parallel: str, filepath):
+        if filepath is None:
+            failed_parallels[parallel] = "see the messages above"
+        else:
+            saved_reports[parallel] = filepath
+
+    sheet_pool = sheet_worker_pool(sheet_jobs)
+    try:
+        with ThreadPoolExecutor(max_workers=PIPELINE_DEPTH, thread_name_prefix="extract") as extract_pool, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix="save") as save_pool:
+            upcoming = iter(parallels)
+            extracting = deque((parallel, extract_pool.submit(extract_parallel, parallel, is_dod))
+                               for parallel in islice(upcoming, PIPELINE_DEPTH))
+            saving = None  # (parallel, future) of the report that is being saved
+            while extracting:
+                parallel, extraction = extracting.popleft()
+                for next_parallel in islice(upcoming, 1):
+                    extracting.append((next_parallel, extract_pool.submit(extract_parallel, next_parallel, is_dod)))
+                try:
+                    classes_in_parallel = extraction.result()
+                    result = None
+                    if classes_in_parallel:
+                        result = process_parallel(parallel, classes_in_parallel, all_days_in_year, is_dod,
+                                                  skip_topics_hw, sheet_pool, writer_backend, incremental, save_pool)
+                    else:
+                        log.info("\nParallel {} has no classes, skipped.", parallel)
+                except Exception as e:
+                    failed_parallels[parallel] = f"{type(e).__name__}: {e}"
+                    log.error("\nAn error occurred while processing parallel {}: {}", parallel, e, parallel=parallel)
+                    continue
+
+                if saving is not None:
+                    record(saving[0], saving[1].result())  # backpressure, one report is saved at a time
+                    saving = None
+                if isinstance(result, Future):
+                    saving = (parallel, result)
+                elif classes_in_parallel:
+                    record(parallel, result)
+            if saving is not None:
+                record(saving[0], saving[1].result())
+    finally:
+        if sheet_pool is not None:
+            sheet_pool.shutdown()
+    return saved_reports, failed_parallels
+
+
+@instrument.timed("parallel", context=lambda parallel, *args, **kwargs: {"parallel": parallel})
+def process_parallel(
+        parallel: str,
+        classes_in_parallel: List[Class],
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False,
+        sheet_pool=None,
+        writer_backend="openpyxl",
+        incremental=True,
+        save_pool=None
+):
+    """
+    Builds and saves the report of one parallel. Returns the path of the saved report, None on failure.
+    With a sheet_pool the sheets are rendered by its workers and merged into the report in order.
+    With a save_pool a finished workbook is saved by it in the background and a future of the path is returned.
+    The manifest of the report is written next to it.
+    """
+    prefix = "dod "if is_dod else ""
+    output_filename = f"{prefix}journal {parallel}.xlsx"
+    filepath = os.path.join(config.output_dir, output_filename)
+    log.info("\n{} PROCESSING PARALLEL {} {}", "=" * 20, parallel, "=" * 20)
+
+    if os.path.exists(filepath):
+        old_manifest = manifest.load(filepath) if incremental else None
+        if old_manifest is not None or writer_backend != "stream":
+            return update_parallel(filepath, classes_in_parallel, all_days_in_year, is_dod, skip_topics_hw,
+                                   sheet_pool, old_manifest, save_pool)
+    if writer_backend == "stream":
+        return stream_parallel(filepath, classes_in_parallel, all_days_in_year, is_dod, skip_topics_hw, sheet_pool)
+
+    workbook = None
+    template_path = config.template_path
+    try:
+        workbook = openpyxl.load_workbook(template_path)
+        log.info("Creating new report for parallel {} from template.", parallel)
+
+    except FileNotFoundError:
+        log.error("Error: Template file not found at '{}'.", template_path)
+        return None
+    except Exception as e:
+        log.error("An error occurred while loading the workbook for parallel {}: {}", parallel, e)
+        return None
+
+    unit_hashes = {}
+    if sheet_pool is None:
+        for current_class in classes_in_parallel:
+            process_class(workbook, current_class, all_days_in_year, is_dod, skip_topics_hw=skip_topics_hw,
+                          unit_hashes=unit_hashes)
+    else:
+        merged = 0
+        units = parallel_units(classes_in_parallel, all_days_in_year, is_dod, skip_topics_hw)
+        for unit, fragment in rendered_fragments(sheet_pool, units):
+            unit_hashes[sheet_title(unit[0], unit[2], unit[1], is_dod)] = manifest.sheet_inputs_hash(*unit)
+            if fragment is not None:
+                sheet_fragment.add_fragment(workbook, fragment)
+                merged += 1
+        log.info("\n  -> Merged {} rendered sheets into the report", merged)
+
+    try:
+        log.info("\nCleaning up final workbook...")
+        workbook.remove(workbook[config.template_sheet_name])
+        workbook.remove(workbook[config.dod_template_sheet_name])
+    except Exception as e:
+        log.error("\nAn error occurred while cleaning up the report '{}': {}", filepath, e)
+        return None
+    return finish_report(workbook, filepath, unit_hashes, "\nSuccessfully saved the complete report to '{}'.", save_pool)
+
+
+def update_parallel(
+        filepath: str,
+        classes_in_parallel: List[Class],
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False,
+        sheet_pool=None,
+        old_manifest=None,
+        save_pool=None
+):
+    """
+    Regenerates the sheets of an existing report whose inputs hash differs from its manifest,
+    every other sheet is left exactly as it is. Returns the path of the report, None on failure.
+    When the sheets of the report stay the same, the changed ones are swapped right inside the xlsx file,
+    otherwise (new or dropped sheets, no manifest) the report is loaded, updated and saved with openpyxl.
+    """
+    old_sheets, old_empty = old_manifest or ({}, {})
+    units = list(parallel_units(classes_in_parallel, all_days_in_year, is_dod, skip_topics_hw))
+    titles = [sheet_title(unit[0], unit[2], unit[1], is_dod) for unit in units]
+    hashes = [manifest.sheet_inputs_hash(*unit) for unit in units]
+    unit_hashes = dict(zip(titles, hashes))
+    changed = [idx for idx, title in enumerate(titles)
+               if hashes[idx] != old_sheets.get(title) and hashes[idx] != old_empty.get(title)]
+    stale = [title for title in old_sheets if title not in unit_hashes]  # classes or subjects that are gone
+    log.info("\n  -> {} of {} sheets have changed inputs, {} old sheets are gone", len(changed), len(units), len(stale))
+    if not changed and not stale:
+        log.info("\nReport '{}' is up to date.", filepath)
+        return filepath
+
+    # sheets the report does not have yet decide whether it can be patched, so they are rendered first
+    fragments = {}
+    if old_sheets:
+        new_units = [idx for idx in changed if titles[idx] not in old_sheets]
+        for idx, (unit, fragment) in zip(new_units, rendered_fragments(sheet_pool, [units[i] for i in new_units])):
+            fragments[idx] = fragment
+
+    patcher = None
+    if old_sheets and not stale and all(fragment is None for fragment in fragments.values()):
+        patcher = stream_writer.ReportSheetPatcher(filepath)
+        if not patcher.can_replace([titles[idx] for idx in changed if idx not in fragments]):
+            log.info("  -> The report can't be patched in place, it will be loaded and saved instead.")
+            patcher = None
+
+    if patcher is not None:
+        gone = []  # had lessons before, not anymore
+        replaced_units = [idx for idx in changed if idx not in fragments]
+        for idx, (unit, fragment) in zip(replaced_units, rendered_fragments(sheet_pool, [units[i] for i in replaced_units])):
+            if fragment is None:
+                gone.append(titles[idx])
             else:
-                workbook = openpyxl.load_workbook(template_path)
-                print(f"Creating new report for parallel {parallel} from template.")
+                patcher.add(fragment)
+        try:
+            if patcher.new_parts:
+                save_report(lambda _: patcher.save(), filepath)
+                log.info("\nSuccessfully replaced {} sheets of '{}'.", patcher.stream.sheet_count, filepath)
+        except Exception as e:
+            log.error("\nAn error occurred while saving the file '{}': {}", filepath, e)
+            return None
+        if not gone:
+            manifest.save(filepath, unit_hashes, old_sheets)
+            return filepath
+        stale = gone
+        changed = []
+
+    try:
+        workbook = openpyxl.load_workbook(filepath)
+        log.info("Successfully loaded existing report from '{}'.", filepath)
+    except Exception as e:
+        log.error("An error occurred while loading the existing report '{}': {}", filepath, e)
+        return None
 
-        except FileNotFoundError:
-            print(f"Error: Template file not found at '{template_path}'.")
+    rendering = rendered_fragments(sheet_pool, [units[idx] for idx in changed if idx not in fragments])
+    for idx in changed:
+        fragment = fragments.pop(idx) if idx in fragments else next(rendering)[1]
+        if fragment is None:
+            if titles[idx] in workbook.sheetnames:
+                workbook.remove(workbook[titles[idx]])
             continue
+        # a new sheet goes right after the sheet before it in the report order
+        index = 0
+        for previous_title in reversed(titles[:idx]):
+            if previous_title in workbook.sheetnames:
+                index = workbook.index(workbook[previous_title]) + 1
+                break
+        sheet_fragment.add_fragment(workbook, fragment, index)
+
+    log.info("\nCleaning up final workbook...")
+    for title in stale + [config.template_sheet_name, config.dod_template_sheet_name]:
+        if title in workbook.sheetnames:
+            workbook.remove(workbook[title])
+    return finish_report(workbook, filepath, unit_hashes, "\nSuccessfully saved the updated report to '{}'.", save_pool)
+
+
+def finish_report(workbook, filepath: str, unit_hashes: Dict[str, str], message: str, save_pool=None):
+    """
+    Saves the finished workbook and then its manifest. Returns the path of the report, None when it could not be saved,
+    with a save_pool the save runs there in the background and a future of that is returned right away.
+    """
+    def finish(context: dict):
+        try:
+            with instrument.within(context):
+                save_report(workbook.save, filepath)
+            log.info(message, filepath)
         except Exception as e:
-            print(f"An error occurred while loading the workbook for parallel {parallel}: {e}")
-            continue
+            log.error("\nAn error occurred while saving the file '{}': {}", filepath, e)
+            return None
+        manifest.save(filepath, unit_hashes, workbook.sheetnames)
+        return filepath
 
-        for current_class in classes_in_parallel:
-            process_class(workbook, current_class, all_days_in_year, is_dod, skip_topics_hw=skip_topics_hw)
+    if save_pool is None:
+        return finish({})
+    return save_pool.submit(finish, instrument.current_context())
+
+
+def save_report(save, filepath: str):
+    """Saves the report with save(filepath) as the "save" stage of the instrumentation."""
+    with instrument.span("save"):
+        save(filepath)
+    instrument.count("bytes saved", os.path.getsize(filepath))
+
+
+def worker_settings() -> tuple:
+    """The init_worker arguments that hand this process's instrumentation, log settings and run seed to its workers."""
+    return (instrument.enabled, *log.settings(), config.random_seed)
 
+
+def init_worker(instrumented=False, log_level=log.INFO, log_events=False, random_seed=config.random_seed):
+    # every sheet draws from its own stream of the run seed (random_streams), not from the global random state
+    config.random_seed = random_seed
+    instrument.reset(instrumented)
+    log.configure_worker(log_level, log_events)
+
+
+def run_in_worker(function, *args):
+    """
+    Runs the function in a worker process and hands its printed output back to the parent.
+    Returns (result, output, failed, recorded, events), the traceback of a failure is part of the output,
+    recorded holds the worker's instrumentation records for instrument.merge() and events its log events for log.merge().
+    """
+    output = io.StringIO()
+    result = None
+    failed = False
+    with redirect_stdout(output):
         try:
-            print("\nCleaning up final workbook...")
-            workbook.remove(workbook[config.template_sheet_name])
-            workbook.remove(workbook[config.dod_template_sheet_name])
+            result = function(*args)
+        except Exception:
+            log.error("{}", traceback.format_exc().rstrip())
+            failed = True
+        finally:
+            log.flush()
+    return result, output.getvalue(), failed, instrument.drain(), log.drain()
+
+
+def stream_parallel(
+        filepath: str,
+        classes_in_parallel: List[Class],
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False,
+        sheet_pool=None
+):
+    """Writes the report with the stream writer, a sheet is written to the file as soon as it is rendered."""
+    if os.path.exists(filepath):
+        log.info("The stream writer always starts from the template, '{}' will be replaced.", filepath)
+    try:
+        stream = stream_writer.StreamReportWriter(config.template_path)
+        log.info("Streaming new report to '{}' with the styles of the template.", filepath)
+    except FileNotFoundError:
+        log.error("Error: Template file not found at '{}'.", config.template_path)
+        return None
+
+    unit_hashes = {}
+    sheet_titles = []
+    units = parallel_units(classes_in_parallel, all_days_in_year, is_dod, skip_topics_hw)
+    for unit, fragment in rendered_fragments(sheet_pool, units):
+        unit_hashes[sheet_title(unit[0], unit[2], unit[1], is_dod)] = manifest.sheet_inputs_hash(*unit)
+        if fragment is not None:
+            stream.add(fragment)
+            sheet_titles.append(fragment.title)
+
+    try:
+        save_report(stream.save, filepath)
+        log.info("\nSuccessfully saved the complete report ({} sheets) to '{}'.", stream.sheet_count, filepath)
+    except Exception as e:
+        log.error("\nAn error occurred while saving the file '{}': {}", filepath, e)
+        return None
+    manifest.save(filepath, unit_hashes, sheet_titles)
+    return filepath
+
+
+def parallel_units(
+        classes_in_parallel: List[Class],
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False
+):
+    """
+    Yields the render_sheet arguments of every class x subject x quarter sheet,
+    in the same order process_class would have created the sheets.
+    """
+    for current_class in classes_in_parallel:
+        # a sheet only needs the details of its class, not the other subjects
+        unit_class = copy(current_class)
+        unit_class.subjects = {}
+        for subject, quarter_num, grades in sheet_units(current_class, is_dod):
+            yield unit_class, quarter_num, subject, grades, all_days_in_year, is_dod, skip_topics_hw
+
+
+def rendered_fragments(sheet_pool, units):
+    """
+    Yields (unit, fragment) for every unit in order, the fragment is None if the unit has no sheet.
+    The sheets are rendered by the workers of the sheet_pool, or right here without one.
+    """
+    submitted = []
+    for unit in units:
+        if sheet_pool is None:
+            yield unit, render_sheet(*unit)
+        else:
+            submitted.append((unit, sheet_pool.submit(run_in_worker, render_sheet, *unit)))
+
+    if submitted:
+        log.info("\n  -> Rendering {} sheets in worker processes", len(submitted))
+    for unit, future in submitted:
+        fragment, output, failed, recorded, events = future.result()
+        log.write_output(output)
+        instrument.merge(recorded)
+        log.merge(events)
+        if failed:
+            raise RuntimeError("a sheet could not be rendered, see the traceback above")
+        yield unit, fragment
 
-            workbook.save(filepath)
-            print(f"\nSuccessfully saved the complete report to '{filepath}'.")
-        except Exception as e:
-            print(f"\nAn error occurred while saving the file '{filepath}': {e}")
+
+_scratch_workbooks: Dict[str, openpyxl.Workbook] = {}  # by the content hash of the template
+
+
+def render_sheet(
+        current_class: Class,
+        quarter_num: int,
+        subject: Subject,
+        grades: np.ndarray,
+        all_days_in_year: SchoolDays,
+        is_dod=False,
+        skip_topics_hw=False
+):
+    """Renders one sheet in this process's own copy of the template and returns it as a fragment (None if skipped)."""
+    template = cache.file_digest(config.template_path)
+    scratch_workbook = _scratch_workbooks.get(template)
+    if scratch_workbook is None:
+        scratch_workbook = openpyxl.load_workbook(config.template_path)
+        _scratch_workbooks[template] = scratch_workbook
+
+    sheet = quarter(scratch_workbook, current_class, quarter_num, subject, grades, all_days_in_year,
+                    is_dod, skip_topics_hw=skip_topics_hw)
+    count_written_cells(sheet, current_class, quarter_num, subject)
+    if sheet is None:
+        return None
+    fragment = sheet_fragment.extract_fragment(sheet)
+    scratch_workbook.remove(sheet)
+    return fragment
 
 
 def process_class(
         workbook,
         current_class: Class,
-        all_days_in_year: Dict[int, List[str]],
+        all_days_in_year: SchoolDays,
         is_dod=False,
-        skip_topics_hw=False
+        skip_topics_hw=False,
+        unit_hashes: Dict[str, str] = None
 ):
+    """Creates every sheet of the class in the workbook, the inputs hash of each goes to unit_hashes if given."""
+    for subject, quarter_num, grades in sheet_units(current_class, is_dod):
+        sheet = quarter(workbook, current_class, quarter_num, subject, grades, all_days_in_year, is_dod, skip_topics_hw=skip_topics_hw)
+        count_written_cells(sheet, current_class, quarter_num, subject)
+        if unit_hashes is not None:
+            unit_hashes[sheet_title(current_class, subject, quarter_num, is_dod)] = manifest.sheet_inputs_hash(
+                current_class, quarter_num, subject, grades, all_days_in_year, is_dod, skip_topics_hw)
+
+
+def sheet_units(current_class: Class, is_dod=False):
+    """Yields (subject, quarter_num, grades) for every sheet of the class, in the order of the report."""
     for subject_name, subject in current_class.subjects.items():
         if subject.hours()>1 and redo_1hpw:
             continue
-        print(f"\n--- Processing Subject: {subject_name} ({subject.hours()}h/w) for class {current_class.name} ---")
-
-        class_number_str = re.match(r'^\d+', current_class.name).group(0)
-        class_number = int(class_number_str)
-
-        split = 7 if (class_number >= 5 and subject.has_exam) else 5
-        split_grades: list[list[int]] = helper.split_string_by_pattern(subject.grades, split)
+        log.info("\n--- Processing Subject: {} ({}h/w) for class {} ---", subject_name, subject.hours(), current_class.name)
 
         for i in range(4):
             quarter_num = i + 1
-            print(split_grades[i])
-            quarter(workbook, current_class, quarter_num, subject, split_grades, all_days_in_year, is_dod, skip_topics_hw=skip_topics_hw)
+            log.debug("{}", subject.grades[:, i].tolist())
+            yield subject, quarter_num, subject.grades
             if is_dod:
                 break
 
 
+def sheet_title(current_class: Class, subject: Subject, quarter_num: int, is_dod=False) -> str:
+    chrome_length = len(f"{current_class.name} -  - Q{quarter_num}")
+    max_subject_len = 31 - chrome_length
+    short_subject_name = subject.name[:max_subject_len] if len(subject.name) > max_subject_len else subject.name
+    if is_dod:
+        return f"{current_class.name} - {short_subject_name}"
+    return f"{current_class.name} - {short_subject_name} - Q{quarter_num}"
+
+
+def quarter_context(workbook, current_class: Class, quarter_num: int, subject: Subject, *args, **kwargs) -> dict:
+    return {"parallel": str(helper.get_parallel(current_class.name)), "class": current_class.name,
+            "subject": subject.name, "quarter": quarter_num}
+
+
+def count_written_cells(sheet, current_class: Class, quarter_num: int, subject: Subject):
+    if sheet is not None and instrument.enabled:
+        cells = sum(1 for cell in sheet._cells.values() if cell._value is not None)
+        instrument.count("cells written", cells, **quarter_context(None, current_class, quarter_num, subject))
+
+
+@instrument.timed("quarter", context=quarter_context)
 def quarter(
         workbook,
         current_class: Class,
         quarter_num: int,
         subject: Subject,
-        split_grades: list[list[int]],
-        all_days_in_each_quarter: Dict[int, List[str]] = config.all_days_in_each_quarter,
+        grades: np.ndarray,
+        all_days_in_each_quarter: SchoolDays = config.all_days_in_each_quarter,
         is_dod=False,
         skip_topics_hw=False
 ):
-    print(f"\n  -> Generating data for Quarter {quarter_num}'...")
+    log.debug("\n  -> Generating data for Quarter {}'...", quarter_num)
 
-    chrome_length = len(f"{current_class.name} -  - Q{quarter_num}")
-    max_subject_len = 31 - chrome_length
-    short_subject_name = subject.name[:max_subject_len] if len(subject.name) > max_subject_len else subject.name
-    if is_dod:
-        output_sheet_name = f"{current_class.name} - {short_subject_name}"
-    else:
-        output_sheet_name = f"{current_class.name} - {short_subject_name} - Q{quarter_num}"
+    output_sheet_name = sheet_title(current_class, subject, quarter_num, is_dod)
+    # the sheet's own random stream, so it comes out the same however and whenever it is built
+    rng = random_streams.sheet_generator(current_class.name, subject.name, quarter_num, is_dod)
 
     is_art = False
     for art in config.art:
@@ -148,39 +782,27 @@ def quarter(
     is_boys_art = is_art and config.art_boys[current_class.is_kz] in subject.name
     is_girls_art = is_art and config.art_girls[current_class.is_kz] in subject.name
     if is_boys_art and is_girls_art:
-        print(f"Warning art subject {subject} has boys and girls mixed up")
+        log.warning("Warning art subject {} has boys and girls mixed up", subject,
+                    class_name=current_class.name, subject=subject.name)
 
-    is_pass_fail = False
     # Get the original full lists from the class object
     student_list = current_class.students
     gender_list = current_class.genders
 
-    # Prepare new lists to hold the filtered data
-    filtered_students = []
-    filtered_split_grades = [[] for _ in range(len(split_grades))]
-
     # print(f"test:   gender list lenth is {len(gender_list)} and student list length is {len(student_list)}")
     if is_art and (is_boys_art or is_girls_art) and len(gender_list) == len(student_list):
-        print(f"  -> Applying gender filter for '{subject.name}'")
-        for idx, student in enumerate(student_list):
-            is_boy = gender_list[idx]
-
-            if (is_boys_art and not is_boy)\
-                    or (is_girls_art and is_boy):
-                continue
-
-            filtered_students.append(student)
-
-            # We also keep their grades for all quarters/splits
-            for q_idx in range(len(split_grades)):
-                if idx < len(split_grades[q_idx]):  # Safety check
-                    filtered_split_grades[q_idx].append(split_grades[q_idx][idx])
+        log.debug("  -> Applying gender filter for '{}'", subject.name)
+        is_boy = np.array(gender_list, dtype=bool)
+        keep = ~((is_boys_art & ~is_boy) | (is_girls_art & is_boy))
+        filtered_students = [student for student, kept in zip(student_list, keep) if kept]
+        # We also keep their grades for all quarters/splits
+        filtered_grades = grades[:len(student_list)][keep[:len(grades)]]
     else:
         # No filter, just use the original lists
         filtered_students = student_list
-        filtered_split_grades = split_grades
+        filtered_grades = grades
 
-    quarter_grades = filtered_split_grades[4] if is_dod else filtered_split_grades[quarter_num - 1]
+    quarter_grades = filtered_grades[:, YEAR_SLOT if is_dod else quarter_num - 1].tolist()
 
     match = re.match(r'^\d+', current_class.name)
     parallel = 0
@@ -196,80 +818,33 @@ def quarter(
     total_hours_this_quarter = len(quarter_dates)
 
     if is_dod:
-        print(f"  -> dod subject uses yearly grades: {quarter_grades}")
+        log.debug("  -> dod subject uses yearly grades: {}", quarter_grades)
     else:
-        print(f"  -> quarter {quarter_num} has grades: {quarter_grades}")
+        log.debug("  -> quarter {} has grades: {}", quarter_num, quarter_grades)
     if total_hours_this_quarter == 0:
-        print(f"\n     -> Skipping Quarter {quarter_num} (no lessons).\n")
+        log.info("\n     -> Skipping Quarter {} (no lessons).\n", quarter_num)
         return
 
-    results = []
-
     num_midterms_for_df = config.num_midterms
     if subject.hours() == 1:
         num_midterms_for_df = 1
     elif subject.hours() == 2:
         num_midterms_for_df = 2
 
-    for grade in quarter_grades:
-        # if grade in [0]:  # Handle blank no longer needed
-        #     if is_dod:
-        #         blank_data = {
-        #             "Penalty/Bonus Applied": 0
-        #         }
-        #     else:
-        #         blank_data = {
-        #             "Input Grade": "",
-        #             "СОр Scores (Midterms)": [''] * num_midterms_for_df,
-        #             "СОч Score (Final)": '', "Adjusted СОр %": '', "Actual СОч %": '',
-        #             "Generated Total %": '', "Penalty/Bonus Applied": 0
-        #         }
-        #     results.append(blank_data)
-        if grade in [1]:  # Handle pass/fail
-            is_pass_fail = True
-            pass_fail_text = ""
-            if grade == 1:
-                pass_fail_text = "есп" if current_class.is_kz else "зач"
-
-            blank_data = {
-                "Input Grade": pass_fail_text,
-                "СОр Scores (Midterms)": [''] * num_midterms_for_df,
-                "СОч Score (Final)": '', "Adjusted СОр %": '', "Actual СОч %": '',
-                "Generated Total %": '', "Penalty/Bonus Applied": 0
-            }
-            results.append(blank_data)
-        elif grade in config.grade_bands:
-            generated_data = gg.generate_plausible_grades(grade, subject, quarter_num, is_beginner_class)
-            results.append(generated_data)
+    pass_fail_text = "есп" if current_class.is_kz else "зач"
+    row_grades = [grade for grade in quarter_grades if grade in [1] or grade in config.grade_bands]
+    is_pass_fail = 1 in row_grades
 
-    if not results and subject.name not in config.no_grades:
-        print("  -> no results for a subject with grades. abort")
+    if not row_grades and subject.name not in config.no_grades:
+        log.warning("  -> no results for a subject with grades. abort",
+                    class_name=current_class.name, subject=subject.name, quarter=quarter_num)
         return
-    elif not results and subject.name in config.no_grades:
-        print("  -> using no grade template")
-        blank_data = {
-            "Input Grade": '',
-            "СОр Scores (Midterms)": [''] * num_midterms_for_df,
-            "СОч Score (Final)": '', "Adjusted СОр %": '', "Actual СОч %": '',
-            "Generated Total %": '', "Penalty/Bonus Applied": 0
-        }
-        results.append(blank_data)
-    elif not results and subject.name not in config.no_grades:
-        blank_data = {
-            "Penalty/Bonus Applied": 0
-        }
-        results.append(blank_data)
-
-    df = pd.DataFrame(results)
-
-    actual_midterm_cols = [f'СОр {j+1}' for j in range(num_midterms_for_df)]
-    midterm_df = pd.DataFrame(df['СОр Scores (Midterms)'].tolist(), index=df.index)
-    midterm_df.columns = actual_midterm_cols
+    elif not row_grades and subject.name in config.no_grades:
+        log.debug("  -> using no grade template")
+        row_grades = [0]
 
+    df = build_grades_frame(row_grades, subject, quarter_num, is_beginner_class, num_midterms_for_df, pass_fail_text, rng)
     template_midterm_cols = [f'СОр {j+1}' for j in range(config.max_midterms)]
-    midterm_df = midterm_df.reindex(columns=template_midterm_cols)
-
-    df = pd.concat([midterm_df, df.drop(columns=['СОр Scores (Midterms)'])], axis=1)
 
     max_sop_weight = config.weights['sop']
     max_so4_weight = config.weights['so4']
@@ -290,16 +865,17 @@ def quarter(
 
     if output_sheet_name in workbook.sheetnames:
         sheet = workbook[output_sheet_name]
-        print(f"  -> Found existing sheet: '{output_sheet_name}'. Overwriting data.")
+        log.info("  -> Found existing sheet: '{}'. Overwriting data.", output_sheet_name)
     else:
         if template_sheet_name not in workbook.sheetnames:
-            print(f"  -> ERROR: Template sheet '{template_sheet_name}' not found. Skipping.")
+            log.error("  -> ERROR: Template sheet '{}' not found. Skipping.", template_sheet_name)
             return
         template_sheet = workbook[template_sheet_name]
         sheet = workbook.copy_worksheet(template_sheet)
         sheet.title = output_sheet_name
-        print(f"  -> Created sheet '{output_sheet_name}' "
-              f"from template '{template_sheet_name}' for {subject.hours()} hours a week.")
+        instrument.count("sheets created")
+        log.info("  -> Created sheet '{}' from template '{}' for {} hours a week.",
+                 output_sheet_name, template_sheet_name, subject.hours(), sheet=output_sheet_name)
 
     [student_start_row, student_start_col] = config.student_name_cell
     skipped_num = 0
@@ -332,7 +908,7 @@ def quarter(
         for r_idx, row_data in enumerate(rows, config.start_row):
             for c_idx, value in enumerate(row_data, quarter_grade_start_col):
                 sheet.cell(row=r_idx, column=c_idx, value=value if not pd.isna(value) else None)
-        print(f"  -> Wrote main grade data for {len(final_df)} students.")
+        log.debug("  -> Wrote main grade data for {} students.", len(final_df))
 
     overall_grade_col = column_index_from_string(config.dod_grade_col)
     date_col_letter = config.dod_date_col if is_dod else config.date_col
@@ -342,29 +918,26 @@ def quarter(
     daily_grades_start_col = column_index_from_string(config.daily_grade_col)
 
     quarter_topic_start_index = 0 if is_dod \
-        else helper.get_quarter_start_index(subject, quarter_num)
-    quarter_topic_end_index = len(subject.topics) if is_dod \
-        else helper.get_quarter_start_index(subject, quarter_num + 1)
+        else helper.get_quarter_start_index(subject, quarter_num, all_days_in_each_quarter)
+    quarter_topic_end_index = len(subject.plan) if is_dod \
+        else helper.get_quarter_start_index(subject, quarter_num + 1, all_days_in_each_quarter)
     # --- Topic and Homework Distribution Logic ---
     if not skip_topics_hw:
-        print(f"  -> Placing {total_hours_this_quarter} dates, topics and homework")
-        print(f"  -> starting from {quarter_topic_start_index} up to {quarter_topic_end_index}")
+        log.debug("  -> Placing {} dates, topics and homework", total_hours_this_quarter)
+        log.debug("  -> starting from {} up to {}", quarter_topic_start_index, quarter_topic_end_index)
     
-        quarter_topics = subject.topics[quarter_topic_start_index:quarter_topic_end_index]
-        quarter_hw = subject.homework[quarter_topic_start_index:quarter_topic_end_index]
+        # the lessons of the quarter straight from the runs of the plan, filled up to its hours with repeats
+        quarter_lessons = subject.plan.view(quarter_topic_start_index, quarter_topic_end_index,
+                                            pad_to=total_hours_this_quarter,
+                                            filler=helper.get_repeat_str(subject.name, current_class.is_kz))
     
-        repeat_topic_str = helper.get_repeat_str(subject.name, current_class.is_kz)
-        if quarter_topic_end_index - quarter_topic_start_index < total_hours_this_quarter:
-            for idx in range(quarter_topic_end_index - quarter_topic_start_index, total_hours_this_quarter):
-                quarter_topics.append(repeat_topic_str)
+        for idx, label in enumerate(calendar_index.short_date_labels(quarter_dates)):
+            sheet.cell(row=config.start_row + idx, column=dates_start_col, value=label)
     
-        for idx, date in enumerate(quarter_dates):
-            sheet.cell(row=config.start_row + idx, column=dates_start_col, value=date[:5])
-    
-        for idx, topic in enumerate(quarter_topics):
+        for idx, topic in enumerate(quarter_lessons.topics()):
             sheet.cell(row=config.start_row + idx, column=topics_start_col, value=topic)
     
-        for idx, hw in enumerate(quarter_hw):
+        for idx, hw in enumerate(quarter_lessons.homework()):
             sheet.cell(row=config.start_row + idx, column=topics_start_col+1, value=hw)
 
     if is_dod:
@@ -377,69 +950,154 @@ def quarter(
 
     if quarter_num == 4:
         yearly_grade_col = quarter_grade_start_col + config.quarter_to_dates_offset - 3
-        print(f"     -> quarter 4 must have yearly grades")
-        for idx, grade in enumerate(filtered_split_grades[4]):
+        log.debug("     -> quarter 4 must have yearly grades")
+        for idx, grade in enumerate(filtered_grades[:, YEAR_SLOT].tolist()):
             pass_fail_text = str(grade)
             if grade == 1:
                 pass_fail_text = "есп" if current_class.is_kz else "зач"
             sheet.cell(row=config.start_row + idx, column=yearly_grade_col, value=pass_fail_text)
         if subject.has_exam:
-            for idx, grade in enumerate(filtered_split_grades[5]):
+            for idx, grade in enumerate(filtered_grades[:, EXAM_SLOT].tolist()):
                 sheet.cell(row=config.start_row + idx, column=yearly_grade_col+1, value=grade)
-            for idx, grade in enumerate(filtered_split_grades[6]):
+            for idx, grade in enumerate(filtered_grades[:, FINAL_SLOT].tolist()):
                 sheet.cell(row=config.start_row + idx, column=yearly_grade_col+2, value=grade)
 
     # --- Daily Grade Generation Logic ---
     is_last_quarter = quarter_num == 4
     sheet = writer.extend_day_columns(sheet, total_hours_this_quarter, is_last_quarter, subject.has_exam, is_dod)
-    month = ""
-    for idx, date in enumerate(quarter_dates):
-        sheet.cell(row=config.dates_row, column=daily_grades_start_col + idx, value=date[:2])
-        this_month = helper.get_month_from_date(date)
-        if this_month != month:
-            month = this_month
-            sheet.cell(row=config.months_row, column=daily_grades_start_col + idx, value=month)
-    print(f"  -> Extended the table by {total_hours_this_quarter} columns")
+    for idx, label in enumerate(calendar_index.day_labels(quarter_dates)):
+        sheet.cell(row=config.dates_row, column=daily_grades_start_col + idx, value=label)
+    for idx, month in calendar_index.month_headers(quarter_dates):
+        sheet.cell(row=config.months_row, column=daily_grades_start_col + idx, value=month)
+    log.debug("  -> Extended the table by {} columns", total_hours_this_quarter)
 
     if subject.name in config.no_grades:
-        print(f"     -> subject {subject.name} has no grades")
-        return
+        log.debug("     -> subject {} has no grades", subject.name)
+        return sheet
     if is_pass_fail:
-        print(f"     -> subject {subject.name} is pass/fail subject")
-        return
+        log.debug("     -> subject {} is pass/fail subject", subject.name)
+        return sheet
 
     num_grades_to_place = int(total_hours_this_quarter * config.daily_grade_density)
     daily_end_col_idx = quarter_grade_start_col + total_hours_this_quarter - config.daily_grade_offset - 1
     available_cols = list(range(daily_grades_start_col, daily_end_col_idx))
 
-    print("reached daily grade generation")
-    skipped_num = 0
-    for idx, row in df.iterrows():
-        bonus = row['Penalty/Bonus Applied']
+    log.debug("reached daily grade generation")
+    bonuses = df['Penalty/Bonus Applied'].to_numpy(dtype=float)
+    quarter_indices = np.full(len(bonuses), quarter_num - 1)
+    rows_to_fill = np.ones(len(bonuses), dtype=bool)
+    if subject.hours() == 1:
+        is_blank = bonuses == 0
+        if quarter_num == 1 or quarter_num == 3:
+            quarter_indices[is_blank] += 1  # do not skip for blank or pass/fail grades, use next split grades instead
+        else:
+            rows_to_fill = ~is_blank
 
-        quarter_index = quarter_num-1
-        if bonus == 0 and subject.hours() == 1:
-            if quarter_num == 1 or quarter_num == 3:
-                quarter_index += 1  # do not skip for blank or pass/fail grades, use next split grades instead
-            else:
-                # print(f"      skip row {idx}")
-                continue
+    row_indices = np.flatnonzero(rows_to_fill)
+    row_quarter_grades = filtered_grades[row_indices, quarter_indices[row_indices]]
+    daily_grades = gg.generate_daily_grades(
+        bonuses[row_indices], row_quarter_grades, len(available_cols), num_grades_to_place, rng)
+    for idx, row_daily_grades in zip(row_indices, daily_grades):
+        for col_offset in np.flatnonzero(row_daily_grades):
+            sheet.cell(row=student_start_row + int(idx), column=available_cols[col_offset],
+                       value=int(row_daily_grades[col_offset]))
+    return sheet
 
-        # if filtered_split_grades[quarter_index][idx] == 0:
-        #     skipped_num += 1
-            # print(f"skipped index {idx}")
-            # continue
 
-        distribution = config.get_daily_grade_distribution(bonus, filtered_split_grades[quarter_index][idx])
-        grades, weights = zip(*distribution.items())
-        cols_to_fill = random.sample(available_cols, num_grades_to_place)
-        # print(f"fill columns {cols_to_fill} with {num_grades_to_place}")
-        for col in cols_to_fill:
-            generated_grade = random.choices(grades, weights=weights, k=1)[0]
-            sheet.cell(row=student_start_row + idx - skipped_num, column=col, value=generated_grade)
+def build_grades_frame(
+        row_grades: List[int],
+        subject: Subject,
+        quarter_num: int,
+        is_beginner_class: bool,
+        num_midterms_for_df: int,
+        pass_fail_text: str,
+        rng: np.random.Generator = None
+) -> pd.DataFrame:
+    """
+    Builds one row per graded student. The scores of all students with a 2-5 mark are generated
+    in one vectorized batch, pass/fail (and blank) rows only get the mark text.
+    """
+    num_rows = len(row_grades)
+    is_generated = np.array([grade in config.grade_bands for grade in row_grades], dtype=bool)
+
+    columns = {
+        name: np.full(num_rows, '', dtype=object)
+        for name in ["СОч Score (Final)", "Adjusted СОр %", "Actual СОч %", "Generated Total %", "Input Grade"]
+    }
+    columns["Input Grade"][np.array([grade == 1 for grade in row_grades], dtype=bool)] = pass_fail_text
+    midterms = np.full((num_rows, config.max_midterms), np.nan, dtype=object)
+    midterms[:, :num_midterms_for_df] = ''
+    penalty_bonus = np.zeros(num_rows)
+
+    if is_generated.any():
+        marks = np.array(row_grades)[is_generated]
+        generated = gg.generate_plausible_grades_batch(marks, subject, quarter_num, is_beginner_class, rng)
+        for name, values in columns.items():
+            values[is_generated] = generated[name]
+        midterms[is_generated, :num_midterms_for_df] = generated["СОр Scores (Midterms)"]
+        penalty_bonus[is_generated] = generated["Penalty/Bonus Applied"]
+
+    df = pd.DataFrame({f'СОр {j+1}': midterms[:, j] for j in range(config.max_midterms)})
+    for name, values in columns.items():
+        df[name] = values
+    df["Penalty/Bonus Applied"] = penalty_bonus
+    return df
 
 
 if __name__ == "__main__":
-    parallels = ["3", "4", "5", "6", "8", ]
-    redo_1hpw = False
-    main(target_parallels=parallels, is_dod=False, skip_topics_hw=False)
+    parser = argparse.ArgumentParser(description="Fills the journal reports of every parallel.")
+    parser.add_argument("parallels", nargs="*", default=["3", "4", "5", "6", "8", ],
+                        help="parallels to process, e.g. 5 6")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="number of worker processes, each parallel is handled by one worker")
+    parser.add_argument("--sheet-jobs", type=int, default=1,
+                        help="number of worker processes rendering the sheets of each parallel")
+    parser.add_argument("--writer", choices=WRITER_BACKENDS, default="openpyxl",
+                        help="'stream' writes each sheet straight to a new report instead of keeping the workbook in memory")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="regenerate every sheet, even those whose inputs did not change since the last run")
+    parser.add_argument("--trace", action="store_true",
+                        help="time every stage and write run_summary.json and run_trace.json (ui.perfetto.dev) to the output folder")
+    parser.add_argument("--quiet", "-q", action="store_true", help="only show warnings, errors and the final summary")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="show every detail and write each message as a JSON line to run_events.jsonl in the output folder")
+    parser.add_argument("--dod", action="store_true", help="fill the DOD journals")
+    parser.add_argument("--skip-topics", action="store_true", help="do not write dates, topics and homework")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="parse the next parallels and save the previous report while a parallel is generated")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="extract, generate and save one parallel at a time and release it before the next")
+    parser.add_argument("--memory-limit", type=int, default=config.memory_limit_mb, metavar="MB",
+                        help="memory ceiling of a --low-memory run, above it the stream writer takes over")
+    parser.add_argument("--seed", type=int, default=config.random_seed,
+                        help="the run seed, the same seed gives the same grades in every sheet")
+    args = parser.parse_args()
+    if args.jobs > 1 and args.sheet_jobs > 1:
+        parser.error("use either --jobs or --sheet-jobs, not both")
+    if args.jobs > 1 and args.pipeline:
+        parser.error("use either --jobs or --pipeline, not both")
+    if args.memory_limit:
+        args.low_memory = True
+    if args.low_memory and (args.jobs > 1 or args.pipeline):
+        parser.error("--low-memory goes one parallel at a time, it cannot be combined with --jobs or --pipeline")
+    if args.quiet and args.verbose:
+        parser.error("use either --quiet or --verbose, not both")
+
+    instrument.enable(args.trace)
+    config.random_seed = args.seed
+    config.memory_limit_mb = args.memory_limit
+    if args.verbose:
+        log.set_mode("verbose", os.path.join(config.output_dir, "run_events.jsonl"))
+    elif args.quiet:
+        log.set_mode("quiet")
+    try:
+        main(target_parallels=args.parallels, is_dod=args.dod, skip_topics_hw=args.skip_topics,
+             jobs=args.jobs, sheet_jobs=args.sheet_jobs, writer_backend=args.writer, incremental=not args.rebuild,
+             pipeline=args.pipeline, low_memory=args.low_memory)
+    finally:
+        log.close_event_log()
+    if args.trace:
+        instrument.print_stages()
+        os.makedirs(config.output_dir, exist_ok=True)
+        instrument.write_summary(os.path.join(config.output_dir, "run_summary.json"))
+        instrument.write_trace(os.path.join(config.output_dir, "run_trace.json"))
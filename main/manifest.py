@@ -0,0 +1,123 @@
+﻿"""
+Content-hash manifest of a report.
+
+Next to every report a small JSON file records, for each sheet of the report, a hash of everything
+the sheet was generated from: the grades, students, hours pattern, topics and homework, the calendar,
+the config values and the template. A later run compares those hashes with the current inputs
+and only regenerates the sheets whose inputs have changed, every other sheet is left as it is.
+"""
+from typing import Dict, Iterable, Optional, Tuple
+import hashlib
+import inspect
+import json
+import os
+import numpy as np
+import cache
+import calendar_index
+import config
+import log
+from classes import TopicPlan
+
+MANIFEST_VERSION = 2  # bump whenever a change in the generator should regenerate every sheet
+
+
+def manifest_path(report_path: str) -> str:
+    return f"{os.path.splitext(report_path)[0]}.manifest.json"
+
+
+def load(report_path: str) -> Optional[Tuple[Dict[str, str], Dict[str, str]]]:
+    """
+    Returns ({sheet title: inputs hash} in the order of the report, the same for the sheets that had no lessons
+    and were left out of the report), None if there is no usable manifest.
+    """
+    path = manifest_path(report_path)
+    try:
+        with open(path, encoding="utf-8") as f:
+            loaded = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning("# WARNING: Could not read manifest '{}', every sheet will be regenerated. Reason: {}", path, e)
+        return None
+    if not isinstance(loaded, dict) or loaded.get("version") != MANIFEST_VERSION:
+        log.info("# Manifest '{}' is from another version, every sheet will be regenerated.", path)
+        return None
+    return loaded["sheets"], loaded["empty"]
+
+
+def save(report_path: str, hashes: Dict[str, str], sheet_titles: Iterable[str]):
+    """Writes the inputs hash of every sheet, those that are not among the report's sheet_titles go to "empty"."""
+    sheet_titles = set(sheet_titles)
+    sheets = {title: digest for title, digest in hashes.items() if title in sheet_titles}
+    empty = {title: digest for title, digest in hashes.items() if title not in sheet_titles}
+    path = manifest_path(report_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "sheets": sheets, "empty": empty}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("# WARNING: Could not write manifest '{}'. Reason: {}", path, e)
+
+
+def canonical(value):
+    """Turns the value into JSON the same way in every process (sets have no stable order)."""
+    if isinstance(value, dict):
+        return [[canonical(key), canonical(item)] for key, item in value.items()]
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, calendar_index.CompiledCalendar):
+        return canonical(value.day_strings())
+    if isinstance(value, TopicPlan):
+        return canonical([value.topics, value.homework, value.hours])
+    return value
+
+
+# where a run reads and keeps its files, none of them changes what is written into a sheet
+RUN_SETTINGS = {"output_dir", "cache_dir", "cache_filename", "use_cache", "benchmark_dir", "excel_reader",
+                "memory_limit_mb"}
+
+_config_fingerprints: Dict[str, str] = {}
+
+
+def config_fingerprint() -> str:
+    """
+    Hash of every config value and of the template file, computed once per process and template.
+    A batch worker builds the reports of several schools, each school can come with its own template.
+    """
+    template = cache.file_digest(config.template_path)
+    fingerprint = _config_fingerprints.get(template)
+    if fingerprint is None:
+        values = {
+            name: canonical(value) for name, value in sorted(vars(config).items())
+            if not name.startswith("_") and not inspect.ismodule(value) and not callable(value)
+            and name not in RUN_SETTINGS
+        }
+        values["template"] = template
+        fingerprint = hashlib.sha256(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+        _config_fingerprints[template] = fingerprint
+    return fingerprint
+
+
+def sheet_inputs_hash(
+        current_class,
+        quarter_num: int,
+        subject,
+        grades,
+        all_days_in_year: dict,
+        is_dod=False,
+        skip_topics_hw=False
+) -> str:
+    """Hashes everything the sheet of this class, subject and quarter is generated from."""
+    inputs = [
+        MANIFEST_VERSION, config_fingerprint(),
+        current_class.name, current_class.is_kz, current_class.students, current_class.genders,
+        subject.name, subject.teacher, subject.grades, subject.has_exam, subject.hours_in_days,
+        subject.plan, grades,
+        quarter_num, all_days_in_year, is_dod, skip_topics_hw,
+    ]
+    return hashlib.sha256(json.dumps(canonical(inputs), ensure_ascii=False).encode("utf-8")).hexdigest()
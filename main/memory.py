@@ -0,0 +1,38 @@
+﻿"""
+Memory use of the process, for the memory ceiling of a low-memory run (main.low_memory_reports).
+
+Both functions return None where the platform does not tell, the ceiling is then not enforced.
+"""
+from typing import Optional
+import gc
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def rss_mb() -> Optional[float]:
+    """The memory the process holds right now, in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_mb() -> Optional[float]:
+    """The most memory the process has held since it started, in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # bytes on macOS, KB elsewhere
+
+
+def release() -> Optional[float]:
+    """Collects the garbage (workbooks are full of reference cycles), returns the memory still held in MB."""
+    gc.collect()
+    return rss_mb()
@@ -0,0 +1,28 @@
+﻿"""
+Deterministic random streams.
+
+Every sheet draws its grades from its own numpy Generator. The generator is spawned from the run seed
+(config.random_seed) at a spawn key derived from the sheet's stable key (class, subject, quarter, dod),
+so a sheet comes out the same whether it is built serially, in a worker process or on its own
+by an incremental run, no matter which sheets were drawn before it.
+"""
+from typing import Tuple
+import hashlib
+import numpy as np
+import config
+
+
+def spawn_key(*key) -> Tuple[int, ...]:
+    """Four 32-bit words of the sha256 of the key, the same in every process (hash() is salted per process)."""
+    digest = hashlib.sha256("\x1f".join(str(part) for part in key).encode("utf-8")).digest()
+    return tuple(int.from_bytes(digest[i:i + 4], "little") for i in range(0, 16, 4))
+
+
+def generator(*key, seed: int = None) -> np.random.Generator:
+    """The generator of the key, a child of the run seed's SeedSequence."""
+    seed = config.random_seed if seed is None else seed
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=spawn_key(*key))))
+
+
+def sheet_generator(class_name: str, subject_name: str, quarter_num: int, is_dod=False) -> np.random.Generator:
+    return generator("sheet", class_name, subject_name, quarter_num, bool(is_dod))
@@ -0,0 +1,190 @@
+﻿"""
+Portable copies of finished report sheets.
+
+A worker process renders a sheet in its own scratch workbook and turns it into a SheetFragment:
+plain cell values, the actual style objects (not the workbook-specific style ids), merged ranges,
+row/column dimensions and the page setup. Fragments can be pickled back to the parent process,
+where add_fragment() rebuilds the sheet inside the report workbook.
+"""
+from typing import Dict, List, Optional, Tuple
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE, BUILTIN_FORMATS_REVERSE
+from openpyxl.worksheet.dimensions import ColumnDimension, RowDimension
+from openpyxl.worksheet.merge import MergedCellRange
+from openpyxl.worksheet.page import PrintPageSetup
+from copy import copy
+import instrument
+
+NO_STYLE = -1
+
+COLUMN_FIELDS = ("width", "bestFit", "hidden", "outlineLevel", "collapsed", "min", "max")
+ROW_FIELDS = ("ht", "hidden", "outlineLevel", "collapsed", "thickBot", "thickTop")
+
+
+class SheetFragment:
+    def __init__(self, title: str):
+        self.title = title
+        # (row, col, value, data_type, style index, is merged cell)
+        self.cells: List[Tuple[int, int, object, str, int, bool]] = []
+        # (font, fill, border, number format, protection, alignment, pivotButton, quotePrefix, named style)
+        self.styles: List[tuple] = []
+        self.merged_ranges: List[str] = []
+        self.column_dimensions: Dict[str, Tuple[dict, int]] = {}
+        self.row_dimensions: Dict[int, Tuple[dict, int]] = {}
+        self.sheet_format = None
+        self.sheet_properties = None
+        self.page_margins = None
+        self.print_options = None
+        self.page_setup: dict = {}
+
+    def __repr__(self):
+        return f"fragment '{self.title}' with {len(self.cells)} cells and {len(self.styles)} styles"
+
+
+@instrument.timed("extract fragment")
+def extract_fragment(sheet) -> SheetFragment:
+    """Copies everything copy_worksheet would copy out of the sheet, independent of its workbook."""
+    workbook = sheet.parent
+    fragment = SheetFragment(sheet.title)
+    style_indices: Dict[tuple, int] = {}
+
+    def style_index(style_array) -> int:
+        if style_array is None:
+            return NO_STYLE
+        key = tuple(style_array)
+        idx = style_indices.get(key)
+        if idx is None:
+            idx = len(fragment.styles)
+            style_indices[key] = idx
+            fragment.styles.append(read_style(workbook, style_array))
+        return idx
+
+    for (row, col), cell in sheet._cells.items():
+        style_array = cell._style if cell.has_style else None
+        fragment.cells.append((row, col, cell._value, cell.data_type, style_index(style_array),
+                               isinstance(cell, MergedCell)))
+
+    fragment.merged_ranges = [merged_range.coord for merged_range in sheet.merged_cells.ranges]
+
+    for key, dim in sheet.column_dimensions.items():
+        attributes = {field: getattr(dim, field) for field in COLUMN_FIELDS}
+        fragment.column_dimensions[key] = attributes, style_index(dim._style if dim.has_style else None)
+    for key, dim in sheet.row_dimensions.items():
+        attributes = {field: getattr(dim, field) for field in ROW_FIELDS}
+        fragment.row_dimensions[key] = attributes, style_index(dim._style if dim.has_style else None)
+
+    fragment.sheet_format = copy(sheet.sheet_format)
+    fragment.sheet_properties = copy(sheet.sheet_properties)
+    fragment.page_margins = copy(sheet.page_margins)
+    fragment.print_options = copy(sheet.print_options)
+    fragment.page_setup = {key: value for key, value in vars(sheet.page_setup).items() if not key.startswith("_")}
+    return fragment
+
+
+def read_style(workbook, style_array) -> tuple:
+    if style_array.numFmtId < BUILTIN_FORMATS_MAX_SIZE:
+        number_format = BUILTIN_FORMATS.get(style_array.numFmtId, "General")
+    else:
+        number_format = workbook._number_formats[style_array.numFmtId - BUILTIN_FORMATS_MAX_SIZE]
+    named_style = workbook._named_styles[style_array.xfId].name \
+        if style_array.xfId < len(workbook._named_styles) else None
+    return (
+        workbook._fonts[style_array.fontId],
+        workbook._fills[style_array.fillId],
+        workbook._borders[style_array.borderId],
+        number_format,
+        workbook._protections[style_array.protectionId],
+        workbook._alignments[style_array.alignmentId],
+        style_array.pivotButton,
+        style_array.quotePrefix,
+        named_style,
+    )
+
+
+def register_style(workbook, style: tuple) -> StyleArray:
+    """Adds the style objects to the workbook's style tables and returns the matching style ids."""
+    font, fill, border, number_format, protection, alignment, pivot_button, quote_prefix, named_style = style
+    num_fmt_id = BUILTIN_FORMATS_REVERSE.get(number_format)
+    if num_fmt_id is None:
+        num_fmt_id = workbook._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE
+    xf_id = 0
+    if named_style is not None and named_style in workbook._named_styles.names:
+        xf_id = workbook._named_styles.names.index(named_style)
+    return StyleArray([
+        workbook._fonts.add(font),
+        workbook._fills.add(fill),
+        workbook._borders.add(border),
+        num_fmt_id,
+        workbook._protections.add(protection),
+        workbook._alignments.add(alignment),
+        pivot_button,
+        quote_prefix,
+        xf_id,
+    ])
+
+
+@instrument.timed("merge fragment")
+def add_fragment(workbook, fragment: SheetFragment, index: Optional[int] = None):
+    """
+    Rebuilds the fragment as a sheet of the workbook and returns it.
+    A sheet with the same title is replaced in place, otherwise the new sheet goes to the end (or to index).
+    """
+    if fragment.title in workbook.sheetnames:
+        old_sheet = workbook[fragment.title]
+        index = workbook.index(old_sheet)
+        workbook.remove(old_sheet)
+    sheet = workbook.create_sheet(title=fragment.title, index=index)
+
+    style_arrays = [register_style(workbook, style) for style in fragment.styles]
+
+    cells = sheet._cells
+    for row, col, value, data_type, style_idx, is_merged in fragment.cells:
+        if is_merged:
+            cell = MergedCell(sheet, row=row, column=col)
+        else:
+            cell = Cell(sheet, row=row, column=col)
+            cell._value = value
+            cell.data_type = data_type
+        if style_idx != NO_STYLE:
+            cell._style = copy(style_arrays[style_idx])
+        cells[(row, col)] = cell
+
+    # the merged cells already are in place, so the ranges are added without merge_cells() touching them again
+    for coord in fragment.merged_ranges:
+        sheet.merged_cells.add(MergedCellRange(sheet, coord))
+
+    for key, (attributes, style_idx) in fragment.column_dimensions.items():
+        dim = ColumnDimension(sheet, index=key, **attributes)
+        if style_idx != NO_STYLE:
+            dim._style = copy(style_arrays[style_idx])
+        sheet.column_dimensions[key] = dim
+    for key, (attributes, style_idx) in fragment.row_dimensions.items():
+        dim = RowDimension(sheet, index=key, **attributes)
+        if style_idx != NO_STYLE:
+            dim._style = copy(style_arrays[style_idx])
+        sheet.row_dimensions[key] = dim
+
+    sheet.sheet_format = copy(fragment.sheet_format)
+    sheet.sheet_properties = copy(fragment.sheet_properties)
+    sheet.page_margins = copy(fragment.page_margins)
+    sheet.print_options = copy(fragment.print_options)
+    sheet.page_setup = PrintPageSetup(worksheet=sheet, **fragment.page_setup)
+    return sheet
+
+
+def test(source_file="template.xlsx", output_file="reports/fragment_test.xlsx"):
+    import openpyxl
+    import pickle
+    workbook = openpyxl.load_workbook(source_file)
+    fragments = [pickle.loads(pickle.dumps(extract_fragment(sheet))) for sheet in workbook.worksheets]
+    for fragment in fragments:
+        fragment.title = f"{fragment.title} copy"
+        print(fragment)
+        add_fragment(workbook, fragment)
+    workbook.save(output_file)
+    print(f"Saved '{output_file}' with sheets {workbook.sheetnames}")
+
+
+if __name__ == "__main__":
+    test()
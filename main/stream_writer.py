@@ -0,0 +1,287 @@
+﻿"""
+Streaming report writer.
+
+Instead of keeping every sheet of a parallel in one openpyxl workbook until the end, each rendered
+sheet (a SheetFragment) is turned into its worksheet XML right away and written to a temporary file.
+The workbook itself is write-only, it only holds the styles and the list of finished sheets,
+so memory stays flat no matter how many sheets the report has and saving just zips the parts together.
+The style tables of the template are registered first, so every template style keeps its id.
+"""
+from typing import Dict, List
+from xml.etree.ElementTree import tostring
+from xml.sax.saxutils import escape
+import os
+import zipfile
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell._writer import etree_write_cell
+from openpyxl.compat import safe_string
+from openpyxl.packaging.relationship import RelationshipList, get_rels_path
+from openpyxl.reader.workbook import WorkbookParser
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.stylesheet import apply_stylesheet, write_stylesheet
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.indexed_list import IndexedList
+from openpyxl.worksheet._writer import create_temporary_file, ALL_TEMP_FILES
+from openpyxl.worksheet.dimensions import ColumnDimension, RowDimension, SheetDimension
+from openpyxl.worksheet.merge import MergeCell, MergeCells
+from openpyxl.worksheet.page import PrintPageSetup
+from openpyxl.xml.constants import ARC_STYLE, ARC_WORKBOOK, SHEET_MAIN_NS
+from copy import copy
+import config
+import instrument
+import sheet_fragment
+from sheet_fragment import SheetFragment, NO_STYLE
+
+ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+
+
+class StreamReportWriter:
+    def __init__(self, template_path: str = config.template_path, workbook=None):
+        """With a workbook the sheets are written against its style tables (see replace_sheets), not the template's."""
+        self.style_arrays: Dict[tuple, StyleArray] = {}
+        self.sheet_count = 0
+        if workbook is not None:
+            self.workbook = workbook
+            return
+        self.workbook = openpyxl.Workbook(write_only=True)
+
+        # start from the template's style tables, so every style keeps the id (and default font) it has there
+        template = openpyxl.load_workbook(template_path)
+        for table in ("_fonts", "_fills", "_borders", "_protections", "_alignments", "_number_formats", "_cell_styles"):
+            setattr(self.workbook, table, IndexedList(getattr(template, table)))
+        for template_sheet in template.worksheets:
+            for style in sheet_fragment.extract_fragment(template_sheet).styles:
+                self.style_array(style)
+
+    def style_array(self, style: tuple) -> StyleArray:
+        style_array = self.style_arrays.get(style)
+        if style_array is None:
+            style_array = sheet_fragment.register_style(self.workbook, style)
+            self.style_arrays[style] = style_array
+        return style_array
+
+    @instrument.timed("stream sheet")
+    def add(self, fragment: SheetFragment):
+        """Writes the fragment as the next sheet of the report. The sheet can't be changed afterwards."""
+        sheet = self.workbook.create_sheet(title=fragment.title)
+        style_arrays = [self.style_array(style) for style in fragment.styles]
+        style_ids = [self.workbook._cell_styles.add(style_array) for style_array in style_arrays]
+
+        for key, (attributes, style_idx) in fragment.column_dimensions.items():
+            dim = ColumnDimension(sheet, index=key, **attributes)
+            if style_idx != NO_STYLE:
+                dim._style = copy(style_arrays[style_idx])
+            sheet.column_dimensions[key] = dim
+        for key, (attributes, style_idx) in fragment.row_dimensions.items():
+            dim = RowDimension(sheet, index=key, **attributes)
+            if style_idx != NO_STYLE:
+                dim._style = copy(style_arrays[style_idx])
+            sheet.row_dimensions[key] = dim
+        sheet.sheet_format = copy(fragment.sheet_format)
+        sheet.sheet_properties = copy(fragment.sheet_properties)
+        sheet.page_margins = copy(fragment.page_margins)
+        sheet.print_options = copy(fragment.print_options)
+        sheet.page_setup = PrintPageSetup(worksheet=sheet, **fragment.page_setup)
+
+        # the write-only sheet saves whatever its writer produced, here the XML written from the fragment
+        sheet._writer = FragmentSheetWriter(sheet, fragment, style_ids)
+        sheet.close()
+        self.sheet_count += 1
+        return sheet
+
+    def save(self, filepath: str):
+        if self.sheet_count == 0:
+            self.workbook.create_sheet(title="Sheet")  # a workbook can't be saved without sheets
+        self.workbook.save(filepath)
+
+
+class FragmentSheetWriter:
+    """
+    Stands in for openpyxl's WorksheetWriter of a write-only sheet.
+    The sheet data is written as plain strings, the few sheet level elements are serialised by openpyxl.
+    """
+    def __init__(self, sheet, fragment: SheetFragment, style_ids: List[int]):
+        self.sheet = sheet
+        self.fragment = fragment
+        self.style_ids = style_ids
+        self.out = create_temporary_file()
+        self._rels = RelationshipList()
+
+    def write_rows(self):
+        sheet = self.sheet
+        rows: Dict[int, list] = {}
+        for cell in self.fragment.cells:
+            rows.setdefault(cell[0], []).append(cell)
+        for row_idx in sheet.row_dimensions.keys() - rows.keys():
+            rows[row_idx] = []
+
+        max_row = max(rows, default=1)
+        max_col = max((cell[1] for cell in self.fragment.cells), default=1)
+        sheet.sheet_format.outlineLevelCol = sheet.column_dimensions.max_outline
+
+        parts = [f'<worksheet xmlns="{SHEET_MAIN_NS}">']
+        parts.append(serialise(sheet.sheet_properties.to_tree()))
+        parts.append(serialise(SheetDimension(f"A1:{get_column_letter(max_col)}{max_row}").to_tree()))
+        parts.append(serialise(sheet.views.to_tree()))
+        parts.append(serialise(sheet.sheet_format.to_tree()))
+        parts.append(serialise(sheet.column_dimensions.to_tree()))
+
+        parts.append("<sheetData>")
+        letters = [""] + [get_column_letter(col) for col in range(1, max_col + 1)]
+        for row_idx in sorted(rows):
+            attributes = "".join(f' {key}="{escape(value, ATTRIBUTE_ENTITIES)}"'
+                                 for key, value in sheet.row_dimensions.get(row_idx, {}))
+            parts.append(f'<row r="{row_idx}"{attributes}>')
+            for row, col, value, data_type, style_idx, is_merged in sorted(rows[row_idx], key=lambda c: c[1]):
+                if is_merged:
+                    value = None
+                if value is None and style_idx == NO_STYLE:
+                    continue
+                parts.append(self.cell_xml(row, col, f"{letters[col]}{row}", value, data_type, style_idx))
+            parts.append("</row>")
+        parts.append("</sheetData>")
+
+        if self.fragment.merged_ranges:
+            merges = MergeCells(mergeCell=[MergeCell(coord) for coord in self.fragment.merged_ranges])
+            parts.append(serialise(merges.to_tree()))
+        for element in (sheet.print_options, sheet.page_margins, sheet.page_setup):
+            if element:
+                parts.append(serialise(element.to_tree()))
+        parts.append("</worksheet>")
+
+        with open(self.out, "w", encoding="utf-8") as f:
+            f.write("".join(parts))
+        self.fragment = None  # the sheet keeps its writer until the workbook is saved, the cells are no longer needed
+
+    def cell_xml(self, row: int, col: int, coordinate: str, value, data_type: str, style_idx: int) -> str:
+        style = f' s="{self.style_ids[style_idx]}"' if style_idx != NO_STYLE else ""
+        if value is None or value == "":
+            return f'<c r="{coordinate}"{style} t="{"inlineStr" if data_type == "s" else data_type}" />'
+        if data_type == "n":
+            return f'<c r="{coordinate}"{style} t="n"><v>{safe_string(value)}</v></c>'
+        if data_type == "s" and isinstance(value, str):
+            space = ' xml:space="preserve"' if value.strip() != value and value.strip() else ""
+            return f'<c r="{coordinate}"{style} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+        # booleans, dates, formulas and rich text are rare here, openpyxl writes them
+        cell = WriteOnlyCell(self.sheet)
+        cell._value = value
+        cell.data_type = data_type
+        cell.row, cell.column = row, col
+        collected = []
+        etree_write_cell(ElementCollector(collected), self.sheet, cell)
+        xml = serialise(collected[0])
+        return xml.replace("<c ", f"<c{style} ", 1) if style else xml
+
+    def write_tail(self):
+        pass
+
+    def close(self):
+        pass
+
+    def cleanup(self):
+        os.remove(self.out)
+        ALL_TEMP_FILES.remove(self.out)
+
+
+class ElementCollector:
+    def __init__(self, elements: list):
+        self.elements = elements
+
+    def write(self, element):
+        self.elements.append(element)
+
+
+def serialise(element) -> str:
+    if element is None:
+        return ""
+    return tostring(element, encoding="unicode")
+
+
+class ReportSheetPatcher:
+    """
+    Swaps the XML of some sheets of an existing report right inside the xlsx file, every other part is copied
+    as it is. That takes seconds where loading and saving the whole report with openpyxl takes minutes.
+    The new sheets are written against the report's own style tables, so the existing style ids stay valid.
+    """
+    STYLE_TABLES = ("_fonts", "_fills", "_borders", "_number_formats", "_protections", "_alignments", "_cell_styles")
+
+    def __init__(self, report_path: str):
+        self.report_path = report_path
+        with zipfile.ZipFile(report_path) as archive:
+            parser = WorkbookParser(archive, ARC_WORKBOOK)
+            parser.parse()
+            self.sheet_parts = {sheet.name: rel.target.lstrip("/") for sheet, rel in parser.find_sheets()}
+            self.part_names = set(archive.namelist())
+            self.workbook = openpyxl.Workbook(write_only=True)
+            apply_stylesheet(archive, self.workbook)
+        for table in self.STYLE_TABLES:
+            # a saved report can list the same style twice, any of its positions is a valid id,
+            # but openpyxl would renumber the lookup as if there were no duplicates
+            values = getattr(self.workbook, table)
+            positions = {}
+            for idx, value in enumerate(values):
+                positions.setdefault(value, idx)
+            values._dict = positions
+            values.clean = True
+        self.table_sizes = self.style_table_sizes()
+        self.stream = StreamReportWriter(workbook=self.workbook)
+        self.new_parts: Dict[str, FragmentSheetWriter] = {}
+
+    def style_table_sizes(self) -> List[int]:
+        return [len(getattr(self.workbook, table)) for table in self.STYLE_TABLES]
+
+    def can_replace(self, titles: List[str]) -> bool:
+        """False if one of the sheets is missing or has parts of its own (comments, drawings)."""
+        for title in titles:
+            part = self.sheet_parts.get(title)
+            if part is None or get_rels_path(part) in self.part_names:
+                return False
+        return True
+
+    def add(self, fragment: SheetFragment):
+        """Writes the fragment's sheet XML to a temporary file right away, like the stream writer does."""
+        self.new_parts[self.sheet_parts[fragment.title]] = self.stream.add(fragment)._writer
+
+    def save(self):
+        styles_xml = None
+        if self.style_table_sizes() != self.table_sizes:
+            styles_xml = tostring(write_stylesheet(self.workbook))  # only appended to, the old ids stay the same
+
+        tmp_path = f"{self.report_path}.{os.getpid()}.tmp"
+        try:
+            with zipfile.ZipFile(self.report_path) as archive, \
+                    zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as out:
+                for item in archive.infolist():
+                    if item.filename in self.new_parts:
+                        out.write(self.new_parts[item.filename].out, item.filename)
+                    elif item.filename == ARC_STYLE and styles_xml is not None:
+                        out.writestr(item.filename, styles_xml)
+                    else:
+                        out.writestr(item, archive.read(item.filename))
+            os.replace(tmp_path, self.report_path)
+        finally:
+            self.discard()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def discard(self):
+        for sheet_writer in self.new_parts.values():
+            sheet_writer.cleanup()
+        self.new_parts = {}
+
+
+def test(source_file=config.template_path, output_file="reports/stream_test.xlsx"):
+    workbook = openpyxl.load_workbook(source_file)
+    stream = StreamReportWriter(source_file)
+    for sheet in workbook.worksheets:
+        fragment = sheet_fragment.extract_fragment(sheet)
+        fragment.title = f"{fragment.title} copy"
+        stream.add(fragment)
+    stream.save(output_file)
+    print(f"Saved '{output_file}' with {stream.sheet_count} sheets")
+
+
+if __name__ == "__main__":
+    test()
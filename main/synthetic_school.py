@@ -0,0 +1,208 @@
+﻿"""
+Generates a synthetic school: timetable, grades, days and topic workbooks in the same layouts as the real ones,
+so the extractors and the report generation can be run (and timed) at any size.
+
+    python synthetic_school.py --classes 6 --subjects 12 --students 30
+
+The files go to a folder of their own, SyntheticSchool.use() points the config at them for a run.
+"""
+from typing import Dict, List
+from contextlib import contextmanager
+import argparse
+import os
+import numpy as np
+import openpyxl
+import config
+
+DAY_NAMES = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница"]
+LESSONS_PER_DAY = 7
+WEEKS_PER_YEAR = 34
+QUARTER_ROWS = ["I", "II", "III", "IV", "год"]
+EXAM_ROWS = ["экз", "итог"]
+GRADE_WEIGHTS = {2: 0.03, 3: 0.22, 4: 0.45, 5: 0.30}
+
+
+class SyntheticSchool:
+    def __init__(
+            self,
+            folder: str,
+            num_classes: int = 2,
+            num_subjects: int = 8,
+            num_students: int = 25,
+            parallels: List[str] = ("7",),
+            seed: int = 0
+    ):
+        if num_subjects > 5 * LESSONS_PER_DAY:
+            raise ValueError(f"A week has only {5 * LESSONS_PER_DAY} lessons, {num_subjects} subjects do not fit")
+        self.folder = folder
+        self.num_classes = num_classes
+        self.num_subjects = num_subjects
+        self.num_students = num_students
+        self.parallels = list(parallels)
+        self.seed = seed
+
+        # the letter A makes a class Kazakh, the rest are Russian classes
+        letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        self.class_names = [f"{self.parallels[idx % len(self.parallels)]}{letters[idx // len(self.parallels)]}"
+                            for idx in range(num_classes)]
+        self.subject_names = [f"Предмет {idx + 1}" for idx in range(num_subjects)]
+        self.weekly_hours = self.plan_weekly_hours()
+
+    @property
+    def timetable_path(self) -> str:
+        return os.path.join(self.folder, "timetable.xlsx")
+
+    @property
+    def grades_path(self) -> str:
+        return os.path.join(self.folder, "grades.xlsx")
+
+    @property
+    def days_path(self) -> str:
+        return os.path.join(self.folder, "days.xlsx")
+
+    @property
+    def topic_paths(self) -> List[str]:
+        return [os.path.join(self.folder, "kaz"), os.path.join(self.folder, "rus"), "", ""]
+
+    def __repr__(self):
+        return (f"synthetic school with {self.num_classes} classes, {self.num_subjects} subjects "
+                f"and {self.num_students} students per class in '{self.folder}'")
+
+    def plan_weekly_hours(self) -> List[int]:
+        """1 to 4 hours a week per subject, as many as fit into the week."""
+        free_slots = 5 * LESSONS_PER_DAY - self.num_subjects
+        hours = []
+        for idx in range(self.num_subjects):
+            extra = min(idx % 4, free_slots)
+            free_slots -= extra
+            hours.append(1 + extra)
+        return hours
+
+    def has_exam(self, subject_idx: int, parallel: int) -> bool:
+        return parallel >= 5 and subject_idx % 4 == 0
+
+    def generate(self):
+        os.makedirs(self.folder, exist_ok=True)
+        rng = np.random.default_rng(self.seed)
+        self.write_timetable()
+        self.write_grades(rng)
+        self.write_days()
+        self.write_topics(rng)
+        print(f"Generated {self}")
+        return self
+
+    def write_timetable(self):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("timetable")
+        header = [None]
+        for day in DAY_NAMES:
+            header += [day] + [None] * (LESSONS_PER_DAY - 1)
+        sheet.append(header)
+        sheet.append(["Класс"] + [f"{lesson + 1}." for _ in DAY_NAMES for lesson in range(LESSONS_PER_DAY)])
+
+        # every subject is spread over the week, one lesson a day before a day gets a second one
+        lessons = [idx for idx, hours in enumerate(self.weekly_hours) for _ in range(hours)]
+        slots = [None] * (5 * LESSONS_PER_DAY)
+        for position, subject_idx in enumerate(lessons):
+            day, lesson = position % 5, position // 5
+            slots[day * LESSONS_PER_DAY + lesson] = subject_idx
+
+        for class_name in self.class_names:
+            sheet.append([class_name] + [None if idx is None else self.subject_names[idx] for idx in slots])
+            sheet.append([None] + [None if idx is None else f"Учитель {idx + 1}" for idx in slots])
+            sheet.append([])
+        workbook.save(self.timetable_path)
+
+    def write_grades(self, rng: np.random.Generator):
+        workbook = openpyxl.Workbook(write_only=True)
+        marks = np.array(list(GRADE_WEIGHTS))
+        probabilities = np.array(list(GRADE_WEIGHTS.values()))
+        for class_name in self.class_names:
+            parallel = int(class_name[:-1])
+            sheet = workbook.create_sheet(class_name)
+            sheet.append([None, "ФИО обучающегося", "Четверть"] + self.subject_names)
+            rows = QUARTER_ROWS + (EXAM_ROWS if parallel >= 5 else [])
+            for student_idx in range(self.num_students):
+                # each student has a typical mark, the quarters stay close to it
+                typical = rng.choice(marks, p=probabilities)
+                quarters = np.clip(typical + rng.integers(-1, 2, size=(4, self.num_subjects)), 2, 5)
+                yearly = np.ceil(quarters.mean(axis=0)).astype(int)
+                grades = {row: quarters[idx] for idx, row in enumerate(QUARTER_ROWS[:4])}
+                grades["год"] = yearly
+                grades["экз"] = np.clip(yearly + rng.integers(-1, 1, size=self.num_subjects), 2, 5)
+                grades["итог"] = yearly
+                for row_idx, row in enumerate(rows):
+                    first = row_idx == 0
+                    values = [int(grades[row][subject_idx])
+                              if row not in EXAM_ROWS or self.has_exam(subject_idx, parallel) else None
+                              for subject_idx in range(self.num_subjects)]
+                    sheet.append(["м" if first and student_idx % 2 == 0 else None,
+                                  f"Ученик {class_name} {student_idx + 1}" if first else None,
+                                  row] + values)
+        workbook.save(self.grades_path)
+
+    def write_days(self):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet(config.days_sheet_name)
+        sheet.append([None, "monday", "tuesday", "wednesday", "thursday", "friday"])
+        for quarter_num, days in config.all_days_in_each_quarter.items():
+            for week_start in range(0, len(days), 5):
+                week = [None if day == "nan" else day for day in days[week_start:week_start + 5]]
+                sheet.append([quarter_num if week_start == 0 else None] + week)
+        workbook.save(self.days_path)
+
+    def write_topics(self, rng: np.random.Generator):
+        for folder in self.topic_paths[:2]:
+            os.makedirs(folder, exist_ok=True)
+            for parallel in sorted(set(self.parallels)):
+                for subject_name, hours in zip(self.subject_names, self.weekly_hours):
+                    self.write_topic_file(os.path.join(folder, f"{parallel} {subject_name}.xlsx"),
+                                          subject_name, hours * WEEKS_PER_YEAR, rng)
+
+    @staticmethod
+    def write_topic_file(path: str, subject_name: str, total_hours: int, rng: np.random.Generator):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Лист 1")
+        sheet.append([f'КАЛЕНДАРНО-ТЕМАТИЧЕСКОЕ ПЛАНИРОВАНИЕ ПО ПРЕДМЕТУ "{subject_name.upper()}"'])
+        sheet.append([])
+        sheet.append(["№ п/п", "Тема урока", "Домашнее задание", "Количество часов", "Даты"])
+        sheet.append([None, None, None, None, "Плановая дата", "Фактическая дата"])
+        topic_num = 0
+        while total_hours > 0:
+            topic_num += 1
+            hours = int(min(rng.choice([1, 1, 1, 2]), total_hours))
+            total_hours -= hours
+            sheet.append([topic_num, f"{subject_name}: тема {topic_num}", f"§{topic_num}, упр. {topic_num * 3}", hours])
+        workbook.save(path)
+
+    @contextmanager
+    def use(self):
+        """Points the config at the files of this school (and turns the cache off) for the duration of the block."""
+        names = ["timetable_path", "grades_path", "days_path", "topic_paths", "use_cache"]
+        saved: Dict[str, object] = {name: getattr(config, name) for name in names}
+        config.timetable_path = self.timetable_path
+        config.grades_path = self.grades_path
+        config.days_path = self.days_path
+        config.topic_paths = self.topic_paths
+        config.use_cache = False
+        try:
+            yield self
+        finally:
+            for name, value in saved.items():
+                setattr(config, name, value)
+
+
+def school_folder(num_classes: int, num_subjects: int, num_students: int) -> str:
+    return os.path.join(config.benchmark_dir, f"school_{num_classes}x{num_subjects}x{num_students}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes the input workbooks of a synthetic school.")
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--subjects", type=int, default=8)
+    parser.add_argument("--students", type=int, default=25)
+    parser.add_argument("--parallels", nargs="+", default=["7"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    SyntheticSchool(school_folder(args.classes, args.subjects, args.students),
+                    args.classes, args.subjects, args.students, args.parallels, args.seed).generate()
@@ -1,143 +1,135 @@
 ﻿import pandas as pd
+import numpy as np
 import config
-from typing import List, Dict
+from typing import List, Dict, Collection, Optional
 import re
 from classes import Class, Subject
+from calendar_index import CompiledCalendar, WEEKDAYS
+import cache
+import excel_reader
+import helper
+import instrument
+import log
 
 
+@instrument.timed("days extraction")
 def extract_days(
         filepath=config.days_path,
         days_sheet_name=config.days_sheet_name
-) -> Dict[int, List[str]]:
+) -> Optional[CompiledCalendar]:
     """
-    Opens an Excel file and processes each sheet to extract dates grouped by quarter.
+    Reads the school days of the year from the days sheet, None when there is no days file.
+    The compiled calendar is cached, so only a new days file is parsed again.
     """
-    days = {}
-
     try:
-        xls = pd.ExcelFile(filepath)
+        return cache.get_or_parse("days", filepath, parse_days, days_sheet_name)
     except FileNotFoundError:
-        print(f"Error: The file '{filepath}' was not found.")
-        return {}
-    print(f"\n--- Processing Days for {days_sheet_name}---")
-    for sheet_name in xls.sheet_names:
-        if sheet_name != days_sheet_name:
-            continue
-        try:
-            # Process each sheet and merge the results
-            sheet_days = process_days_sheet(xls, sheet_name)
-            for quarter, date_list in sheet_days.items():
-                if quarter not in days:
-                    days[quarter] = []
-                days[quarter].extend(date_list)
-        except Exception as e:
-            print(f"# ERROR: Could not process sheet '{sheet_name}'. Reason: {e}")
-    return days
-
-
-def process_days_sheet(xls, sheet_name) -> Dict[int, List[str]]:
+        log.warning("# WARNING: The days file '{}' was not found.", filepath)
+        return None
+
+
+def parse_days(filepath, days_sheet_name) -> Optional[CompiledCalendar]:
+    log.info("\n--- Processing Days for {}---", days_sheet_name)
+    with excel_reader.open_workbook(filepath) as reader:
+        if days_sheet_name not in reader.sheet_names:
+            log.error("# ERROR: The days file '{}' has no sheet '{}'.", filepath, days_sheet_name)
+            return None
+        rows = reader.rows(days_sheet_name)
+    calendar = process_days_sheet(rows, days_sheet_name)
+    if calendar is not None:
+        misplaced = calendar.misplaced_days()
+        if misplaced:
+            log.warning("# WARNING: {} dates of '{}' are not in the column of their weekday: {}",
+                        len(misplaced), days_sheet_name, [str(day) for day in misplaced[:5]])
+    return calendar
+
+
+def process_days_sheet(rows, sheet_name) -> Optional[CompiledCalendar]:
     """
-    Scrapes a single sheet for dates, organizing them by quarter.
-
-    Args:
-        xls (pd.ExcelFile): The opened Excel file object.
-        sheet_name (str): The name of the sheet to process.
-
-    Returns:
-        A dictionary where keys are quarter numbers (int) and values are lists of
-        date strings for that quarter.
+    Turns the rows of a days sheet into a calendar, in one pass over the whole sheet.
+    The first row is the header. Column A starts a quarter (its number), columns B to F
+    hold the dates of Monday to Friday of one week, as dd.mm.yyyy text or as Excel dates.
     """
-    # Read the sheet, assuming the first row is the header
-    df = pd.read_excel(xls, sheet_name, header=0)
-
-    # Check if the sheet has the expected structure (at least 6 columns: Quarter + 5 weekdays)
-    if len(df.columns) < 6:
-        print(f"# WARNING: Skipping '{sheet_name}'. It has fewer than 6 columns.")
-        return {}
-
-    days_by_quarter = {}
-    current_quarter = None
-
-    # Iterate over each row of the DataFrame
-    for index, row in df.iterrows():
-        # Column A (index 0) contains the quarter number
-        quarter_cell_value = str(row.iloc[0])
-
-        # Use regex to find if the cell in Column A specifies a new quarter
-        match = re.search(r'\d+', quarter_cell_value)
-        if match:
-            current_quarter = int(match.group(0))
-            # Initialize an empty list for this quarter if it's the first time we've seen it
-            if current_quarter not in days_by_quarter:
-                days_by_quarter[current_quarter] = []
-
-        # If we have identified a quarter, process the dates in that row
-        if current_quarter is not None:
-            # Columns B to F (indices 1 to 5) contain the dates for Monday to Friday
-            week_dates = row.iloc[1:6].tolist()
-
-            # Format and clean the date values before adding them
-            formatted_dates = []
-            for date_val in week_dates:
-                # Keep empty values as empty strings
-                if not date_val:
-                    formatted_dates.append('')
-                    continue
-                try:
-                    # Use pandas to_datetime to robustly parse dates (DD.MM.YY)
-                    # and format them into a consistent string format (DD.MM.YYYY)
-                    dt_obj = pd.to_datetime(date_val, dayfirst=True)
-                    formatted_dates.append(dt_obj.strftime('%d.%m.%Y'))
-                except (ValueError, TypeError):
-                    # If conversion fails, it's not a date; keep the original value as a string
-                    formatted_dates.append(str(date_val))
-
-            # Add the week's dates to the list for the current quarter
-            days_by_quarter[current_quarter].extend(formatted_dates)
-
-    print(f"Successfully processed sheet '{sheet_name}', found data for quarters: {list(days_by_quarter.keys())}")
-    return days_by_quarter
-
-
+    if len(rows) < 2 or len(rows[0]) < 1 + WEEKDAYS:
+        log.warning("# WARNING: Skipping '{}'. It has fewer than 6 columns.", sheet_name)
+        return None
+    block = np.array(rows[1:], dtype=object).reshape(len(rows) - 1, -1)
+
+    # the quarter of a week is the last quarter number at or above it in column A
+    quarter_numbers = pd.Series(block[:, 0], dtype=object).astype(str).str.extract(r'(\d+)', expand=False)
+    quarters = pd.to_numeric(quarter_numbers).ffill()
+
+    cells = pd.Series(block[:, 1:1 + WEEKDAYS].ravel(), dtype=object)
+    dates = pd.to_datetime(cells, format="%d.%m.%Y", errors="coerce").to_numpy(dtype="datetime64[D]")
+    has_value = cells.notna().to_numpy()
+    # plain numbers are not dates, pandas would read them as nanoseconds after 1970
+    is_number = pd.to_numeric(cells, errors="coerce").notna().to_numpy()
+    other_formats = np.isnat(dates) & has_value & ~is_number
+    if other_formats.any():
+        # Excel dates and other spellings (dd.mm.yy, ...) go through the slower, more forgiving parser
+        dates[other_formats] = pd.to_datetime(cells[other_formats], dayfirst=True, format="mixed",
+                                              errors="coerce").to_numpy(dtype="datetime64[D]")
+    not_dates = cells[np.isnat(dates) & has_value]
+    if len(not_dates):
+        log.warning("# WARNING: {} cells of '{}' are not dates and count as days without school: {}",
+                    len(not_dates), sheet_name, not_dates.astype(str).unique()[:5].tolist())
+    week_dates = dates.reshape(-1, WEEKDAYS)
+
+    quarter_dates = {}
+    for quarter_num in quarters.dropna().unique():
+        quarter_dates[int(quarter_num)] = week_dates[(quarters == quarter_num).to_numpy()].ravel()
+    calendar = CompiledCalendar(quarter_dates)
+    log.info("Successfully processed sheet '{}', found data for quarters: {}", sheet_name, list(quarter_dates))
+    return calendar
+
+
+@instrument.timed("timetable extraction")
 def extract_class_subjects(
         filepath=config.timetable_path,
-        class_name: str = "",
+        targets: Collection[str] = (),
         is_dod=False
 ) -> Dict[str, Class]:
     """
-    Opens the timetable Excel file and extracts the schedule for all classes from each sheet.
+    Opens the timetable Excel file and extracts the schedule of the target classes (every class without targets).
     """
     if is_dod and filepath == config.timetable_path:
         filepath = config.dod_timetable_path
 
-    all_classes_data = {}
     try:
-        xls = pd.ExcelFile(filepath)
+        return cache.get_or_parse("timetable", filepath, parse_timetable, is_dod, tuple(sorted(targets)))
     except FileNotFoundError:
-        print(f"Error: The file '{filepath}' was not found.")
+        log.error("Error: The file '{}' was not found.", filepath)
         return {}
 
-    print(f"\n--- Processing Timetable ---")
-    for sheet_name in xls.sheet_names:
-        try:
-            # Read the entire sheet without headers, as the structure is not a simple table
-            df = pd.read_excel(xls, sheet_name=sheet_name, header=None)
 
-            # Process the sheet to get class schedules
-            sheet_classes = process_timetable_sheet(df, sheet_name, target_class=class_name, is_dod=is_dod)
+def parse_timetable(filepath, is_dod=False, targets: Collection[str] = ()) -> Dict[str, Class]:
+    """
+    Reads every sheet of the timetable file, only the rows of the target classes are turned into classes.
+    """
+    all_classes_data = {}
+
+    log.info("\n--- Processing Timetable ---")
+    with excel_reader.open_workbook(filepath) as reader:
+        for sheet_name in reader.sheet_names:
+            try:
+                # Read the entire sheet without headers, as the structure is not a simple table
+                rows = reader.rows(sheet_name)
+
+                # Process the sheet to get class schedules
+                sheet_classes = process_timetable_sheet(rows, sheet_name, targets, is_dod=is_dod)
 
-            # Add the extracted classes from the current sheet to the main dictionary
-            all_classes_data.update(sheet_classes)
-        except Exception as e:
-            print(f"# ERROR: Could not process sheet '{sheet_name}'. Reason: {e}")
+                # Add the extracted classes from the current sheet to the main dictionary
+                all_classes_data.update(sheet_classes)
+            except Exception as e:
+                log.error("# ERROR: Could not process sheet '{}'. Reason: {}", sheet_name, e)
 
     return all_classes_data
 
 
 def process_timetable_sheet(
-        df: pd.DataFrame,
+        rows: List[tuple],
         sheet_name: str,
-        target_class: str = "",
+        targets: Collection[str] = (),
         is_dod=False
 ) -> Dict[str, Class]:
     """
@@ -145,25 +137,25 @@ def process_timetable_sheet(
     Assumes a specific format where each class has a subject row, a teacher row, and a blank row.
     """
     all_class_subjects = {}
-    print(f"Processing timetable sheet: '{sheet_name}' with {len(df)} rows")
+    log.info("Processing timetable sheet: '{}' with {} rows", sheet_name, len(rows))
 
-    # The actual data starts from the 3rd row (index 2 in pandas)
+    # The actual data starts from the 3rd row (index 2)
     # The structure is: subjects row, teachers row, empty row. So we step by 3.
-    for i in range(2, len(df), 3):
-        # Ensure we don't go past the end of the DataFrame
-        if i + 1 >= len(df):
+    for i in range(2, len(rows), 3):
+        # Ensure we don't go past the end of the sheet
+        if i + 1 >= len(rows):
             break
 
-        subject_row = df.iloc[i]
-        teacher_row = df.iloc[i + 1]
+        subject_row = rows[i]
+        teacher_row = rows[i + 1]
 
-        class_name = subject_row.iloc[0]
+        class_name = subject_row[0]
         # If the first cell in the subject row is empty, we assume it's the end of the class list
-        if pd.isna(class_name):
+        if class_name is None:
             break
 
         class_name = str(class_name).strip()
-        if class_name != target_class and target_class != "":
+        if not helper.is_target(class_name, targets):
             continue
         subjects_in_class = {}
         is_kaz = any(class_name.endswith(c) for c in ('A', 'a', '8B', '8b'))
@@ -181,17 +173,17 @@ def process_timetable_sheet(
             end_col = start_col + lessons_per_day
 
             for col_index in range(start_col, end_col):
-                subject_name = subject_row.iloc[col_index]
+                subject_name = subject_row[col_index]
 
                 # If there's no subject in this slot, skip to the next one
-                if pd.isna(subject_name):
+                if subject_name is None:
                     continue
 
-                teacher_name = teacher_row.iloc[col_index]
+                teacher_name = teacher_row[col_index]
 
                 # Clean and normalize the data
                 normalized_name = str(subject_name).replace('\n', ' ').strip().lower()
-                normalized_teacher = str(teacher_name).strip() if not pd.isna(teacher_name) else "No Teacher Assigned"
+                normalized_teacher = str(teacher_name).strip() if teacher_name is not None else "No Teacher Assigned"
 
                 is_art = False
                 for art in config.art:
@@ -204,7 +196,8 @@ def process_timetable_sheet(
                 if normalized_name not in subjects_in_class:
                     if is_art and ((boys_subject_name not in subjects_in_class
                                     and girls_subject_name not in subjects_in_class)):
-                        print(f"   ->subject {normalized_name} is a new art class and will add '{boys_subject_name}', and '{girls_subject_name}'")
+                        log.debug("   ->subject {} is a new art class and will add '{}', and '{}'",
+                                  normalized_name, boys_subject_name, girls_subject_name)
                         boys_subject = Subject(name=boys_subject_name, teacher=normalized_teacher)
                         girls_subject = Subject(name=girls_subject_name, teacher=normalized_teacher)
                         subjects_in_class[boys_subject_name] = boys_subject
@@ -224,7 +217,7 @@ def process_timetable_sheet(
         current_class = Class(class_name, subjects_in_class)
         current_class.is_kz = is_kaz
         all_class_subjects[class_name] = current_class
-        print(f"  -> Processed schedule for class '{class_name}' with {len(subjects_in_class)} unique subjects.")
+        log.debug("  -> Processed schedule for class '{}' with {} unique subjects.", class_name, len(subjects_in_class))
 
     return all_class_subjects
 
@@ -232,7 +225,7 @@ def process_timetable_sheet(
 def test2():
     sample_class_name_1 = "10A"
     is_dod = True
-    all_class_data = extract_class_subjects(class_name=sample_class_name_1, is_dod=is_dod)
+    all_class_data = extract_class_subjects(targets=[sample_class_name_1], is_dod=is_dod)
     if not all_class_data:
         print("No class schedules were extracted.")
         return
@@ -250,15 +243,16 @@ def test2():
 def test1():
     sheet_name = config.days_sheet_name
 
-    all_days_in_quarters = extract_days(days_sheet_name=sheet_name)
-    if not all_days_in_quarters:
+    calendar = extract_days(days_sheet_name=sheet_name)
+    if calendar is None:
         print("No days were extracted.")
         return
 
-    for quarter, days_list in all_days_in_quarters.items():
+    print(calendar)
+    for quarter, days_list in calendar.day_strings().items():
         print(f"\n---> In quarter {quarter} there are {len(days_list)} date entries:")
-        # Join the list of days for cleaner printing
-        print("\", \"".join(filter(None, days_list)))
+        print("\", \"".join(day for day in days_list if day != "nan"))
+    print(f"\nSame as config.all_days_in_each_quarter: {calendar.day_strings() == config.all_days_in_each_quarter}")
 
 
 if __name__ == "__main__":
@@ -1,26 +1,31 @@
-﻿import pandas as pd
-from classes import Class
+﻿from classes import Class, TopicPlan
 import config
-from typing import Dict
+import excel_reader
+from typing import Collection, Dict, List, Tuple
+from collections import defaultdict
 from pathlib import Path
 import re
 import timetable_extractor
 import helper
+import cache
+import instrument
+import log
 
 
+@instrument.timed("topic extraction")
 def extract_all_topics_and_hw(
         all_classes_dict: Dict[str, Class],
-        class_name: str = "",
+        targets: Collection[str] = (),
         is_dod=False
 ):
-    extract_topics_and_hw(all_classes_dict, True, target_class=class_name, is_dod=is_dod)
-    extract_topics_and_hw(all_classes_dict, False, target_class=class_name, is_dod=is_dod)
+    extract_topics_and_hw(all_classes_dict, True, targets=targets, is_dod=is_dod)
+    extract_topics_and_hw(all_classes_dict, False, targets=targets, is_dod=is_dod)
 
 
 def extract_topics_and_hw(
         all_classes_dict: Dict[str, Class],
         is_kaz: bool,
-        target_class: str = "",
+        targets: Collection[str] = (),
         is_dod=False
 ):
     if not is_dod:
@@ -40,37 +45,63 @@ def extract_topics_and_hw(
 
     path = Path(folder_path_str)
     if not path.is_dir():
-        print(f"Error: The folder '{folder_path_str}' was not found.")
+        log.error("Error: The folder '{}' was not found.", folder_path_str)
         return
 
-    print(f"\n--- Extracting topics/homework from {folder_path_str} ---")
-    for file_path in path.glob('*.xlsx'):
+    classes_by_parallel = build_class_index(all_classes_dict, targets)
+    if targets:
+        # only the files of the parallels that are asked for, named like "5 Алгебра.xlsx"
+        parallels = sorted({parallel for parallel, kaz in classes_by_parallel if kaz == is_kaz})
+        file_paths = [file_path for parallel in parallels for file_path in sorted(path.glob(f'{parallel} *.xlsx'))]
+    else:
+        file_paths = path.glob('*.xlsx')
+
+    log.info("\n--- Extracting topics/homework from {} ---", folder_path_str)
+    for file_path in file_paths:
         filename_stem = file_path.stem  # "5 Алгебра"
 
         # --- 1. Extract subject and class number from filename ---
         match = re.match(r'^(\d+)\s+(.+)', filename_stem)
         if not match:
-            print(f"# WARNING: Skipping topics file with unexpected name format: '{file_path.name}'")
+            log.warning("# WARNING: Skipping topics file with unexpected name format: '{}'", file_path.name)
             continue
 
         class_num_str, subject_from_filename = match.groups()
         normalized_subject_name = subject_from_filename.strip().lower()
 
-        # --- 2. Find the correct class.subjects dictionary to add topics to ---
-        # Find a class that starts with the number and matches the language context (Kaz/Rus)
-        for class_name_key, class_object in all_classes_dict.items():
-            if class_name_key.startswith(class_num_str):
-                if target_class != "" and not target_class.startswith(class_num_str):
-                    continue
-                is_class_key_kaz = any(class_name_key.endswith(c) for c in ('A', 'a', '8B', '8b'))
+        # --- 2. Find the classes of this parallel that match the language context (Kaz/Rus) ---
+        matching_classes = classes_by_parallel.get((int(class_num_str), is_kaz), [])
+        if not matching_classes:
+            continue
 
-                if (is_kaz and is_class_key_kaz) or (not is_kaz and not is_class_key_kaz):
-                    set_data_to_subject(
-                        class_object.subjects,
-                        file_path,
-                        normalized_subject_name,
-                        class_name_key,
-                        is_dod)
+        # --- 3. Parse the file once and share the same topics with every class that uses it ---
+        plan = None
+        for class_name_key, class_object in matching_classes:
+            if normalized_subject_name in class_object.subjects and plan is None:
+                plan = cache.get_or_parse("topics", file_path, parse_topic_file, is_dod)
+            set_data_to_subject(
+                class_object.subjects,
+                file_path,
+                normalized_subject_name,
+                class_name_key,
+                plan,
+                is_dod)
+
+
+def build_class_index(
+        all_classes_dict: Dict[str, Class],
+        targets: Collection[str] = ()
+) -> Dict[Tuple[int, bool], List[Tuple[str, Class]]]:
+    """
+    Groups the target classes by (parallel number, is_kaz), the two things a topics file name selects on.
+    """
+    classes_by_parallel = defaultdict(list)
+    for class_name_key, class_object in all_classes_dict.items():
+        if class_object is None or not helper.is_target(class_name_key, targets):
+            continue
+        parallel = helper.get_parallel(class_name_key)
+        classes_by_parallel[(parallel, class_object.is_kz)].append((class_name_key, class_object))
+    return classes_by_parallel
 
 
 def set_data_to_subject(
@@ -78,54 +109,73 @@ def set_data_to_subject(
         file_path,
         normalized_subject_name,
         target_class_name,
+        plan: TopicPlan,
         is_dod: bool = False
 ):
     if not subjects_for_this_class:
-        print(f"# WARNING: Could not find a matching class for topics file '{file_path.name}'. Skip.")
+        log.warning("# WARNING: Could not find a matching class for topics file '{}'. Skip.", file_path.name)
         return
 
-    # --- 3. Find the subject object within that class ---
+    # --- 4. Find the subject object within that class ---
     subject_obj = subjects_for_this_class.get(normalized_subject_name)
     if not subject_obj:
-        print(f"# WARNING: Subject '{normalized_subject_name}' from file not found for class '{target_class_name}'. Skip.")
+        log.warning("# WARNING: Subject '{}' from file not found for class '{}'. Skip.",
+                    normalized_subject_name, target_class_name, class_name=target_class_name, subject=normalized_subject_name)
         return
 
-    # --- 4. Aggregate topics and homework from ALL sheets in the file ---
-    xls = pd.ExcelFile(file_path)
+    subject_obj.plan = plan
+    log.debug("  -> class '{}':'{}': {} topics in {} lessons.",
+              target_class_name, normalized_subject_name, len(plan.topics), len(plan))
+    if not log.wanted(log.DEBUG):
+        return
+    total = 0
+    for q in range(1, 5):
+        total += len(helper.get_days_this_quarter(subject_obj, q))
+    if is_dod and normalized_subject_name in config.two_per_month:
+        total = total //2
+    log.debug("  -> in total has {} hours this year.", total)
+
+
+def parse_topic_file(file_path, is_dod: bool = False):
+    """
+    Aggregates topics and homework from ALL sheets of a topics file into one plan,
+    every topic with the number of lesson hours it takes. The plan is shared by all classes of a parallel.
+    """
+    with excel_reader.open_workbook(file_path) as reader:
+        sheets = [(sheet_name, reader.rows(sheet_name)) for sheet_name in reader.sheet_names]
     all_topics = []
     all_homework = []
+    all_hours = []
 
     start_row_index = 8 if is_dod else 4  # Excel row 5 is 0-indexed as 4
 
-    for sheet_name in xls.sheet_names:
-        df = pd.read_excel(xls, sheet_name=sheet_name, header=None)
-
-        if len(df.columns) < 4:
-            print(f"  # WARNING: Sheet '{sheet_name}' in '{file_path.name}' has fewer than 4 columns. Skipping sheet.")
+    for sheet_name, rows in sheets:
+        if not rows or len(rows[0]) < 4:
+            log.warning("  # WARNING: Sheet '{}' in '{}' has fewer than 4 columns. Skipping sheet.", sheet_name, file_path.name)
             continue
 
-        if len(df) <= start_row_index:
-            print(f"  # WARNING: Sheet '{sheet_name}' in '{file_path.name}' has no data from row 5 onwards. Skipping.")
+        if len(rows) <= start_row_index:
+            log.warning("  # WARNING: Sheet '{}' in '{}' has no data from row 5 onwards. Skipping.", sheet_name, file_path.name)
             continue
 
-        for index, row in df.iloc[start_row_index:].iterrows():
+        for row in rows[start_row_index:]:
             if not is_dod:
-                topic_val = row.iloc[1]  # Column B (index 1) = Topic
-                hw_val = row.iloc[2]  # Column C (index 2) = Homework
-                hours_val = row.iloc[3]  # Column D (index 3) = Hours
+                topic_val = row[1]  # Column B (index 1) = Topic
+                hw_val = row[2]  # Column C (index 2) = Homework
+                hours_val = row[3]  # Column D (index 3) = Hours
             else:
-                topic_val = row.iloc[2]  # Column B (index 1) = Topic
-                hw_val = row.iloc[3]  # Column C (index 2) = Homework
-                hours_val = row.iloc[0]  # Column D (index 3) = Hours
+                topic_val = row[2]  # Column B (index 1) = Topic
+                hw_val = row[3]  # Column C (index 2) = Homework
+                hours_val = row[0]  # Column D (index 3) = Hours
 
             # If the topic cell is empty, we assume it's the end of the list
-            if pd.isna(topic_val) or str(topic_val).strip() == "":
+            if topic_val is None or str(topic_val).strip() == "":
                 continue
 
             # Clean the topic and homework values
             topic = str(topic_val).strip()
             # Handle empty homework cells gracefully
-            homework = str(hw_val).strip() if not pd.isna(hw_val) else ""
+            homework = str(hw_val).strip() if hw_val is not None else ""
 
             hours = 1
             try:
@@ -135,29 +185,20 @@ def set_data_to_subject(
             except (ValueError, TypeError):
                 hours = 1  # Default to 1 if cell is empty, text, or invalid
 
-            # Add the topic and homework 'hours' number of times
-            for _ in range(hours):
-                all_topics.append(topic)
-                all_homework.append(homework)
+            all_topics.append(topic)
+            all_homework.append(homework)
+            all_hours.append(hours)
 
-    subject_obj.topics = all_topics
-    subject_obj.homework = all_homework
-    print(f"  -> class '{target_class_name}':'{normalized_subject_name}': {len(all_topics)} topics and {len(all_homework)} homeworks.")
-    total = 0
-    for q in range(1, 5):
-        total += len(helper.get_days_this_quarter(subject_obj, q))
-    if is_dod and normalized_subject_name in config.two_per_month:
-        total = total //2
-    print(f"  -> in total has {total} hours this year.")
+    return TopicPlan(all_topics, all_homework, all_hours)
 
 
 def test():
     class_str = "10D"
     is_dod = True
-    all_classes_dict = timetable_extractor.extract_class_subjects(class_name=class_str, is_dod=is_dod)
-    extract_all_topics_and_hw(all_classes_dict, class_name=class_str, is_dod=is_dod)
+    all_classes_dict = timetable_extractor.extract_class_subjects(targets=[class_str], is_dod=is_dod)
+    extract_all_topics_and_hw(all_classes_dict, targets=[class_str], is_dod=is_dod)
     for subject_name, subject in all_classes_dict[class_str].subjects.items():
-        print(f"subject \'{subject_name}\' has topics: {subject.topics}")
+        print(f"subject \'{subject_name}\' has topics: {list(subject.plan.view().topics())}")
 
 
 if __name__ == "__main__":
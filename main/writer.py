@@ -1,10 +1,13 @@
 ﻿import openpyxl
 from openpyxl.utils import get_column_letter, column_index_from_string
 import config
+import instrument
+import log
 import sys
 from copy import copy
 
 
+@instrument.timed("extend_day_columns")
 def extend_day_columns(
         sheet,
         num_copies,
@@ -35,26 +38,23 @@ def extend_day_columns(
     cols_to_delete = []
     if not is_dod:
         if not is_last_quarter:  # delete the final grade, exam, and summary grade columns
-            print("      -> not the last quarter removed 3 columns")
+            log.debug("      -> not the last quarter removed 3 columns")
             cols_to_delete = [yearly_grade_idx,
                               yearly_grade_idx + 1,
                               yearly_grade_idx + 2]
         elif not has_exam:  # delete the exam and summary grade columns
-            print("      -> has no exam, removed 2 columns")
+            log.debug("      -> has no exam, removed 2 columns")
             cols_to_delete = [yearly_grade_idx + 1,
                               yearly_grade_idx + 2]
 
     new_merges = get_merges_to_restore(cols_to_delete, sheet, num_copies, is_last_quarter, has_exam, is_dod)
 
-    if len(cols_to_delete) > 0:
-        sheet.delete_cols(cols_to_delete[0], len(cols_to_delete))
     for col in cols_to_delete:
         del styles_widths[col]
-    # print_widths(sheet, f"after deletion of {len(cols_to_delete)} columns at index {yearly_grade_idx}")
     # print(f"   after deletion styles_widths uses columns = {list(styles_widths.keys())}")
 
-    sheet.insert_cols(daily_grade_col_idx, num_copies - 1)
-    # print_widths(sheet, f"after insertion of {num_copies - 1} columns")
+    move_to_final_columns(sheet, daily_grade_col_idx, num_copies, cols_to_delete)
+    # print_widths(sheet, f"after moving to the final {num_copies} daily columns")
 
     for col_idx in range(daily_grade_col_idx, daily_grade_col_idx + num_copies):
         current_col_letter = get_column_letter(col_idx)
@@ -81,6 +81,41 @@ def extend_day_columns(
     return sheet
 
 
+def final_column(col_idx, daily_grade_col_idx, num_copies, cols_to_delete):
+    """
+    Returns where a column of the template ends up once the daily grade column became num_copies columns
+    and cols_to_delete are gone, None for a deleted column. Columns left of the daily grade column stay.
+    """
+    if col_idx < daily_grade_col_idx:
+        return col_idx
+    if col_idx in cols_to_delete:
+        return None
+    if len(cols_to_delete) > 0 and col_idx > cols_to_delete[-1]:
+        col_idx -= len(cols_to_delete)
+    return col_idx + num_copies - 1
+
+
+def move_to_final_columns(sheet, daily_grade_col_idx, num_copies, cols_to_delete):
+    """
+    Puts every cell straight into its final column in one pass.
+    Same result as delete_cols(cols_to_delete) followed by insert_cols(daily_grade_col_idx, num_copies - 1),
+    without shifting all cells right of those columns twice.
+    """
+    max_col_idx = max((col_idx for (_, col_idx) in sheet._cells), default=0)
+    layout = {col_idx: final_column(col_idx, daily_grade_col_idx, num_copies, cols_to_delete)
+              for col_idx in range(daily_grade_col_idx, max_col_idx + 1)}
+
+    moved_cells = {}
+    for (row_idx, col_idx), cell in sheet._cells.items():
+        if col_idx >= daily_grade_col_idx:
+            col_idx = layout[col_idx]
+            if col_idx is None:
+                continue
+            cell.column = col_idx
+        moved_cells[(row_idx, col_idx)] = cell
+    sheet._cells = moved_cells
+
+
 def read_styles_and_width(sheet, col: str):
     styles = {}
     width = sheet.column_dimensions[col].width
@@ -148,7 +183,7 @@ def get_merges_to_restore(cols_to_delete, sheet, num_copies, is_last_quarter=Fal
                              f":{get_column_letter(new_max_col)}{merged_range.max_row}")
             new_merges.append(new_range_str)
         except Exception as e:
-            print(f"warning during merge manipulation: {e}")
+            log.warning("warning during merge manipulation: {}", e)
 
     return new_merges
 